@@ -0,0 +1,82 @@
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+from prometheus_client import Counter, Gauge
+
+IN_FLIGHT = Gauge("admission_in_flight", "Number of Twilio webhooks admitted and still being processed")
+IN_FLIGHT_LIMIT = Gauge("admission_in_flight_limit", "Maximum number of Twilio webhooks processed at once")
+REJECTED_COUNT = Counter("admission_rejected_count", "Total number of Twilio webhooks rejected or dropped", ["reason"])
+TRACKED_SENDERS = Gauge("admission_tracked_senders", "Number of senders with a rate counter")
+
+
+class AdmissionControl:
+    """
+    Limits how much webhook work is accepted at once, and from each sender
+
+    At most `max_in_flight` webhooks are processed at a time, any more are
+    turned away straight away so a flood can't queue unbounded work. Each
+    sender can send `sender_limit` messages or calls per `sender_window`
+    seconds, counted over a sliding window approximated from the counts of
+    the current and previous fixed windows. Counters are kept for the
+    `max_senders` most recent senders.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 100,
+        retry_after: int = 1,
+        sender_limit: int = 0,
+        sender_window: float = 60.0,
+        max_senders: int = 10000,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.sender_limit = sender_limit
+        self.sender_window = sender_window
+        self.max_senders = max_senders
+        self.in_flight = 0
+        # Sender to [window index, previous window count, current window count, dropped this window]
+        self.senders: OrderedDict[str, list[int]] = OrderedDict()
+        IN_FLIGHT_LIMIT.set(max_in_flight)
+
+    def acquire(self) -> bool:
+        """Admit a webhook, returns False if too many are already being processed"""
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            REJECTED_COUNT.labels("overloaded").inc()
+            return False
+        self.in_flight += 1
+        IN_FLIGHT.set(self.in_flight)
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        IN_FLIGHT.set(self.in_flight)
+
+    def check_sender(self, sender: str, now: float | None = None) -> int:
+        """Count a webhook from a sender, returns how many it has had dropped this window including this one"""
+        if not self.sender_limit or not sender:
+            return 0
+        now = monotonic() if now is None else now
+        position = now / self.sender_window
+        index = int(position)
+
+        state = self.senders.get(sender)
+        if state is None or state[0] < index - 1:
+            state = [index, 0, 0, 0]
+        elif state[0] == index - 1:
+            state = [index, state[2], 0, 0]
+        self.senders[sender] = state
+        self.senders.move_to_end(sender)
+        if len(self.senders) > self.max_senders:
+            self.senders.popitem(last=False)
+        TRACKED_SENDERS.set(len(self.senders))
+
+        # The previous window's count is weighted by how much of it is still within the sliding window
+        if state[1] * (1 - (position - index)) + state[2] >= self.sender_limit:
+            state[3] += 1
+            REJECTED_COUNT.labels("sender_rate").inc()
+            return state[3]
+        state[2] += 1
+        return 0
@@ -2,19 +2,36 @@ import argparse
 import asyncio
 import logging
 import os
+import secrets
+import socket
 import sys
 from configparser import ConfigParser
 from signal import SIGINT, SIGTERM
-from twilio.rest import Client
 
 import uvicorn
-from asgiref.wsgi import WsgiToAsgi
+from telegram import Update
+from telegram.error import TelegramError
 
+from smsbot.admission import AdmissionControl
+from smsbot.cluster import LeaderElection, SqliteLease
+from smsbot.coalesce import Coalescer
+from smsbot.dedupe import DedupeCache
+from smsbot.delivery import DeliveryQueue
+from smsbot.diagnostics import Diagnostics
+from smsbot.fanout import FanOut
+from smsbot.health import ChatHealth
+from smsbot.history import MessageHistory
+from smsbot.media import MediaRelay
+from smsbot.routing import Router, parse_rules
+from smsbot.sms import OutboundSms
+from smsbot.store import SqliteSubscriberStore, SubscriberStore
 from smsbot.telegram import TelegramSmsBot
 from smsbot.utils import get_smsbot_version
+from smsbot.utils.log import setup_logging
+from smsbot.utils.render import DEFAULT_CALL_TEMPLATE, DEFAULT_MESSAGE_TEMPLATE, MarkdownV2Renderer
+from smsbot.validation import TwilioSignatureValidator
 from smsbot.webhook import TwilioWebhookHandler
 
-
 # Prefix of the environment variables to override config values
 ENVIRONMENT_PREFIX = "SMSBOT_"
 
@@ -72,58 +89,240 @@ def main():
         )
         return
 
-    # Now the config is loaded, set the logger level
+    # Now the config is loaded, log from a background thread at the configured level
     level = getattr(logging, config.get("logging", "level", fallback="INFO").upper(), logging.INFO)
-    logging.getLogger().setLevel(level)
+    log_listener = setup_logging(
+        level=level,
+        stream=args.log_file,
+        json_format=config.get("logging", "format", fallback="text").lower() == "json",
+        redact=config.getboolean("logging", "redact", fallback=True),
+    )
 
-    # Configure Twilio client if we have credentials
+    # Configure outbound SMS if we have credentials
     if config.has_section("twilio") and config.get("twilio", "account_sid") and config.get("twilio", "auth_token"):
-        twilio_client = Client(
-            config.get("twilio", "account_sid"),
-            config.get("twilio", "auth_token"),
+        # Twilio can only post SMS statuses back if it knows our public URL
+        public_url = config.get("webhook", "public_url", fallback=None)
+        outbound_sms = OutboundSms(
+            account_sid=config.get("twilio", "account_sid"),
+            auth_token=config.get("twilio", "auth_token"),
+            from_number=config.get("twilio", "from_number"),
+            concurrency=config.getint("twilio", "concurrency", fallback=4),
+            status_callback=f"{public_url.rstrip('/')}/status" if public_url else None,
         )
     else:
-        twilio_client = None
+        outbound_sms = None
         logging.warning("No Twilio credentials found, outbound SMS functionality will be disabled.")
 
+    # Owners come from the config, default subscribers are added to the store on start
+    owners = [config.getint("telegram", "owner_id")] if config.has_option("telegram", "owner_id") else []
+    if not owners:
+        logging.warning("No Owner ID is set, which is not a good idea...")
+    subscribers = []
+    if config.has_option("telegram", "subscribers"):
+        subscribers = [int(chat_id.strip()) for chat_id in config.get("telegram", "subscribers").split(",")]
+
+    # Replicas share subscribers, seen webhooks and the polling lease through one SQLite file
+    cluster_path = config.get("cluster", "path", fallback=None)
+    if cluster_path:
+        logging.info("Running as one of several replicas, sharing state in %s", cluster_path)
+
+    if config.has_option("store", "path") or cluster_path:
+        store = SqliteSubscriberStore(
+            config.get("store", "path", fallback=cluster_path),
+            owners=owners,
+            subscribers=subscribers,
+            shared=bool(cluster_path),
+        )
+    else:
+        store = SubscriberStore(owners=owners, subscribers=subscribers)
+
+    # Searchable history of received messages, for /last and /search
+    if config.has_option("history", "path"):
+        history = MessageHistory(
+            path=config.get("history", "path"),
+            max_messages=config.getint("history", "max_messages", fallback=100000),
+            max_age=config.getfloat("history", "max_age_days", fallback=30) * 86400,
+            batch_size=config.getint("history", "batch_size", fallback=100),
+            flush_interval=config.getfloat("history", "flush_interval", fallback=1.0),
+        )
+    else:
+        history = None
+
     # Start bot
     telegram_bot = TelegramSmsBot(
         token=config.get("telegram", "bot_token"),
-        twilio_client=twilio_client,
-        twilio_from_number=config.get("twilio", "from_number", fallback=None),
+        outbound_sms=outbound_sms,
+        fanout=FanOut(
+            global_rate=config.getfloat("telegram", "global_rate", fallback=30.0),
+            chat_rate=config.getfloat("telegram", "chat_rate", fallback=1.0),
+        ),
+        store=store,
+        health=ChatHealth(
+            backoff=config.getfloat("telegram", "chat_backoff", fallback=30.0),
+            probe_interval=config.getfloat("telegram", "chat_probe_interval", fallback=6 * 3600.0),
+        ),
+        base_url=config.get("telegram", "base_url", fallback=None),
+        history=history,
     )
 
-    # Set the owner ID if configured
-    if config.has_option("telegram", "owner_id"):
-        telegram_bot.owners = [config.getint("telegram", "owner_id")]
+    # Durable delivery queue, if configured webhooks are acknowledged before being sent to Telegram
+    if config.has_option("queue", "path"):
+        delivery_queue = DeliveryQueue(
+            path=config.get("queue", "path"),
+            workers=config.getint("queue", "workers", fallback=4),
+            max_attempts=config.getint("queue", "max_attempts", fallback=5),
+            max_defer=config.getfloat("queue", "max_defer", fallback=3600.0),
+        )
+        logging.info("Using delivery queue at %s", delivery_queue.path)
     else:
-        logging.warning("No Owner ID is set, which is not a good idea...")
+        delivery_queue = None
 
-    # Add default subscribers
-    if config.has_option("telegram", "subscribers"):
-        for chat_id in config.get("telegram", "subscribers").split(","):
-            telegram_bot.subscribers.append(int(chat_id.strip()))
+    # Ignore webhooks Twilio retries after a timeout or error
+    dedupe = DedupeCache(
+        ttl=config.getfloat("dedupe", "ttl", fallback=3600),
+        max_size=config.getint("dedupe", "max_size", fallback=10000),
+        path=config.get("dedupe", "path", fallback=cluster_path),
+        shared=bool(cluster_path),
+    )
+
+    # Message templates, written in MarkdownV2 with $placeholders and \n for new lines
+    message_template = config.get("render", "message_template", fallback=DEFAULT_MESSAGE_TEMPLATE)
+    call_template = config.get("render", "call_template", fallback=DEFAULT_CALL_TEMPLATE)
+    renderer = MarkdownV2Renderer(
+        message_template=message_template.replace("\\n", "\n"),
+        call_template=call_template.replace("\\n", "\n"),
+    )
+
+    # Receive Telegram updates by webhook on the same server, rather than polling
+    telegram_webhook_url = config.get("telegram", "webhook_url", fallback=None)
+    telegram_secret = None
+    if telegram_webhook_url:
+        telegram_secret = config.get("telegram", "webhook_secret", fallback=None)
+        if not telegram_secret:
+            if cluster_path:
+                # Telegram may send an update to any replica, so they must all accept the same secret
+                logging.error("A Telegram webhook secret is required when running several replicas.")
+                return
+            telegram_secret = secrets.token_urlsafe(32)
+
+    # Only one replica may poll Telegram for updates at a time, including if setting the webhook fails
+    if cluster_path:
+        election = LeaderElection(
+            SqliteLease(
+                cluster_path,
+                holder=config.get("cluster", "name", fallback=f"{socket.gethostname()}-{os.getpid()}"),
+                ttl=config.getfloat("cluster", "lease_ttl", fallback=15.0),
+                name="telegram_polling",
+            )
+        )
+    else:
+        election = None
+
+    # Combine bursts of messages into digests
+    if config.getfloat("coalesce", "window", fallback=0):
+        if delivery_queue is not None:
+            # Twilio is answered before a buffered message is on disk, so the queue couldn't keep it safe
+            logging.error("Coalescing can't be used with the delivery queue, remove one of them.")
+            return
+        coalescer = Coalescer(
+            window=config.getfloat("coalesce", "window"),
+            max_latency=config.getfloat("coalesce", "max_latency", fallback=5.0),
+            max_batch=config.getint("coalesce", "max_batch", fallback=10),
+            key=config.get("coalesce", "key", fallback="from"),
+        )
+    else:
+        coalescer = None
+
+    # Download MMS media and send it to Telegram as files
+    if config.has_option("media", "cache_dir"):
+        account_sid = config.get("twilio", "account_sid", fallback=None)
+        auth_token = config.get("twilio", "auth_token", fallback=None)
+        media_relay = MediaRelay(
+            cache_dir=config.get("media", "cache_dir"),
+            cache_size=config.getint("media", "cache_size_mb", fallback=256) * 1024 * 1024,
+            concurrency=config.getint("media", "concurrency", fallback=4),
+            auth=(account_sid, auth_token) if account_sid and auth_token else None,
+        )
+    else:
+        media_relay = None
+
+    # Send messages and calls to chats picked by their numbers or content, rather than every subscriber
+    if config.has_section("routing"):
+        router = Router(
+            to=parse_rules(config.get("routing", "to", fallback="")),
+            from_prefixes=parse_rules(config.get("routing", "from", fallback="")),
+            keywords=parse_rules(config.get("routing", "keywords", fallback="")),
+            fallback=config.getboolean("routing", "fallback", fallback=True),
+        )
+    else:
+        router = None
+
+    # Limit the webhooks processed at once, and from each sender
+    if config.has_section("admission"):
+        admission = AdmissionControl(
+            max_in_flight=config.getint("admission", "max_in_flight", fallback=100),
+            retry_after=config.getint("admission", "retry_after", fallback=1),
+            sender_limit=config.getint("admission", "sender_limit", fallback=20),
+            sender_window=config.getfloat("admission", "sender_window", fallback=60.0),
+        )
+    else:
+        admission = None
+
+    # Profiling and task listing at /debug, only enabled with a token to access them
+    if config.get("debug", "token", fallback=None):
+        diagnostics = Diagnostics(
+            token=config.get("debug", "token"),
+            max_seconds=config.getfloat("debug", "max_seconds", fallback=60.0),
+        )
+        logging.warning("Debug endpoints are enabled at /debug")
+    else:
+        diagnostics = None
 
     # Init the webhook handler
     webhooks = TwilioWebhookHandler(
         account_sid=config.get("twilio", "account_sid", fallback=None),
         auth_token=config.get("twilio", "auth_token", fallback=None),
+        debug=args.debug,
+        delivery_queue=delivery_queue,
+        dedupe=dedupe,
+        validator=TwilioSignatureValidator(
+            auth_tokens=[
+                config.get("twilio", "auth_token", fallback=None),
+                config.get("twilio", "secondary_auth_token", fallback=None),
+            ],
+            public_url=config.get("webhook", "public_url", fallback=None),
+            trust_forwarded=config.getboolean("webhook", "trust_forwarded_headers", fallback=False),
+        ),
+        renderer=renderer,
+        telegram_secret=telegram_secret,
+        coalescer=coalescer,
+        media_relay=media_relay,
+        router=router,
+        admission=admission,
+        history=history,
+        diagnostics=diagnostics,
     )
     webhooks.set_telegram_application(telegram_bot)
 
-    # Build a uvicorn ASGI server
-    flask_app = uvicorn.Server(
+    # Build a uvicorn ASGI server, sharing the event loop with the Telegram bot
+    webhook_server = uvicorn.Server(
         config=uvicorn.Config(
-            app=WsgiToAsgi(webhooks.app),
+            app=webhooks,
             port=config.getint("webhook", "port", fallback=5000),
             use_colors=False,
+            # Leave uvicorn's loggers to propagate to the root logger, so they're queued and redacted too
+            log_config=None,
             host=config.get("webhook", "host", fallback="127.0.0.1"),
         )
     )
 
     # Loop until exit
     loop = asyncio.get_event_loop()
-    main_task = asyncio.ensure_future(run_bot(telegram_bot, flask_app))
+    if diagnostics is not None:
+        diagnostics.install(loop)
+    main_task = asyncio.ensure_future(
+        run_bot(telegram_bot, webhook_server, telegram_webhook_url, telegram_secret, election)
+    )
     for signal in [SIGINT, SIGTERM]:
         loop.add_signal_handler(signal, main_task.cancel)
     try:
@@ -133,24 +332,58 @@ def main():
         pass
     finally:
         loop.close()
+        log_listener.stop()
 
 
-async def run_bot(telegram_bot: TelegramSmsBot, flask_app):
+async def run_bot(
+    telegram_bot: TelegramSmsBot,
+    webhook_server: uvicorn.Server,
+    telegram_webhook_url: str | None = None,
+    telegram_secret: str | None = None,
+    election: LeaderElection | None = None,
+):
     # Start async Telegram bot
     try:
         # Start the bot
         await telegram_bot.app.initialize()
         await telegram_bot.app.start()
-        await telegram_bot.app.updater.start_polling()
+        # Use the Telegram webhook if configured, polling is the fallback
+        use_webhook = bool(telegram_webhook_url) and await set_telegram_webhook(
+            telegram_bot, telegram_webhook_url, telegram_secret
+        )
+        if not use_webhook and election is not None:
+            # Only poll while this replica holds the lease
+            election.on_elected = telegram_bot.app.updater.start_polling
+            election.on_demoted = telegram_bot.app.updater.stop
+            election.start()
+        elif not use_webhook:
+            await telegram_bot.app.updater.start_polling()
 
-        # Startup uvicorn/flask
-        await flask_app.serve()
+        # Startup uvicorn
+        await webhook_server.serve()
 
         # Run the bot idle loop
         await telegram_bot.app.updater.idle()
     finally:
         # Shutdown in reverse order
-        await flask_app.shutdown()
-        await telegram_bot.app.updater.stop()
+        await webhook_server.shutdown()
+        if election is not None:
+            await election.stop()
+        if telegram_bot.app.updater.running:
+            await telegram_bot.app.updater.stop()
         await telegram_bot.app.stop()
         await telegram_bot.app.shutdown()
+        if telegram_bot.outbound_sms:
+            await telegram_bot.outbound_sms.close()
+
+
+async def set_telegram_webhook(telegram_bot: TelegramSmsBot, base_url: str, secret: str) -> bool:
+    """Register our webhook endpoint with Telegram, returns False if polling should be used instead"""
+    url = f"{base_url.rstrip('/')}/telegram"
+    try:
+        await telegram_bot.app.bot.set_webhook(url=url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+    except TelegramError:
+        logging.exception("Failed to set the Telegram webhook, falling back to polling")
+        return False
+    logging.info("Receiving Telegram updates by webhook at %s", url)
+    return True
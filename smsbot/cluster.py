@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import sqlite3
+from contextlib import closing
+from time import monotonic, time
+from typing import Awaitable, Callable
+
+from prometheus_client import Gauge
+
+LEADER = Gauge("cluster_leader", "1 if this replica holds the leader lease, otherwise 0")
+
+
+class Lease:
+    """
+    A named lease that only one replica can hold at a time
+
+    The lease is held until `ttl` seconds after it was last acquired, so a
+    replica that dies loses it without having to release it. This lease is
+    kept in a dict, which replicas in the same process can share.
+    """
+
+    def __init__(
+        self,
+        holder: str,
+        ttl: float = 15.0,
+        name: str = "leader",
+        leases: dict[str, tuple[str, float]] | None = None,
+    ):
+        self.holder = holder
+        self.ttl = ttl
+        self.name = name
+        self.leases = leases if leases is not None else {}
+
+    def acquire(self) -> bool:
+        """Take or renew the lease, returns False if another replica holds it"""
+        now = time()
+        current = self.leases.get(self.name)
+        if current is not None and current[0] != self.holder and current[1] > now:
+            return False
+        self.leases[self.name] = (self.holder, now + self.ttl)
+        return True
+
+    def release(self) -> None:
+        """Give up the lease if we hold it"""
+        current = self.leases.get(self.name)
+        if current is not None and current[0] == self.holder:
+            del self.leases[self.name]
+
+
+class SqliteLease(Lease):
+    """A lease stored in a SQLite database shared by every replica"""
+
+    def __init__(self, path: str, holder: str, ttl: float = 15.0, name: str = "leader"):
+        super().__init__(holder, ttl, name)
+        self.path = path
+        with closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            connection.commit()
+
+    def connect(self) -> sqlite3.Connection:
+        # A connection per call, as leases are acquired from a worker thread
+        return sqlite3.connect(self.path, timeout=self.ttl / 3)
+
+    def acquire(self) -> bool:
+        now = time()
+        with closing(self.connect()) as connection:
+            # A single statement, so two replicas can't both take an expired lease
+            cursor = connection.execute(
+                "INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires "
+                "WHERE leases.holder = excluded.holder OR leases.expires <= ?",
+                (self.name, self.holder, now + self.ttl, now),
+            )
+            connection.commit()
+            return cursor.rowcount == 1
+
+    def release(self) -> None:
+        with closing(self.connect()) as connection:
+            connection.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+            connection.commit()
+
+
+class LeaderElection:
+    """
+    Runs a task on only one replica at a time
+
+    Every replica tries to acquire the lease every `interval` seconds, a third
+    of its TTL by default. The replica holding it calls `on_elected`, and
+    `on_demoted` once it loses the lease or can no longer renew it before it
+    expires, so the task never runs on two replicas for longer than it takes
+    to notice.
+    """
+
+    def __init__(
+        self,
+        lease: Lease,
+        on_elected: Callable[[], Awaitable[None]] | None = None,
+        on_demoted: Callable[[], Awaitable[None]] | None = None,
+        interval: float | None = None,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lease = lease
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.interval = interval if interval is not None else lease.ttl / 3
+        self.leader = False
+        self.expires = 0.0
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval)
+
+    async def check(self) -> None:
+        """Try to acquire the lease, starting or stopping the task if leadership changed"""
+        started = monotonic()
+        try:
+            held = await asyncio.to_thread(self.lease.acquire)
+        except Exception:
+            self.logger.exception("Unable to acquire the %s lease", self.lease.name)
+            # Keep leading until the lease we last renewed runs out
+            held = self.leader and monotonic() < self.expires
+        else:
+            if held:
+                self.expires = started + self.lease.ttl
+
+        if held and not self.leader:
+            self.logger.info("%s is now the leader", self.lease.holder)
+            self.leader = True
+            LEADER.set(1)
+            try:
+                if self.on_elected:
+                    await self.on_elected()
+            except Exception:
+                self.logger.exception("Failed to start as leader, giving up the lease")
+                await self.demote()
+                await asyncio.to_thread(self.lease.release)
+        elif not held and self.leader:
+            self.logger.warning("%s is no longer the leader", self.lease.holder)
+            await self.demote()
+
+    async def demote(self) -> None:
+        self.leader = False
+        LEADER.set(0)
+        try:
+            if self.on_demoted:
+                await self.on_demoted()
+        except Exception:
+            self.logger.exception("Failed to stop as leader")
+
+    async def stop(self) -> None:
+        """Stop trying to lead, releasing the lease if we hold it"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.leader:
+            await self.demote()
+            await asyncio.to_thread(self.lease.release)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Callable, Hashable
+
+from prometheus_client import Counter
+
+from smsbot.utils.twilio import TwilioCall, TwilioMessage
+
+COALESCED_COUNT = Counter("coalesce_messages_count", "Total number of messages combined into a digest")
+DIGEST_COUNT = Counter("coalesce_digest_count", "Total number of digests sent")
+
+
+class Batch:
+    """Messages buffered for one key"""
+
+    def __init__(self, chats: set[int] | None) -> None:
+        self.chats = chats
+        self.created = monotonic()
+        self.messages: list[TwilioMessage] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class Coalescer:
+    """
+    Combines bursts of SMS messages into a single digest
+
+    Messages are buffered per sender, or per destination number, until no new
+    message has arrived for `window` seconds. A batch is flushed early when it
+    reaches `max_batch` messages, and never waits longer than `max_latency`
+    seconds after its first message, so 2FA codes still arrive promptly.
+    Calls are passed straight through. Buffered messages are only held in
+    memory, so coalescing isn't used with the durable delivery queue.
+
+    Messages are only combined with others routed to the same chats. `flush`
+    is called with each digest and those chats, the webhook handler sets it to
+    its own delivery path if it is not given.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[TwilioCall | TwilioMessage, set[int] | None], Awaitable[None]] | None = None,
+        window: float = 2.0,
+        max_latency: float = 5.0,
+        max_batch: int = 10,
+        key: str = "from",
+    ):
+        if key not in ("from", "to"):
+            raise ValueError(f"Invalid coalesce key {key!r}, must be 'from' or 'to'")
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.flush = flush
+        self.window = window
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.key = key
+        self.batches: dict[Hashable, Batch] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    async def add(self, payload: TwilioCall | TwilioMessage, chats: set[int] | None = None) -> None:
+        """Buffer a message routed to `chats`, None being every subscriber, flushing its batch if it is full"""
+        if not isinstance(payload, TwilioMessage):
+            await self.flush(payload, chats)
+            return
+
+        number = payload.from_number if self.key == "from" else payload.to_number
+        key = (number, None if chats is None else frozenset(chats))
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = Batch(chats)
+        batch.messages.append(payload)
+
+        if len(batch.messages) >= self.max_batch:
+            self.flush_batch(key)
+            return
+
+        # Wait for the window to pass without another message, capped at the maximum latency
+        if batch.timer:
+            batch.timer.cancel()
+        delay = max(0.0, min(self.window, batch.created + self.max_latency - monotonic()))
+        batch.timer = asyncio.get_running_loop().call_later(delay, self.flush_batch, key)
+
+    def flush_batch(self, key: Hashable) -> None:
+        """Send a batch in the background"""
+        batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer:
+            batch.timer.cancel()
+        task = asyncio.create_task(self.send(batch.messages, batch.chats))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, messages: list[TwilioMessage], chats: set[int] | None) -> None:
+        if len(messages) == 1:
+            payload = messages[0]
+        else:
+            self.logger.info("Combining %d messages into one digest", len(messages))
+            payload = TwilioMessage.combine(messages)
+            COALESCED_COUNT.inc(len(messages))
+            DIGEST_COUNT.inc()
+        try:
+            await self.flush(payload, chats)
+        except Exception:
+            self.logger.exception("Failed to send %r", payload)
+
+    async def stop(self) -> None:
+        """Flush everything still buffered and wait for it to be sent"""
+        for key in list(self.batches):
+            self.flush_batch(key)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from prometheus_client import Counter
+
+DEDUPE_HITS = Counter("webhook_dedupe_hits", "Total number of duplicate webhooks ignored")
+DEDUPE_MISSES = Counter("webhook_dedupe_misses", "Total number of webhooks seen for the first time")
+
+
+class DedupeCache:
+    """
+    A bounded LRU cache of recently seen Twilio SIDs with a TTL
+
+    Twilio re-posts a webhook if it times out or gets an error, this lets the
+    handler acknowledge the retry without sending it to Telegram again. If a
+    path is given seen SIDs are also written to SQLite so they survive a
+    restart.
+
+    When `shared` the database is shared with other replicas, as Twilio's
+    retry may reach a different one. Each new SID is then claimed with a
+    single upsert, so only one replica processes it, and rows are only
+    removed once they expire.
+
+    Lookups are answered from memory, the database is only written to on a
+    single thread off the event loop, so a replica holding the write lock
+    can't stall webhooks.
+    """
+
+    # Seconds between removing expired SIDs from a shared database
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self, ttl: float = 3600, max_size: int = 10000, path: str | None = None, shared: bool = False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.shared = shared and bool(path)
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        self.next_prune = 0.0
+
+        # All database access after loading happens on a single thread, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedupe")
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS seen (sid TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            self.connection.execute("DELETE FROM seen WHERE expires < ?", (time(),))
+            self.connection.commit()
+            rows = self.connection.execute(
+                "SELECT sid, expires FROM seen ORDER BY expires DESC LIMIT ?", (max_size,)
+            ).fetchall()
+            for sid, expires in reversed(rows):
+                self.entries[sid] = expires
+            self.logger.info("Loaded %d recently seen webhooks from %s", len(self.entries), path)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def seen(self, sid: str) -> bool:
+        """Return True if the SID was seen within the TTL, otherwise record it and return False"""
+        now = time()
+        expires = self.entries.get(sid)
+        if expires is not None and expires > now:
+            DEDUPE_HITS.inc()
+            return True
+
+        # Recorded before awaiting the database, so a retry arriving meanwhile is already seen
+        self.entries[sid] = now + self.ttl
+        self.entries.move_to_end(sid)
+        evicted = []
+        while len(self.entries) > self.max_size:
+            evicted.append(self.entries.popitem(last=False)[0])
+
+        if self.shared:
+            if not await self.claim(sid, now):
+                # Only remembered by the replica that claimed it, so its forget lets a retry through here too
+                self.entries.pop(sid, None)
+                DEDUPE_HITS.inc()
+                return True
+        elif self.connection:
+            await self._run(self._insert, sid, now + self.ttl, evicted)
+        DEDUPE_MISSES.inc()
+        return False
+
+    def _insert(self, sid: str, expires: float, evicted: list[str]) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO seen (sid, expires) VALUES (?, ?)", (sid, expires))
+        self.connection.executemany("DELETE FROM seen WHERE sid = ?", [(evicted_sid,) for evicted_sid in evicted])
+        self.connection.commit()
+
+    async def claim(self, sid: str, now: float) -> bool:
+        """Record a SID in the shared database, returns False if another replica saw it within the TTL"""
+        return await self._run(self._claim, sid, now)
+
+    def _claim(self, sid: str, now: float) -> bool:
+        cursor = self.connection.execute(
+            "INSERT INTO seen (sid, expires) VALUES (?, ?) "
+            "ON CONFLICT(sid) DO UPDATE SET expires = excluded.expires WHERE seen.expires <= ?",
+            (sid, now + self.ttl, now),
+        )
+        if now >= self.next_prune:
+            self.connection.execute("DELETE FROM seen WHERE expires <= ?", (now,))
+            self.next_prune = now + self.PRUNE_INTERVAL
+        self.connection.commit()
+        return cursor.rowcount == 1
+
+    async def forget(self, sid: str) -> None:
+        """Remove a SID, so a retry of a webhook that failed is processed again"""
+        self.entries.pop(sid, None)
+        if self.connection:
+            await self._run(self._delete, sid)
+
+    def _delete(self, sid: str) -> None:
+        self.connection.execute("DELETE FROM seen WHERE sid = ?", (sid,))
+        self.connection.commit()
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Awaitable, Callable
+
+from prometheus_client import Counter, Gauge
+
+from smsbot.fanout import FanOutError
+from smsbot.utils.twilio import TwilioWebhookPayload
+
+QUEUE_DEPTH = Gauge("delivery_queue_depth", "Number of payloads waiting to be delivered")
+QUEUE_OLDEST_AGE = Gauge("delivery_queue_oldest_age_seconds", "Age of the oldest payload waiting to be delivered")
+QUEUE_ENQUEUED = Counter("delivery_queue_enqueued_count", "Total number of payloads added to the delivery queue")
+QUEUE_DELIVERED = Counter("delivery_queue_delivered_count", "Total number of payloads delivered from the queue")
+QUEUE_RETRIED = Counter("delivery_queue_retried_count", "Total number of failed delivery attempts that were retried")
+QUEUE_DEFERRED = Counter("delivery_queue_deferred_count", "Total number of payloads put off until a chat is healthy")
+QUEUE_DROPPED = Counter("delivery_queue_dropped_count", "Total number of payloads dropped undelivered")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class DeliveryQueue:
+    """
+    A durable queue between the webhook endpoints and Telegram
+
+    Payloads are written to a SQLite database in WAL mode before the webhook
+    returns, then delivered by a pool of async workers. Anything still in the
+    database when the process starts is queued again, so a restart does not
+    lose messages.
+
+    A payload that every chat was skipped for is retried without counting an
+    attempt, until it is `max_defer` seconds old and is dropped, so messages
+    for chats that stay unavailable don't pile up.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        workers: int = 4,
+        max_attempts: int = 5,
+        retry_delay: float = 2.0,
+        max_defer: float = 3600.0,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_defer = max_defer
+
+        # All database access happens on a single thread, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="delivery-queue")
+        self.connection: sqlite3.Connection | None = None
+
+        self.queue: asyncio.Queue[tuple[int, TwilioWebhookPayload, int]] = asyncio.Queue()
+        self.pending: dict[int, float] = {}
+        self.tasks: list[asyncio.Task] = []
+
+        QUEUE_DEPTH.set_function(lambda: len(self.pending))
+        QUEUE_OLDEST_AGE.set_function(self.oldest_age)
+
+    def oldest_age(self) -> float:
+        """Return the age in seconds of the oldest undelivered payload"""
+        if not self.pending:
+            return 0.0
+        return time() - min(self.pending.values())
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _open(self) -> list[tuple[int, str, float, int]]:
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        return self.connection.execute("SELECT id, payload, created, attempts FROM deliveries ORDER BY id").fetchall()
+
+    def _insert(self, payload: str, created: float) -> int:
+        cursor = self.connection.execute("INSERT INTO deliveries (payload, created) VALUES (?, ?)", (payload, created))
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def _delete(self, delivery_id: int) -> None:
+        self.connection.execute("DELETE FROM deliveries WHERE id = ?", (delivery_id,))
+        self.connection.commit()
+
+    def _set_attempts(self, delivery_id: int, attempts: int) -> None:
+        self.connection.execute("UPDATE deliveries SET attempts = ? WHERE id = ?", (attempts, delivery_id))
+        self.connection.commit()
+
+    async def start(self, deliver: Callable[[TwilioWebhookPayload], Awaitable[None]]) -> None:
+        """Open the database, requeue any undelivered payloads and start the workers"""
+        rows = await self._run(self._open)
+        for delivery_id, payload, created, attempts in rows:
+            self.pending[delivery_id] = created
+            self.queue.put_nowait((delivery_id, self.load(payload), attempts))
+        if rows:
+            self.logger.info("Recovered %d undelivered payloads from %s", len(rows), self.path)
+
+        self.tasks = [asyncio.create_task(self.worker(deliver)) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Stop the workers and close the database, undelivered payloads stay on disk"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.connection:
+            await self._run(self.connection.close)
+            self.connection = None
+
+    async def put(self, payload: TwilioWebhookPayload) -> int:
+        """Persist a payload and queue it for delivery"""
+        created = time()
+        delivery_id = await self._run(self._insert, json.dumps(payload.to_dict()), created)
+        self.pending[delivery_id] = created
+        self.queue.put_nowait((delivery_id, payload, 0))
+        QUEUE_ENQUEUED.inc()
+        return delivery_id
+
+    def load(self, payload: str) -> TwilioWebhookPayload:
+        """Rebuild a payload from its stored form"""
+        return TwilioWebhookPayload.parse(json.loads(payload))
+
+    async def worker(self, deliver: Callable[[TwilioWebhookPayload], Awaitable[None]]) -> None:
+        while True:
+            delivery_id, payload, attempts = await self.queue.get()
+            try:
+                await deliver(payload)
+            except asyncio.CancelledError:
+                raise
+            except FanOutError as exc:
+                if not exc.deferred:
+                    await self.failed(delivery_id, payload, attempts + 1)
+                elif time() - self.pending[delivery_id] >= self.max_defer:
+                    self.logger.error("Dropping %r, no chat could receive it for %g seconds", payload, self.max_defer)
+                    await self.drop(delivery_id)
+                else:
+                    # Nothing was sent as every chat is unhealthy, so it's kept without counting an attempt
+                    self.logger.info("No chats can receive %r yet, retrying later", payload)
+                    self.retry_later(delivery_id, payload, attempts, self.retry_delay * 2 ** (self.max_attempts - 1))
+                    QUEUE_DEFERRED.inc()
+            except Exception:
+                await self.failed(delivery_id, payload, attempts + 1)
+            else:
+                await self._run(self._delete, delivery_id)
+                self.pending.pop(delivery_id, None)
+                QUEUE_DELIVERED.inc()
+            finally:
+                self.queue.task_done()
+
+    async def failed(self, delivery_id: int, payload: TwilioWebhookPayload, attempts: int) -> None:
+        """Retry a failed delivery, or drop it after too many attempts"""
+        if attempts >= self.max_attempts:
+            self.logger.exception("Dropping %r after %d failed attempts", payload, attempts)
+            await self.drop(delivery_id)
+        else:
+            self.logger.warning("Delivery of %r failed, retrying (attempt %d)", payload, attempts)
+            await self._run(self._set_attempts, delivery_id, attempts)
+            self.retry_later(delivery_id, payload, attempts)
+            QUEUE_RETRIED.inc()
+
+    async def drop(self, delivery_id: int) -> None:
+        await self._run(self._delete, delivery_id)
+        self.pending.pop(delivery_id, None)
+        QUEUE_DROPPED.inc()
+
+    def retry_later(
+        self, delivery_id: int, payload: TwilioWebhookPayload, attempts: int, delay: float | None = None
+    ) -> None:
+        """Requeue a payload after `delay` seconds, or an exponential backoff"""
+        if delay is None:
+            delay = self.retry_delay * 2 ** (attempts - 1)
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, (delivery_id, payload, attempts))
+
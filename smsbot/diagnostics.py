@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from time import monotonic, sleep
+from types import FrameType
+from weakref import WeakKeyDictionary
+
+
+def frame_name(frame: FrameType) -> str:
+    """Name a frame by its function and where the function is defined"""
+    code = frame.f_code
+    path = os.path.join(*code.co_filename.split(os.sep)[-2:])
+    return f"{code.co_qualname} ({path}:{code.co_firstlineno})"
+
+
+def collapse(frame: FrameType | None) -> str:
+    """Return a stack in collapsed form, outermost frame first and separated by semicolons"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample(thread_id: int, seconds: float, interval: float) -> Counter[str]:
+    """Sample a thread's stack every `interval` seconds, counting how often each stack is seen"""
+    stacks: Counter[str] = Counter()
+    end = monotonic() + seconds
+    while monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[collapse(frame)] += 1
+        del frame
+        sleep(interval)
+    return stacks
+
+
+class Diagnostics:
+    """
+    Profiles the running service and lists its asyncio tasks, for debugging in production
+
+    Nothing here runs unless it's enabled. The profiler samples the event
+    loop thread's stack from another thread, so it sees the webhook handlers
+    and the Telegram application's handlers alike, and only while a profile
+    is being taken. Task ages come from a task factory installed on the loop,
+    tasks created before it was installed have no age.
+    """
+
+    def __init__(self, token: str, max_seconds: float = 60.0, interval: float = 0.005):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.token = token
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self.created: WeakKeyDictionary[asyncio.Task, float] = WeakKeyDictionary()
+        self.profiling = False
+
+    def install(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Record when each task is created on the loop"""
+        previous = loop.get_task_factory()
+
+        def task_factory(loop, coro, **kwargs):
+            if previous is not None:
+                task = previous(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            self.created[task] = monotonic()
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    async def profile(self, seconds: float) -> str:
+        """Sample the event loop for a number of seconds, returning the stacks in collapsed form"""
+        seconds = min(seconds, self.max_seconds)
+        self.logger.info("Profiling the event loop for %gs", seconds)
+        self.profiling = True
+        try:
+            stacks = await asyncio.to_thread(sample, threading.get_ident(), seconds, self.interval)
+        finally:
+            self.profiling = False
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def tasks(self) -> list[dict]:
+        """Describe every pending task on the running loop, oldest first"""
+        now = monotonic()
+        tasks = []
+        for task in asyncio.all_tasks():
+            created = self.created.get(task)
+            coro = task.get_coro()
+            tasks.append(
+                {
+                    "name": task.get_name(),
+                    "coroutine": getattr(coro, "__qualname__", repr(coro)),
+                    "age": round(now - created, 3) if created is not None else None,
+                    "stack": [f"{frame_name(frame)} line {frame.f_lineno}" for frame in task.get_stack()],
+                }
+            )
+        return sorted(tasks, key=lambda task: -1 if task["age"] is None else task["age"], reverse=True)
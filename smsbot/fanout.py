@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import random
+import warnings
+from datetime import timedelta
+from time import monotonic
+from typing import Awaitable, Callable, Iterable, NamedTuple
+
+from prometheus_client import Counter
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.warnings import PTBDeprecationWarning
+
+RECIPIENT_COUNT = Counter("fanout_recipient_count", "Total number of messages sent to each recipient", ["outcome"])
+RETRY_COUNT = Counter("fanout_retry_count", "Total number of sends retried", ["reason"])
+
+
+class FanOutResult(NamedTuple):
+    """The outcome of sending a message to a single chat"""
+
+    chat_id: int
+    ok: bool
+    attempts: int
+    error: Exception | None = None
+
+
+class FanOutError(Exception):
+    """Raised when a message could not be delivered to any recipient"""
+
+    def __init__(self, results: list[FanOutResult]):
+        self.results = results
+        super().__init__(f"Delivery failed for all {len(results)} recipients")
+
+    @property
+    def deferred(self) -> bool:
+        """True if no recipient was tried at all, e.g. every chat was skipped as unhealthy"""
+        return all(result.attempts == 0 for result in self.results)
+
+
+class TokenBucket:
+    """An asyncio token bucket allowing `rate` acquisitions per second, with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all acquisitions for at least `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Return the delay requested by Telegram in seconds"""
+    # Both the int and timedelta forms are handled, so the deprecation of the int form doesn't matter here
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", PTBDeprecationWarning)
+        retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class FanOut:
+    """
+    Sends a message to many chats concurrently
+
+    Each send waits on a per-chat token bucket and a global token bucket, so
+    Telegram's flood limits are respected however many recipients there are.
+    `RetryAfter` pauses the global bucket for the requested time, network errors
+    are retried with jittered exponential backoff, and a failing chat never
+    stops delivery to the others.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        max_attempts: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def send_one(self, chat_id: int, send: Callable[[int], Awaitable[object]]) -> FanOutResult:
+        """Send to a single chat, retrying where Telegram allows it"""
+        attempts = 0
+        while True:
+            attempts += 1
+            await self.chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await send(chat_id)
+                return FanOutResult(chat_id, True, attempts)
+            except RetryAfter as exc:
+                delay = retry_after_seconds(exc)
+                self.logger.warning("Flood limit hit sending to chat %s, retrying in %.1fs", chat_id, delay)
+                self.global_bucket.pause(delay)
+                RETRY_COUNT.labels("retry_after").inc()
+                error = exc
+            except BadRequest as exc:
+                # Bad requests will fail the same way every time
+                return FanOutResult(chat_id, False, attempts, exc)
+            except NetworkError as exc:
+                delay = self.backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+                self.logger.warning("Network error sending to chat %s, retrying in %.1fs: %s", chat_id, delay, exc)
+                error = exc
+                if attempts < self.max_attempts:
+                    RETRY_COUNT.labels("network_error").inc()
+                    await asyncio.sleep(delay)
+            except TelegramError as exc:
+                return FanOutResult(chat_id, False, attempts, exc)
+            if attempts >= self.max_attempts:
+                return FanOutResult(chat_id, False, attempts, error)
+
+    async def send(self, chat_ids: Iterable[int], send: Callable[[int], Awaitable[object]]) -> list[FanOutResult]:
+        """Call `send` for every chat concurrently and return the result for each recipient"""
+        results = await asyncio.gather(*(self.send_one(chat_id, send) for chat_id in chat_ids))
+        for result in results:
+            # Failures are counted by error, e.g. Forbidden when the bot was blocked
+            RECIPIENT_COUNT.labels("ok" if result.ok else type(result.error).__name__).inc()
+            if not result.ok:
+                self.logger.error("Failed to send message to chat %s: %s", result.chat_id, result.error)
+        return results
@@ -0,0 +1,102 @@
+import logging
+from time import monotonic
+
+from prometheus_client import Counter, Gauge
+from telegram.error import BadRequest, ChatMigrated, Forbidden
+
+from smsbot.fanout import FanOutResult
+
+CHATS_SUSPENDED = Gauge("telegram_chats_suspended", "Number of chats suspended after a permanent error")
+CHATS_BACKING_OFF = Gauge("telegram_chats_backing_off", "Number of chats skipped after transient errors")
+SKIPPED_COUNT = Counter("telegram_chat_skipped_count", "Total number of sends skipped to unhealthy chats")
+
+
+def is_permanent(error: Exception | None) -> bool:
+    """Return True if an error means the chat can't receive messages until something changes"""
+    if isinstance(error, (Forbidden, ChatMigrated)):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+
+class ChatUnavailable(Exception):
+    """The error reported for a chat that was skipped because it is suspended or backing off"""
+
+
+class ChatState:
+    """The health of a chat that has failed"""
+
+    __slots__ = ("failures", "suspended", "retry_at", "error")
+
+    def __init__(self):
+        self.failures = 0
+        self.suspended = False
+        self.retry_at = 0.0
+        self.error = ""
+
+
+class ChatHealth:
+    """
+    Tracks which chats can receive messages
+
+    A chat that fails with a permanent error, e.g. the bot was blocked or the
+    chat deleted, is suspended and only probed every `probe_interval`
+    seconds. Transient errors back off exponentially from `backoff` seconds
+    up to `max_backoff`. Only one send at a time probes an unhealthy chat, and
+    any successful send makes it healthy again. Errors caused by the message
+    rather than the chat, e.g. bad formatting, are ignored.
+    """
+
+    def __init__(self, backoff: float = 30.0, max_backoff: float = 3600.0, probe_interval: float = 6 * 3600.0):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_interval = probe_interval
+        self.chats: dict[int, ChatState] = {}
+        CHATS_SUSPENDED.set_function(lambda: sum(state.suspended for state in self.chats.values()))
+        CHATS_BACKING_OFF.set_function(lambda: sum(not state.suspended for state in self.chats.values()))
+
+    def is_suspended(self, chat_id: int) -> bool:
+        state = self.chats.get(chat_id)
+        return state is not None and state.suspended
+
+    def available(self, chat_id: int, now: float | None = None) -> bool:
+        """Return True if a message should be sent to the chat, claiming the probe if it's unhealthy"""
+        state = self.chats.get(chat_id)
+        if state is None:
+            return True
+        now = monotonic() if now is None else now
+        if now < state.retry_at:
+            SKIPPED_COUNT.inc()
+            return False
+        # Hold back other sends until this probe's result is recorded
+        state.retry_at = now + self.delay(state)
+        return True
+
+    def delay(self, state: ChatState) -> float:
+        if state.suspended:
+            return self.probe_interval
+        return min(self.backoff * 2 ** (state.failures - 1), self.max_backoff)
+
+    def record(self, result: FanOutResult, now: float | None = None) -> bool:
+        """Update a chat's health from a send, returns True if the chat was just suspended"""
+        if result.ok:
+            if self.chats.pop(result.chat_id, None) is not None:
+                self.logger.info("Chat %s is receiving messages again", result.chat_id)
+            return False
+        if isinstance(result.error, BadRequest) and not is_permanent(result.error):
+            return False
+
+        now = monotonic() if now is None else now
+        state = self.chats.setdefault(result.chat_id, ChatState())
+        state.failures += 1
+        state.error = f"{type(result.error).__name__}: {result.error}"
+        newly_suspended = not state.suspended and is_permanent(result.error)
+        if newly_suspended:
+            state.suspended = True
+            self.logger.warning("Suspending chat %s after %s", result.chat_id, state.error)
+        state.retry_at = now + self.delay(state)
+        return newly_suspended
+
+    def reset(self, chat_id: int) -> None:
+        """Mark a chat healthy, e.g. when its user talks to the bot again"""
+        self.chats.pop(chat_id, None)
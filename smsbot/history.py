@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import NamedTuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from smsbot.utils.twilio import TwilioMessage
+
+HISTORY_STORED = Counter("history_stored_count", "Total number of messages written to the history")
+HISTORY_PENDING = Gauge("history_pending", "Number of messages waiting to be written to the history")
+HISTORY_QUERY_TIME = Histogram(
+    "history_query_seconds",
+    "Time spent answering history queries",
+    ["query"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+# Messages are kept in a plain table, indexed by an external content FTS5 table kept in sync by triggers
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    received REAL NOT NULL,
+    from_number TEXT NOT NULL,
+    to_number TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (received);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    body, from_number, to_number, content='messages', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body, from_number, to_number)
+    VALUES (new.id, new.body, new.from_number, new.to_number);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body, from_number, to_number)
+    VALUES ('delete', old.id, old.body, old.from_number, old.to_number);
+END;
+"""
+
+
+class StoredMessage(NamedTuple):
+    received: float
+    from_number: str
+    to_number: str
+    body: str
+
+
+def search_query(terms: str) -> str:
+    """Turn user input into an FTS5 query matching every term as a prefix, so no input is a syntax error"""
+    return " ".join('"{0}"*'.format(term.replace('"', '""')) for term in terms.split())
+
+
+class MessageHistory:
+    """
+    A searchable history of received messages
+
+    Messages are added to an in-memory batch on the request path, and written
+    by a background task every `flush_interval` seconds or once `batch_size`
+    are waiting, in one transaction on a single database thread. Messages
+    older than `max_age` seconds, or beyond the newest `max_messages`, are
+    removed every `prune_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_messages: int = 100000,
+        max_age: float = 30 * 86400,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        prune_interval: float = 60.0,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self.connection: sqlite3.Connection | None = None
+        self.pending: list[tuple[float, str, str, str]] = []
+        self.next_prune = 0.0
+        self.wakeup: asyncio.Event | None = None
+        self.task: asyncio.Task | None = None
+
+        HISTORY_PENDING.set_function(lambda: len(self.pending))
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _open(self) -> None:
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def _write(self, rows: list[tuple[float, str, str, str]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO messages (received, from_number, to_number, body) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def _prune(self, now: float) -> int:
+        with self.connection:
+            removed = self.connection.execute("DELETE FROM messages WHERE received < ?", (now - self.max_age,)).rowcount
+            removed += self.connection.execute(
+                "DELETE FROM messages WHERE id <= (SELECT MAX(id) FROM messages) - ?", (self.max_messages,)
+            ).rowcount
+        return removed
+
+    def _query(self, sql: str, params: tuple) -> list[StoredMessage]:
+        return [StoredMessage(*row) for row in self.connection.execute(sql, params)]
+
+    async def start(self) -> None:
+        """Open the database and start writing batches"""
+        await self._run(self._open)
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Write any waiting messages and close the database"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.connection:
+            await self.flush()
+            await self._run(self.connection.close)
+            self.connection = None
+
+    def add(self, message: TwilioMessage) -> None:
+        """Queue a message to be written, without waiting for the database"""
+        self.pending.append((time(), message.from_number, message.to_number, message.body))
+        if len(self.pending) >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.logger.exception("Failed to write messages to the history")
+
+    async def flush(self) -> None:
+        """Write the waiting messages in one transaction, and remove expired ones when due"""
+        rows, self.pending = self.pending, []
+        if rows:
+            await self._run(self._write, rows)
+            HISTORY_STORED.inc(len(rows))
+
+        now = time()
+        if now >= self.next_prune:
+            self.next_prune = now + self.prune_interval
+            removed = await self._run(self._prune, now)
+            if removed:
+                self.logger.info("Removed %d messages from the history", removed)
+
+    async def last(self, count: int = 5) -> list[StoredMessage]:
+        """Return the most recent messages, newest first"""
+        with HISTORY_QUERY_TIME.labels("last").time():
+            return await self._run(
+                self._query,
+                "SELECT received, from_number, to_number, body FROM messages ORDER BY id DESC LIMIT ?",
+                (count,),
+            )
+
+    async def search(self, terms: str, count: int = 10) -> list[StoredMessage]:
+        """Return the most recent messages containing words starting with every term, newest first"""
+        query = search_query(terms)
+        if not query:
+            return []
+        with HISTORY_QUERY_TIME.labels("search").time():
+            return await self._run(
+                self._query,
+                "SELECT m.received, m.from_number, m.to_number, m.body FROM messages_fts "
+                "JOIN messages m ON m.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? ORDER BY messages_fts.rowid DESC LIMIT ?",
+                (query, count),
+            )
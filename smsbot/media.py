@@ -0,0 +1,215 @@
+import asyncio
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Iterable
+
+import httpx
+from prometheus_client import Counter
+from telegram import InputFile, InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo, Message
+
+MEDIA_DOWNLOADS = Counter("media_download_count", "Total number of MMS media files downloaded from Twilio")
+MEDIA_CACHE_HITS = Counter("media_cache_hits", "Total number of MMS media files served from the disk cache")
+MEDIA_UPLOADS = Counter("media_upload_count", "Total number of MMS media groups uploaded to Telegram")
+
+# Telegram's limit on files uploaded by bots, and on items in a media group
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+MAX_GROUP_SIZE = 10
+
+INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "audio": InputMediaAudio,
+    "document": InputMediaDocument,
+}
+
+# Telegram only allows photos and videos to be mixed in a media group, audio and documents are grouped on their own
+MEDIA_GROUPS = (("photo", "video"), ("audio",), ("document",))
+
+
+class CachedMedia:
+    """A media file downloaded to the disk cache"""
+
+    def __init__(self, path: Path, content_type: str, url: str):
+        self.path = path
+        self.content_type = content_type
+        self.url = url
+
+    @property
+    def kind(self) -> str:
+        """The Telegram media type used to send this file"""
+        if self.content_type.startswith("image/") and self.content_type != "image/gif":
+            return "photo"
+        if self.content_type.startswith("video/"):
+            return "video"
+        if self.content_type.startswith("audio/"):
+            return "audio"
+        return "document"
+
+
+def attachment_file_id(message: Message) -> str:
+    """Return the file ID of the media attached to a sent message"""
+    attachment = message.effective_attachment
+    if isinstance(attachment, tuple):
+        # Photos are returned as a tuple of sizes, the last is the largest
+        attachment = attachment[-1]
+    return attachment.file_id
+
+
+def group_input(media: Path | str) -> InputFile | str:
+    """Return a cached file or file ID for a media group, PTB would send a path in a group as a file:// URI"""
+    if isinstance(media, Path):
+        with media.open("rb") as file:
+            return InputFile(file, filename=media.name, attach=True)
+    return media
+
+
+class MediaRelay:
+    """
+    Relays MMS media from Twilio to Telegram
+
+    All media for a message is downloaded concurrently over one pooled HTTP
+    client, and streamed to a bounded on-disk cache rather than held in
+    memory. The files are uploaded to Telegram once, then every other
+    subscriber is sent the `file_id` Telegram returned, so nothing is uploaded
+    twice.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        cache_size: int = 256 * 1024 * 1024,
+        concurrency: int = 4,
+        auth: tuple[str, str] | None = None,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_size = cache_size
+        self.concurrency = concurrency
+        self.auth = auth
+        self._client: httpx.AsyncClient | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The HTTP client, created on first use so its connection pool belongs to the running loop"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(auth=self.auth, follow_redirects=True, timeout=30.0)
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def cache_path(self, url: str) -> Path:
+        return self.cache_dir / hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    async def download(self, url: str) -> CachedMedia | None:
+        """Stream a media file into the cache, returning None if it can't be relayed"""
+        path = self.cache_path(url)
+        type_path = path.with_suffix(".type")
+        if path.exists() and type_path.exists():
+            MEDIA_CACHE_HITS.inc()
+            os.utime(path)
+            return CachedMedia(path, type_path.read_text(), url)
+
+        partial = path.with_suffix(".partial")
+        async with self.semaphore:
+            try:
+                async with self.client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    content_type = response.headers.get("content-type", "application/octet-stream").split(";")[0]
+                    size = 0
+                    with partial.open("wb") as output:
+                        async for chunk in response.aiter_bytes():
+                            size += len(chunk)
+                            if size > MAX_UPLOAD_SIZE:
+                                raise ValueError("media is larger than Telegram's upload limit")
+                            output.write(chunk)
+            except (httpx.HTTPError, ValueError) as exc:
+                self.logger.warning("Unable to download media %s: %s", url, exc)
+                partial.unlink(missing_ok=True)
+                return None
+
+        type_path.write_text(content_type)
+        partial.rename(path)
+        MEDIA_DOWNLOADS.inc()
+        self.evict()
+        return CachedMedia(path, content_type, url)
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the cache is within its size limit"""
+        files = [(path, path.stat()) for path in self.cache_dir.iterdir() if not path.suffix]
+        total = sum(stat.st_size for _, stat in files)
+        for path, stat in sorted(files, key=lambda item: item[1].st_mtime):
+            if total <= self.cache_size:
+                break
+            path.unlink(missing_ok=True)
+            path.with_suffix(".type").unlink(missing_ok=True)
+            total -= stat.st_size
+
+    async def send_group(self, bot, chat_id: int, kinds: list[str], media: list) -> tuple[Message, ...]:
+        """Send files or file IDs of the given kinds, as a media group if there is more than one"""
+        if len(media) == 1:
+            message = await getattr(bot, f"send_{kinds[0]}")(chat_id, media[0])
+            return (message,)
+        return await bot.send_media_group(
+            chat_id, [INPUT_MEDIA[kind](group_input(item)) for kind, item in zip(kinds, media)]
+        )
+
+    async def download_all(self, urls: list[str]) -> list[CachedMedia | None]:
+        """Download media concurrently, returning None in place of any that can't be relayed"""
+        return await asyncio.gather(*(self.download(url) for url in urls))
+
+    async def relay(self, urls: list[str], telegram_app, chat_ids: Iterable[int] | None = None) -> list[CachedMedia]:
+        """Send the media at the given URLs to the given chats, or every subscriber, returning any not sent"""
+        files = [media for media in await self.download_all(urls) if media]
+        return await self.send(files, telegram_app, chat_ids)
+
+    async def send(
+        self, files: list[CachedMedia], telegram_app, chat_ids: Iterable[int] | None = None
+    ) -> list[CachedMedia]:
+        """Send downloaded media to the given chats, or every subscriber, returning any no chat would accept"""
+        recipients = telegram_app.available(telegram_app.subscribers if chat_ids is None else chat_ids)
+        if not files or not recipients:
+            return []
+
+        groups: list[list[CachedMedia]] = []
+        for kinds in MEDIA_GROUPS:
+            of_kinds = [media for media in files if media.kind in kinds]
+            for i in range(0, len(of_kinds), MAX_GROUP_SIZE):
+                groups.append(of_kinds[i : i + MAX_GROUP_SIZE])
+
+        bot = telegram_app.app.bot
+        unsent = []
+        for group in groups:
+            kinds = [media.kind for media in group]
+            # Upload to the first recipient that accepts it, then reuse the file IDs for everyone else
+            file_ids = None
+            remaining = list(recipients)
+            while remaining and file_ids is None:
+                chat_id = remaining.pop(0)
+                try:
+                    messages = await self.send_group(bot, chat_id, kinds, [media.path for media in group])
+                except Exception as exc:
+                    self.logger.warning("Failed to upload media to chat %s: %s", chat_id, exc)
+                    continue
+                file_ids = [attachment_file_id(message) for message in messages]
+                MEDIA_UPLOADS.inc()
+
+            if file_ids is None:
+                unsent.extend(group)
+            elif remaining:
+                await telegram_app.fanout.send(
+                    remaining, lambda chat_id: self.send_group(bot, chat_id, kinds, file_ids)
+                )
+        return unsent
@@ -0,0 +1,101 @@
+import re
+from typing import Iterable
+
+from prometheus_client import Counter
+
+from smsbot.utils.twilio import TwilioCall, TwilioMessage
+
+ROUTE_COUNT = Counter("routing_match_count", "Total number of webhooks routed by each kind of rule", ["rule"])
+
+# Body keywords are matched against whole words, ignoring case
+WORD = re.compile(r"\w+")
+
+
+def parse_rules(value: str) -> dict[str, set[int]]:
+    """Parse rules written as `key: chat_id chat_id, key: chat_id`"""
+    rules: dict[str, set[int]] = {}
+    for rule in value.split(","):
+        if not rule.strip():
+            continue
+        key, sep, chats = rule.rpartition(":")
+        if not sep or not key.strip():
+            raise ValueError(f"Invalid routing rule {rule.strip()!r}, expected 'key: chat_id [chat_id ...]'")
+        rules.setdefault(key.strip(), set()).update(int(chat_id) for chat_id in chats.split())
+    return rules
+
+
+class PrefixTrie:
+    """Maps prefixes to chats, matching every prefix of a string in one pass over it"""
+
+    def __init__(self, rules: dict[str, Iterable[int]] | None = None):
+        self.root: dict = {}
+        for prefix, chats in (rules or {}).items():
+            self.insert(prefix, chats)
+
+    def insert(self, prefix: str, chats: Iterable[int]) -> None:
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # None can't be a character, so it holds the chats for the prefix ending at this node
+        node.setdefault(None, set()).update(chats)
+
+    def match(self, text: str) -> set[int]:
+        """Return the chats for every prefix of the text"""
+        matched = set(self.root.get(None, ()))
+        node = self.root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            matched.update(node.get(None, ()))
+        return matched
+
+
+class Router:
+    """
+    Picks the chats a message or call is sent to
+
+    Rules map the number that received it (`to`), a prefix of the number that
+    sent it (`from`), or a word in a message body (`keywords`) to a set of
+    chats. They are compiled into a dict, a prefix trie and a keyword dict, so
+    routing takes time in proportion to the length of the numbers and body
+    rather than the number of rules. A payload is sent to every chat any rule
+    matches. If none do it goes to all subscribers, or nowhere if `fallback`
+    is off.
+    """
+
+    def __init__(
+        self,
+        to: dict[str, Iterable[int]] | None = None,
+        from_prefixes: dict[str, Iterable[int]] | None = None,
+        keywords: dict[str, Iterable[int]] | None = None,
+        fallback: bool = True,
+    ):
+        self.to = {number: set(chats) for number, chats in (to or {}).items()}
+        self.from_prefixes = PrefixTrie(from_prefixes)
+        self.keywords = {keyword.lower(): set(chats) for keyword, chats in (keywords or {}).items()}
+        self.fallback = fallback
+
+    def route(self, payload: TwilioCall | TwilioMessage) -> set[int] | None:
+        """Return the chats to send a payload to, or None to send it to all subscribers"""
+        chats = set()
+        if payload.to_number in self.to:
+            chats.update(self.to[payload.to_number])
+            ROUTE_COUNT.labels("to").inc()
+
+        from_chats = self.from_prefixes.match(payload.from_number)
+        if from_chats:
+            chats.update(from_chats)
+            ROUTE_COUNT.labels("from").inc()
+
+        if self.keywords and isinstance(payload, TwilioMessage):
+            words = set(WORD.findall(payload.body.lower()))
+            keyword_chats = [self.keywords[word] for word in words & self.keywords.keys()]
+            if keyword_chats:
+                chats.update(*keyword_chats)
+                ROUTE_COUNT.labels("keyword").inc()
+
+        if chats:
+            return chats
+        ROUTE_COUNT.labels("fallback" if self.fallback else "none").inc()
+        return None if self.fallback else set()
@@ -0,0 +1,159 @@
+import asyncio
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import TYPE_CHECKING
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from smsbot.utils.twilio import TwilioMessageStatus
+
+if TYPE_CHECKING:
+    # twilio.rest and its aiohttp client take longer to import than the rest of smsbot, so they are only
+    # imported once an SMS is sent
+    from twilio.rest import Client
+
+SEND_TIME = Histogram("twilio_send_seconds", "Time spent sending each SMS through Twilio")
+SENDS_IN_PROGRESS = Gauge("twilio_send_in_progress", "Number of SMS being sent through Twilio")
+SEND_COUNT = Counter("twilio_send_count", "Total number of SMS sent through Twilio", ["outcome"])
+PENDING_SENDS = Gauge("twilio_pending_sends", "Number of sent SMS waiting for a final status callback")
+STATUS_COUNT = Counter("twilio_status_count", "Total number of status callbacks for sent SMS", ["status"])
+
+
+def is_async(client: "Client") -> bool:
+    """Return True if the client sends requests with an async HTTP client, without importing it"""
+    return inspect.iscoroutinefunction(getattr(client.http_client, "request", None))
+
+
+class PendingSend:
+    """An SMS sent from a chat, waiting for its final status"""
+
+    __slots__ = ("chat_id", "to_number", "status", "sent")
+
+    def __init__(self, chat_id: int, to_number: str, status: str = "queued"):
+        self.chat_id = chat_id
+        self.to_number = to_number
+        self.status = status
+        self.sent = time()
+
+
+class OutboundSms:
+    """
+    Sends SMS messages through Twilio without blocking the event loop
+
+    By default the Twilio client is built on first use with Twilio's aiohttp
+    based async HTTP client, so every send shares one connection pool on the
+    running loop. A synchronous client can be passed in instead, in which case
+    sends run on a bounded thread pool. Either way no more than `concurrency`
+    messages are in flight at once.
+
+    If a `status_callback` URL is given, Twilio posts each SMS's status to it
+    and the chat it was sent from is remembered by message SID until its
+    final status arrives, up to `max_pending` sends.
+    """
+
+    def __init__(
+        self,
+        account_sid: str | None = None,
+        auth_token: str | None = None,
+        from_number: str | None = None,
+        concurrency: int = 4,
+        client: "Client | None" = None,
+        status_callback: str | None = None,
+        max_pending: int = 10000,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.from_number = from_number
+        self.concurrency = concurrency
+        self._client = client
+        self.status_callback = status_callback
+        self.max_pending = max_pending
+        self.pending: dict[str, PendingSend] = {}
+        PENDING_SENDS.set_function(lambda: len(self.pending))
+        self._semaphore: asyncio.Semaphore | None = None
+        self._executor: ThreadPoolExecutor | None = None
+
+    @property
+    def client(self) -> "Client":
+        """The Twilio client, created on first use so the HTTP session belongs to the running loop"""
+        if self._client is None:
+            from twilio.http.async_http_client import AsyncTwilioHttpClient
+            from twilio.rest import Client
+
+            self._client = Client(self.account_sid, self.auth_token, http_client=AsyncTwilioHttpClient())
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def send(self, to: str, body: str, chat_id: int | None = None) -> str:
+        """Send a single SMS and return its message SID, tracking its status for the chat if given"""
+        async with self.semaphore:
+            self.logger.info("Sending SMS to %s", to)
+            client = self.client
+            try:
+                with SENDS_IN_PROGRESS.track_inprogress(), SEND_TIME.time():
+                    kwargs = {"body": body, "to": to, "from_": self.from_number}
+                    if self.status_callback:
+                        kwargs["status_callback"] = self.status_callback
+                    if is_async(client):
+                        message = await client.messages.create_async(**kwargs)
+                    else:
+                        if self._executor is None:
+                            self._executor = ThreadPoolExecutor(
+                                max_workers=self.concurrency, thread_name_prefix="twilio"
+                            )
+                        message = await asyncio.get_running_loop().run_in_executor(
+                            self._executor, lambda: client.messages.create(**kwargs)
+                        )
+            except Exception:
+                SEND_COUNT.labels("failed").inc()
+                raise
+            SEND_COUNT.labels("sent").inc()
+            if self.status_callback and chat_id is not None:
+                self.track(message.sid, PendingSend(chat_id, to))
+            return message.sid
+
+    def track(self, sid: str, pending: PendingSend) -> None:
+        """Remember a send until its final status, dropping the oldest if there are too many"""
+        self.pending[sid] = pending
+        if len(self.pending) > self.max_pending:
+            del self.pending[next(iter(self.pending))]
+
+    def update_status(self, status: TwilioMessageStatus) -> PendingSend | None:
+        """Record a status callback, returning the send it belongs to if we are tracking it"""
+        STATUS_COUNT.labels(status.status).inc()
+        pending = self.pending.get(status.sid)
+        if pending is not None:
+            pending.status = status.status
+            # Failed sends are kept until the chat has been told, see forget
+            if status.final and not status.failed:
+                del self.pending[status.sid]
+        return pending
+
+    def forget(self, sid: str) -> None:
+        """Stop tracking a send"""
+        self.pending.pop(sid, None)
+
+    async def send_many(
+        self, recipients: list[str], body: str, chat_id: int | None = None
+    ) -> dict[str, str | Exception]:
+        """Send the same SMS to several recipients concurrently, returning the SID or error for each"""
+        results = await asyncio.gather(*(self.send(to, body, chat_id) for to in recipients), return_exceptions=True)
+        for to, result in zip(recipients, results):
+            if isinstance(result, Exception):
+                self.logger.error("Failed to send SMS to %s: %s", to, result)
+        return dict(zip(recipients, results))
+
+    async def close(self) -> None:
+        """Close the Twilio HTTP session and thread pool"""
+        if self._client is not None and is_async(self._client):
+            await self._client.http_client.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
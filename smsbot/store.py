@@ -0,0 +1,146 @@
+import logging
+import sqlite3
+from time import monotonic
+from typing import Iterable
+
+
+class SubscriberStore:
+    """
+    Keeps track of the owners and subscribers of the bot
+
+    Membership is held in sets so authorization checks on every update are
+    O(1). This store is memory only, subscriptions are lost on restart.
+    """
+
+    def __init__(self, owners: Iterable[int] = (), subscribers: Iterable[int] = ()):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.owners: set[int] = set(owners)
+        self._seed = set(subscribers)
+        self._subscribers: set[int] | None = None
+
+    @property
+    def subscribers(self) -> set[int]:
+        """The current subscribers, loaded on first use"""
+        if self._subscribers is None:
+            self._subscribers = self.load()
+        return self._subscribers
+
+    def load(self) -> set[int]:
+        """Return the initial set of subscribers"""
+        return set(self._seed)
+
+    def is_owner(self, chat_id: int) -> bool:
+        return chat_id in self.owners
+
+    def is_subscriber(self, chat_id: int) -> bool:
+        return chat_id in self.subscribers
+
+    def add_owner(self, chat_id: int) -> None:
+        self.owners.add(chat_id)
+
+    def add_subscriber(self, chat_id: int) -> bool:
+        """Add a subscriber, returns False if they were already subscribed"""
+        if chat_id in self.subscribers:
+            return False
+        self.subscribers.add(chat_id)
+        return True
+
+    def remove_subscriber(self, chat_id: int) -> bool:
+        """Remove a subscriber, returns False if they were not subscribed"""
+        if chat_id not in self.subscribers:
+            return False
+        self.subscribers.discard(chat_id)
+        return True
+
+
+class SqliteSubscriberStore(SubscriberStore):
+    """
+    A subscriber store that writes through to a SQLite database
+
+    Subscribers are read into memory once, then every change is written to
+    the database so `/subscribe` and `/unsubscribe` survive restarts. Owners
+    always come from the configuration and are not persisted. Subscribers
+    from the configuration are added on start, unless they have unsubscribed
+    since.
+
+    When `shared` the database is shared with other replicas, a version
+    number is bumped with every change and checked at most once every
+    `REFRESH_INTERVAL` seconds, so changes made by other replicas are picked
+    up without a query on every read or reading every subscriber.
+    """
+
+    # Seconds between checking a shared database for changes made by other replicas
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(
+        self, path: str, owners: Iterable[int] = (), subscribers: Iterable[int] = (), shared: bool = False
+    ):
+        super().__init__(owners, subscribers)
+        self.path = path
+        self.shared = shared
+        self.version: int | None = None
+        self.next_refresh = 0.0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY)")
+        # Chats that unsubscribed, so they aren't added back from the config on the next start
+        self.connection.execute("CREATE TABLE IF NOT EXISTS unsubscribed (chat_id INTEGER PRIMARY KEY)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscribers_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER)"
+        )
+        self.connection.execute("INSERT OR IGNORE INTO subscribers_version (id, version) VALUES (0, 0)")
+        self.connection.commit()
+
+    @property
+    def subscribers(self) -> set[int]:
+        if self.shared and self._subscribers is not None:
+            now = monotonic()
+            if now >= self.next_refresh:
+                self.next_refresh = now + self.REFRESH_INTERVAL
+                if self.current_version() != self.version:
+                    self._subscribers = None
+        return super().subscribers
+
+    def current_version(self) -> int:
+        return self.connection.execute("SELECT version FROM subscribers_version").fetchone()[0]
+
+    def changed(self) -> None:
+        """Bump the version and commit, so other replicas reload the subscribers"""
+        self.connection.execute("UPDATE subscribers_version SET version = version + 1")
+        # Read the version before committing, while no other replica can change it
+        self.version = self.current_version()
+        self.connection.commit()
+
+    def load(self) -> set[int]:
+        # Subscribers from the config are added on start, not every time changes are reloaded
+        if self.version is None:
+            cursor = self.connection.executemany(
+                "INSERT OR IGNORE INTO subscribers (chat_id) "
+                "SELECT ? WHERE NOT EXISTS (SELECT 1 FROM unsubscribed WHERE chat_id = ?)",
+                [(chat_id, chat_id) for chat_id in self._seed],
+            )
+            if cursor.rowcount > 0:
+                self.connection.execute("UPDATE subscribers_version SET version = version + 1")
+        # Read the version before committing, while no other replica can change it
+        self.version = self.current_version()
+        self.next_refresh = monotonic() + self.REFRESH_INTERVAL
+        self.connection.commit()
+        subscribers = {row[0] for row in self.connection.execute("SELECT chat_id FROM subscribers")}
+        self.logger.info("Loaded %d subscribers from %s", len(subscribers), self.path)
+        return subscribers
+
+    def add_subscriber(self, chat_id: int) -> bool:
+        if not super().add_subscriber(chat_id):
+            return False
+        self.connection.execute("INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)", (chat_id,))
+        self.connection.execute("DELETE FROM unsubscribed WHERE chat_id = ?", (chat_id,))
+        self.changed()
+        return True
+
+    def remove_subscriber(self, chat_id: int) -> bool:
+        if not super().remove_subscriber(chat_id):
+            return False
+        self.connection.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+        self.connection.execute("INSERT OR IGNORE INTO unsubscribed (chat_id) VALUES (?)", (chat_id,))
+        self.changed()
+        return True
@@ -1,6 +1,9 @@
 import logging
+from datetime import datetime
+from functools import wraps
+from typing import Iterable
 
-from prometheus_client import Counter, Summary
+from prometheus_client import Counter, Gauge, Histogram
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -9,67 +12,155 @@ from telegram.ext import (
     ContextTypes,
     TypeHandler,
 )
-from twilio.rest import Client
 
+from smsbot.fanout import FanOut, FanOutResult
+from smsbot.health import ChatHealth, ChatUnavailable
+from smsbot.history import MessageHistory, StoredMessage
+from smsbot.sms import OutboundSms
+from smsbot.store import SubscriberStore
 from smsbot.utils import get_smsbot_version
+from smsbot.utils.log import Body
+from smsbot.utils.render import escape_markdownv2
+from smsbot.utils.twilio import TwilioMessageStatus
 
-REQUEST_TIME = Summary("telegram_request_processing_seconds", "Time spent processing request")
+REQUEST_TIME = Histogram("telegram_request_processing_seconds", "Time spent processing request", ["command"])
+REQUESTS_IN_PROGRESS = Gauge("telegram_requests_in_progress", "Number of commands being processed", ["command"])
+SEND_TIME = Histogram("telegram_send_message_seconds", "Time spent sending each message to Telegram")
+SENDS_IN_PROGRESS = Gauge("telegram_send_message_in_progress", "Number of messages being sent to Telegram")
 COMMAND_COUNT = Counter("telegram_command_count", "Total number of commands processed")
 
+# Keep history replies within Telegram's 4096 character message limit
+MAX_HISTORY_RESULTS = 10
+MAX_HISTORY_BODY = 300
+
+
+def timed(command: str):
+    """Time a command handler and track it in flight, including the time spent awaiting"""
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with REQUESTS_IN_PROGRESS.labels(command).track_inprogress(), REQUEST_TIME.labels(command).time():
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
 
 class TelegramSmsBot:
     def __init__(
         self,
         token: str,
-        twilio_client: Client | None = None,
-        twilio_from_number: str | None = None,
-        owners: list[int] = [],
-        subscribers: list[int] = [],
+        outbound_sms: OutboundSms | None = None,
+        owners: list[int] | None = None,
+        subscribers: list[int] | None = None,
+        fanout: FanOut | None = None,
+        store: SubscriberStore | None = None,
+        base_url: str | None = None,
+        history: MessageHistory | None = None,
+        health: ChatHealth | None = None,
     ):
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.app = Application.builder().token(token).build()
-        self.owners = owners
-        self.subscribers = subscribers
-        self.twilio_client = twilio_client
-        self.twilio_from_number = twilio_from_number
+        builder = Application.builder().token(token)
+        # Use a local Bot API server rather than api.telegram.org
+        if base_url:
+            builder = builder.base_url(base_url)
+        self.app = builder.build()
+        self.store = store or SubscriberStore(owners or (), subscribers or ())
+        self.outbound_sms = outbound_sms
+        self.fanout = fanout or FanOut()
+        self.history = history
+        self.health = health or ChatHealth()
 
         self.init_handlers()
 
+    @property
+    def owners(self) -> set[int]:
+        return self.store.owners
+
+    @property
+    def subscribers(self) -> set[int]:
+        return self.store.subscribers
+
     def init_handlers(self):
         self.app.add_handler(TypeHandler(Update, self.callback), -1)
         self.app.add_handler(CommandHandler(["help", "start"], self.handler_help))
         self.app.add_handler(CommandHandler("subscribe", self.handler_subscribe))
         self.app.add_handler(CommandHandler("unsubscribe", self.handler_unsubscribe))
         self.app.add_handler(CommandHandler("sms", self.handler_sms))
+        self.app.add_handler(CommandHandler("last", self.handler_last))
+        self.app.add_handler(CommandHandler("search", self.handler_search))
 
     async def callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle the update"""
         if update.effective_user and update.message:
-            if update.effective_user.id in self.owners:
-                self.logger.info(f"{update.effective_user.username} sent {update.message.text}")
+            if self.store.is_owner(update.effective_user.id):
+                self.logger.info("%s sent %s", update.effective_user.username, Body(update.message.text))
                 COMMAND_COUNT.inc()
             else:
-                self.logger.debug(f"Ignoring message from user {update.effective_user.username}")
+                self.logger.debug("Ignoring message from user %s", update.effective_user.username)
                 raise ApplicationHandlerStop
 
     async def send_message(self, chat_id: int, text: str):
         """Send a message to a specific chat"""
-        self.logger.info(f"Sending message to chat {chat_id}: {text}")
-        await self.app.bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
+        self.logger.debug("Sending message to chat %s: %s", chat_id, Body(text))
+        with SENDS_IN_PROGRESS.track_inprogress(), SEND_TIME.time():
+            await self.app.bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
+
+    def available(self, chat_ids: Iterable[int]) -> list[int]:
+        """Return the chats that messages should be sent to, skipping unhealthy ones until they are probed"""
+        return [chat_id for chat_id in chat_ids if self.health.available(chat_id)]
+
+    async def send_many(self, chat_ids: Iterable[int], text: str) -> list[FanOutResult]:
+        """Send a message to several healthy chats concurrently, returning the result for each chat"""
+        chat_ids = list(chat_ids)
+        available = self.available(chat_ids)
+        results = await self.fanout.send(available, lambda chat_id: self.send_message(chat_id, text))
+        suspended = [result for result in results if self.health.record(result)]
+        if suspended:
+            await self.notify_suspended(suspended)
+        # Skipped chats are reported without any attempts, so callers can tell nobody was sent the message
+        skipped = set(chat_ids).difference(available)
+        return results + [FanOutResult(chat_id, False, 0, ChatUnavailable(chat_id)) for chat_id in skipped]
 
-    async def send_subscribers(self, text: str):
+    async def notify_suspended(self, results: list[FanOutResult]) -> None:
+        """Tell the owners which chats were suspended"""
+        lines = [f"Suspended chat {result.chat_id}, {result.error}" for result in results]
+        lines.append("Messages won't be sent to it until it can receive them again.")
+        try:
+            await self.send_owners(escape_markdownv2("\n".join(lines)))
+        except Exception:
+            self.logger.exception("Failed to tell the owners about suspended chats")
+
+    async def send_subscribers(self, text: str) -> list[FanOutResult]:
         """Send a message to all subscribers"""
-        for subscriber in self.subscribers:
-            self.logger.info(f"Sending message to subscriber {subscriber}")
-            await self.send_message(subscriber, text)
+        self.logger.info("Sending message to %d subscribers", len(self.subscribers))
+        return await self.send_many(self.subscribers, text)
 
-    async def send_owners(self, text: str):
+    async def send_owners(self, text: str) -> list[FanOutResult]:
         """Send a message to all owners"""
-        for owner in self.owners:
-            self.logger.info(f"Sending message to owner {owner}")
-            await self.send_message(owner, text)
+        self.logger.info("Sending message to %d owners", len(self.owners))
+        return await self.send_many(self.owners, text)
+
+    async def sms_status(self, status: TwilioMessageStatus) -> None:
+        """Update the status of an SMS sent with /sms, telling the chat it was sent from if it failed"""
+        if not self.outbound_sms:
+            return
+        pending = self.outbound_sms.update_status(status)
+        if pending is None or not status.failed:
+            return
+        self.logger.warning(
+            "SMS %s to %s %s, error %s", status.sid, pending.to_number, status.status, status.error_code
+        )
+        text = f"SMS to {pending.to_number} {status.status}"
+        if status.error_code:
+            text += f", Twilio error {status.error_code}"
+        # If this fails the send is still pending, so Twilio's retry of the callback tells the chat
+        await self.send_message(pending.chat_id, escape_markdownv2(text))
+        self.outbound_sms.forget(status.sid)
 
-    @REQUEST_TIME.time()
+    @timed("help")
     async def handler_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a message when the command /help is issued."""
         if update.message:
@@ -83,47 +174,106 @@ class TelegramSmsBot:
             await update.message.reply_markdown("Smsbot v{0}\n\n{1}".format(get_smsbot_version(), "\n".join(commands)))
             COMMAND_COUNT.inc()
 
-    @REQUEST_TIME.time()
+    @timed("subscribe")
     async def handler_subscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle subscription requests"""
         if update.effective_user and update.message:
             user_id = update.effective_user.id
-            if user_id not in self.subscribers:
-                self.subscribers.append(user_id)
-                self.logger.info(f"User {user_id} subscribed.")
-                self.logger.info(f"Current subscribers: {self.subscribers}")
+            # The user is talking to the bot, so it can message them again
+            self.health.reset(user_id)
+            if self.store.add_subscriber(user_id):
+                self.logger.info("User %s subscribed.", user_id)
+                self.logger.info("Current subscribers: %d", len(self.subscribers))
                 await update.message.reply_markdown("You have successfully subscribed to updates.")
             else:
-                self.logger.info(f"User {user_id} is already subscribed.")
+                self.logger.info("User %s is already subscribed.", user_id)
 
-    @REQUEST_TIME.time()
+    @timed("unsubscribe")
     async def handler_unsubscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle unsubscription requests"""
         if update.effective_user and update.message:
             user_id = update.effective_user.id
-            if user_id in self.subscribers:
-                self.subscribers.remove(user_id)
-                self.logger.info(f"User {user_id} unsubscribed.")
-                self.logger.info(f"Current subscribers: {self.subscribers}")
+            if self.store.remove_subscriber(user_id):
+                self.logger.info("User %s unsubscribed.", user_id)
+                self.logger.info("Current subscribers: %d", len(self.subscribers))
                 await update.message.reply_markdown("You have successfully unsubscribed from updates.")
             else:
-                self.logger.info(f"User {user_id} is not subscribed.")
+                self.logger.info("User %s is not subscribed.", user_id)
 
-    @REQUEST_TIME.time()
+    @timed("sms")
     async def handler_sms(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle sending SMS requests"""
+        """Handle sending SMS requests, e.g. /sms +441234567890,+441234567891 Message text"""
         if update.effective_user and update.message:
             user_id = update.effective_user.id
-            if self.twilio_client and self.twilio_from_number:
-                to = context.args[0] if context.args else "No recipient provided"
-                message = context.args[1] if context.args else "No message provided"
-                self.logger.info(f"Sending SMS from user {user_id} -> {to}: {message}")
-
-                try:
-                    self.twilio_client.messages.create(body=message, to=to, from_=self.twilio_from_number)
-                except Exception:
-                    self.logger.exception("Failed to send SMS due to exception")
-                    await update.message.reply_markdown("Failed to send SMS")
-                    pass
-            else:
+            if not self.outbound_sms:
                 await update.message.reply_markdown("Twilio client is not configured, cannot send SMS.")
+                return
+
+            # Use the full message text so whitespace and new lines in the message are kept
+            parts = (update.message.text or "").split(maxsplit=2)
+            recipients = []
+            if len(parts) == 3:
+                recipients = [number.strip() for number in parts[1].split(",") if number.strip()]
+            # Also covers a list of nothing but commas, e.g. /sms , hello
+            if not recipients:
+                await update.message.reply_text("Usage: /sms <number>[,<number>...] <message>")
+                return
+            message = parts[2]
+            self.logger.info("Sending SMS from user %s to %d recipients", user_id, len(recipients))
+
+            results = await self.outbound_sms.send_many(recipients, message, update.effective_chat.id)
+            sent = [to for to, result in results.items() if not isinstance(result, Exception)]
+            failed = [to for to, result in results.items() if isinstance(result, Exception)]
+            lines = []
+            if sent:
+                lines.append(f"Sent SMS to {', '.join(sent)}")
+            if failed:
+                lines.append(f"Failed to send SMS to {', '.join(failed)}")
+            await update.message.reply_text("\n".join(lines))
+
+    @staticmethod
+    def format_history(messages: list[StoredMessage]) -> str:
+        """Format stored messages as plain text, one paragraph each"""
+        paragraphs = []
+        for message in messages:
+            body = message.body
+            if len(body) > MAX_HISTORY_BODY:
+                body = body[:MAX_HISTORY_BODY] + "..."
+            received = datetime.fromtimestamp(message.received).strftime("%Y-%m-%d %H:%M")
+            paragraphs.append(f"{received} from {message.from_number} to {message.to_number}\n{body}")
+        return "\n\n".join(paragraphs)
+
+    @timed("last")
+    async def handler_last(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Reply with the most recent messages, e.g. /last 5"""
+        if update.effective_user and update.message:
+            if not self.history:
+                await update.message.reply_text("Message history is not configured.")
+                return
+
+            args = (update.message.text or "").split()[1:]
+            if len(args) > 1 or (args and not args[0].isdigit()):
+                await update.message.reply_text("Usage: /last [count]")
+                return
+            count = min(int(args[0]) if args else 5, MAX_HISTORY_RESULTS)
+
+            messages = await self.history.last(count)
+            await update.message.reply_text(self.format_history(messages) or "No messages received yet.")
+            COMMAND_COUNT.inc()
+
+    @timed("search")
+    async def handler_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Reply with the most recent messages containing all the terms, e.g. /search code 1234"""
+        if update.effective_user and update.message:
+            if not self.history:
+                await update.message.reply_text("Message history is not configured.")
+                return
+
+            terms = " ".join((update.message.text or "").split()[1:])
+            if not terms:
+                await update.message.reply_text("Usage: /search <terms>")
+                return
+
+            messages = await self.history.search(terms, MAX_HISTORY_RESULTS)
+            await update.message.reply_text(self.format_history(messages) or "No messages found.")
+            COMMAND_COUNT.inc()
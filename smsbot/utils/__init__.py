@@ -1,5 +1,8 @@
+from functools import cache
 from importlib.metadata import version
 
 
+@cache
 def get_smsbot_version() -> str:
+    # Reading the package metadata searches sys.path, so only do it once
     return version("smsbot")
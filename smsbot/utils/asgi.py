@@ -0,0 +1,106 @@
+import json
+from urllib.parse import parse_qsl
+
+
+class RequestTooLarge(Exception):
+    """Raised when a request body is larger than allowed"""
+
+
+class Request:
+    """A minimal HTTP request built from an ASGI scope and body"""
+
+    def __init__(self, scope: dict, body: bytes = b"") -> None:
+        self.scope = scope
+        self.method: str = scope.get("method", "GET")
+        self.path: str = scope.get("path", "/")
+        self.query_string: str = scope.get("query_string", b"").decode("latin-1")
+        self.headers: dict[str, str] = {
+            name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])
+        }
+        self.body = body
+
+    @property
+    def url(self) -> str:
+        """Reconstruct the full URL the client requested"""
+        scheme = self.scope.get("scheme", "http")
+        host = self.headers.get("host")
+        if not host and self.scope.get("server"):
+            host, port = self.scope["server"]
+            host = f"{host}:{port}"
+        url = f"{scheme}://{host}{self.scope.get('root_path', '')}{self.path}"
+        if self.query_string:
+            url += f"?{self.query_string}"
+        return url
+
+    @property
+    def args(self) -> dict[str, str]:
+        """Query string arguments"""
+        return dict(parse_qsl(self.query_string, keep_blank_values=True))
+
+    @property
+    def form(self) -> dict[str, str]:
+        """URL encoded form values from the request body"""
+        if self.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            return dict(parse_qsl(self.body.decode("utf-8"), keep_blank_values=True))
+        return {}
+
+    @property
+    def values(self) -> dict[str, str]:
+        """Combined query string and form values, form values take precedence"""
+        return {**self.args, **self.form}
+
+    @classmethod
+    async def from_receive(cls, scope: dict, receive, max_size: int | None = None) -> "Request":
+        """Read the full request body from the ASGI receive channel, raising RequestTooLarge past `max_size`"""
+        if max_size is not None:
+            for name, value in scope.get("headers", []):
+                if name.lower() == b"content-length" and value.isdigit() and int(value) > max_size:
+                    raise RequestTooLarge()
+
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise RequestTooLarge()
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                break
+        return cls(scope, b"".join(chunks))
+
+
+class Response:
+    """A minimal HTTP response that can be sent over ASGI"""
+
+    def __init__(
+        self,
+        body: str | bytes = b"",
+        status: int = 200,
+        content_type: str = "text/html; charset=utf-8",
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.status = status
+        self.headers = {"content-type": content_type, **(headers or {})}
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in self.headers.items()]
+        headers.append((b"content-length", str(len(self.body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class JSONResponse(Response):
+    """A response with a JSON encoded body"""
+
+    def __init__(self, data, status: int = 200, headers: dict[str, str] | None = None) -> None:
+        super().__init__(json.dumps(data), status=status, content_type="application/json", headers=headers)
+
+
+def abort(status: int) -> Response:
+    """Return an empty response with the given status code"""
+    return Response(b"", status=status, content_type="text/plain")
@@ -0,0 +1,109 @@
+import json
+import logging
+import queue
+import re
+from logging.handlers import QueueHandler, QueueListener
+from typing import TextIO
+
+# E.164 numbers, as Twilio sends them
+PHONE_NUMBER = re.compile(r"\+\d{5,15}")
+
+
+class Body:
+    """
+    Marks a message body passed as a log argument, so it can be redacted
+
+    The text is only converted when the record is formatted, so nothing is
+    done if the record is filtered out by its level.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str | None):
+        self.text = text or ""
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def redact_number(match: re.Match) -> str:
+    """Mask all but the country code and last two digits of a phone number"""
+    number = match.group(0)
+    return number[:3] + "*" * (len(number) - 5) + number[-2:]
+
+
+class RedactingFilter(logging.Filter):
+    """Replaces message bodies with their length and masks phone numbers"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, tuple) and any(isinstance(arg, Body) for arg in record.args):
+            record.args = tuple(
+                f"<{len(arg.text)} characters>" if isinstance(arg, Body) else arg for arg in record.args
+            )
+        try:
+            message = record.getMessage()
+        except Exception:
+            # A bad log call mustn't raise here, outside the handler's error handling, or the listener stops
+            message = str(record.msg)
+        if "+" in message:
+            message = PHONE_NUMBER.sub(redact_number, message)
+        record.msg, record.args = message, None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues records as they are, without formatting them first
+
+    QueueHandler formats each message on the thread that logged it, this
+    leaves formatting, redaction and writing to the listener's thread. Log
+    arguments must not be changed after they're logged, which holds for the
+    strings and numbers smsbot logs.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(
+    level: int = logging.INFO, stream: TextIO | None = None, json_format: bool = False, redact: bool = True
+) -> QueueListener:
+    """
+    Send all logging through a queue to a background thread writing to the stream
+
+    The returned listener is already started, stop it on exit so everything
+    queued is written.
+    """
+    handler = logging.StreamHandler(stream)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    if redact:
+        handler.addFilter(RedactingFilter())
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level)
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,100 @@
+from string import Template
+
+# Telegram rejects any message longer than this
+MESSAGE_LIMIT = 4096
+
+# Characters that must be escaped anywhere in MarkdownV2 text, the backslash must come first
+MARKDOWNV2_SPECIAL = "\\_*[]()~`>#+-=|{}.!"
+MARKDOWNV2_ESCAPES = tuple((char, f"\\{char}") for char in MARKDOWNV2_SPECIAL)
+
+DEFAULT_MESSAGE_TEMPLATE = "*From*: $from_number\n*To*: $to_number\n\n$body\n\n$media"
+DEFAULT_CALL_TEMPLATE = "Call from $from_number, rejected\\."
+
+
+def escape_markdownv2(text: str) -> str:
+    """Escape text for MarkdownV2"""
+    # Checking for each character first skips the replace for characters the text doesn't contain. This
+    # is faster in CPython than a single str.translate or re.sub pass, which both work a character at a time
+    for char, escaped in MARKDOWNV2_ESCAPES:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
+
+
+class MessageTemplate:
+    """
+    A MarkdownV2 template using `$name` placeholders
+
+    The template is split into literal text and placeholders once, rendering
+    then only escapes the field values and joins the parts. The template text
+    itself is MarkdownV2 and is not escaped.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.parts: list[tuple[str, str | None]] = []
+
+        position = 0
+        for match in Template.pattern.finditer(template):
+            literal = template[position : match.start()]
+            if match.group("escaped") is not None:
+                self.parts.append((literal + "$", None))
+            elif match.group("invalid") is not None:
+                raise ValueError(f"Invalid placeholder in template at position {match.start()}")
+            else:
+                self.parts.append((literal, match.group("named") or match.group("braced")))
+            position = match.end()
+        self.parts.append((template[position:], None))
+
+    def render(self, fields: dict[str, str]) -> str:
+        return "".join(
+            literal + escape_markdownv2(fields.get(name, "")) if name else literal for literal, name in self.parts
+        )
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Split text into chunks Telegram will accept, preferring to break on newlines"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+            # Never split an escape sequence from the character it escapes
+            backslashes = len(text[:cut]) - len(text[:cut].rstrip("\\"))
+            if backslashes % 2:
+                cut -= 1
+        chunks.append(text[:cut].rstrip("\n"))
+        text = text[cut:].lstrip("\n")
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class MarkdownV2Renderer:
+    """Renders Twilio webhook payloads into MarkdownV2 messages for Telegram"""
+
+    def __init__(
+        self,
+        message_template: str = DEFAULT_MESSAGE_TEMPLATE,
+        call_template: str = DEFAULT_CALL_TEMPLATE,
+        limit: int = MESSAGE_LIMIT,
+    ):
+        self.templates = {
+            "message": MessageTemplate(message_template),
+            "call": MessageTemplate(call_template),
+        }
+        self.limit = limit
+
+    def render_text(self, payload, media: list[str] | None = None) -> str:
+        """Render a payload to a single string, ignoring Telegram's length limit, linking `media` if given"""
+        fields = payload.fields()
+        if media is not None:
+            fields["media"] = "\n".join(media)
+        return self.templates[payload.kind].render(fields).rstrip()
+
+    def render(self, payload, media: list[str] | None = None) -> list[str]:
+        """Render a payload to one or more messages within Telegram's length limit"""
+        return split_message(self.render_text(payload, media), self.limit)
+
+
+DEFAULT_RENDERER = MarkdownV2Renderer()
@@ -1,7 +1,17 @@
-class TwilioWebhookPayload:
+from abc import ABC, abstractmethod
+
+from smsbot.utils.render import DEFAULT_RENDERER, escape_markdownv2
+
+
+class TwilioWebhookPayload(ABC):
+    # Payloads use slots rather than a dict per instance, as many may be held at once
+    __slots__ = ()
+
     @staticmethod
-    def parse(data: dict[str, str]) -> "TwilioCall | TwilioMessage | None":
+    def parse(data: dict[str, str]) -> "TwilioCall | TwilioMessage | TwilioMessageStatus | None":
         """Return the correct class for the incoming Twilio webhook payload"""
+        if "MessageStatus" in data:
+            return TwilioMessageStatus(data)
         if "SmsMessageSid" in data:
             return TwilioMessage(data)
         if "CallSid" in data:
@@ -9,71 +19,149 @@ class TwilioWebhookPayload:
 
     def _escape(self, text: str) -> str:
         """Escape text for MarkdownV2"""
-        characters = [
-            "_",
-            "*",
-            "[",
-            "]",
-            "(",
-            ")",
-            "~",
-            "`",
-            ">",
-            "#",
-            "+",
-            "-",
-            "=",
-            "|",
-            "{",
-            "}",
-            ".",
-            "!",
-        ]
-        for char in characters:
-            text = text.replace(char, rf"\{char}")
-        return text
+        return escape_markdownv2(text)
+
+    @abstractmethod
+    def fields(self) -> dict[str, str]:
+        """Return the values available to message templates"""
+
+    def to_markdownv2(self) -> str:
+        return DEFAULT_RENDERER.render_text(self)
 
 
 class TwilioMessage(TwilioWebhookPayload):
     """Represents a Twilio SMS message"""
 
+    __slots__ = ("sid", "from_number", "to_number", "body", "media")
+    kind = "message"
+
     def __init__(self, data: dict) -> None:
+        self.sid: str | None = data.get("SmsMessageSid")
         self.from_number: str = data.get("From", "Unknown")
         self.to_number: str = data.get("To", "Unknown")
         self.body: str = data.get("Body", "")
 
-        self.media = []
+        # NumMedia can overstate the number of URLs actually sent
+        self.media: list[str] = []
         for i in range(0, int(data.get("NumMedia", "0"))):
-            self.media.append(data.get(f"MediaUrl{i}"))
+            url = data.get(f"MediaUrl{i}")
+            if url:
+                self.media.append(url)
 
     def __repr__(self) -> str:
         return f"TwilioWebhookMessage(from={self.from_number}, to={self.to_number})"
 
+    @classmethod
+    def combine(cls, messages: list["TwilioMessage"]) -> "TwilioMessage":
+        """Combine several messages into one, prefixing each body with its sender if they differ"""
+        senders = {message.from_number for message in messages}
+        recipients = {message.to_number for message in messages}
+        if len(senders) == 1:
+            bodies = [message.body for message in messages]
+        else:
+            bodies = [f"{message.from_number}: {message.body}" for message in messages]
+
+        combined = cls(
+            {
+                "SmsMessageSid": messages[0].sid,
+                "From": senders.pop() if len(senders) == 1 else "Multiple senders",
+                "To": recipients.pop() if len(recipients) == 1 else "Multiple numbers",
+                "Body": "\n\n".join(bodies),
+            }
+        )
+        combined.media = [url for message in messages for url in message.media]
+        return combined
+
+    def to_dict(self) -> dict[str, str | None]:
+        """Return the message in the same form as the original webhook data"""
+        data: dict[str, str | None] = {
+            "SmsMessageSid": self.sid,
+            "From": self.from_number,
+            "To": self.to_number,
+            "Body": self.body,
+            "NumMedia": str(len(self.media)),
+        }
+        for i, url in enumerate(self.media):
+            data[f"MediaUrl{i}"] = url
+        return data
+
     def to_str(self) -> str:
         media_str = "\n".join([f"<{url}>" for url in self.media]) if self.media else ""
         msg = f"**From**: {self.from_number}\n**To**: {self.to_number}\n\n{self.body}\n\n{media_str}"
         return msg
 
-    def to_markdownv2(self):
-        media_str = "\n".join([f"{self._escape(url)}" for url in self.media]) if self.media else ""
-        msg = f"**From**: {self._escape(self.from_number)}\n**To**: {self._escape(self.to_number)}\n\n{self._escape(self.body)}\n\n{media_str}"
-        return msg
+    def fields(self) -> dict[str, str]:
+        return {
+            "from_number": self.from_number,
+            "to_number": self.to_number,
+            "body": self.body,
+            "media": "\n".join(self.media),
+        }
 
 
 class TwilioCall(TwilioWebhookPayload):
     """Represents a Twilio voice call"""
 
+    __slots__ = ("sid", "from_number", "to_number")
+    kind = "call"
+
     def __init__(self, data: dict) -> None:
+        self.sid: str | None = data.get("CallSid")
         self.from_number: str = data.get("From", "Unknown")
         self.to_number: str = data.get("To", "Unknown")
 
     def __repr__(self) -> str:
         return f"TwilioCall(from={self.from_number}, to={self.to_number})"
 
+    def to_dict(self) -> dict[str, str | None]:
+        """Return the call in the same form as the original webhook data"""
+        return {"CallSid": self.sid, "From": self.from_number, "To": self.to_number}
+
     def to_str(self) -> str:
         msg = f"Call from {self.from_number}, rejected."
         return msg
 
-    def to_markdownv2(self) -> str:
-        msg = f"Call from {self._escape(self.from_number)}, rejected\\."
-        return msg
+    def fields(self) -> dict[str, str]:
+        return {"from_number": self.from_number, "to_number": self.to_number}
+
+
+class TwilioMessageStatus(TwilioWebhookPayload):
+    """Represents a status callback for an SMS we sent"""
+
+    __slots__ = ("sid", "status", "from_number", "to_number", "error_code")
+    kind = "status"
+
+    # Statuses after which Twilio sends no more callbacks
+    FINAL_STATUSES = frozenset({"delivered", "undelivered", "failed", "read", "canceled"})
+    FAILED_STATUSES = frozenset({"undelivered", "failed"})
+
+    def __init__(self, data: dict) -> None:
+        self.sid: str | None = data.get("MessageSid")
+        self.status: str = data.get("MessageStatus", "unknown")
+        self.from_number: str = data.get("From", "Unknown")
+        self.to_number: str = data.get("To", "Unknown")
+        self.error_code: str | None = data.get("ErrorCode") or None
+
+    def __repr__(self) -> str:
+        return f"TwilioMessageStatus(sid={self.sid}, status={self.status})"
+
+    @property
+    def final(self) -> bool:
+        return self.status in self.FINAL_STATUSES
+
+    @property
+    def failed(self) -> bool:
+        return self.status in self.FAILED_STATUSES
+
+    def to_dict(self) -> dict[str, str | None]:
+        """Return the status in the same form as the original webhook data"""
+        return {
+            "MessageSid": self.sid,
+            "MessageStatus": self.status,
+            "From": self.from_number,
+            "To": self.to_number,
+            "ErrorCode": self.error_code,
+        }
+
+    def fields(self) -> dict[str, str]:
+        return {"from_number": self.from_number, "to_number": self.to_number, "status": self.status}
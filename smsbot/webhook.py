@@ -1,109 +1,419 @@
+import hmac
+import json
+import logging
 from functools import wraps
 
-from flask import Flask, abort, current_app, request
-from prometheus_async.aio import time
-from prometheus_client import Counter, Summary, make_wsgi_app
-from twilio.request_validator import RequestValidator
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from prometheus_client import Counter, Gauge, Histogram, make_asgi_app
+from telegram import Update
 
+from smsbot.admission import AdmissionControl
+from smsbot.coalesce import Coalescer
+from smsbot.dedupe import DedupeCache
+from smsbot.delivery import DeliveryQueue
+from smsbot.diagnostics import Diagnostics
+from smsbot.fanout import FanOutError, FanOutResult
+from smsbot.history import MessageHistory
+from smsbot.media import MediaRelay
+from smsbot.routing import Router
 from smsbot.utils import get_smsbot_version
-from smsbot.utils.twilio import TwilioWebhookPayload
+from smsbot.utils.asgi import JSONResponse, Request, RequestTooLarge, Response, abort
+from smsbot.utils.log import Body
+from smsbot.utils.render import DEFAULT_RENDERER, MarkdownV2Renderer, escape_markdownv2
+from smsbot.utils.twilio import TwilioCall, TwilioMessage, TwilioMessageStatus, TwilioWebhookPayload
+from smsbot.validation import TwilioSignatureValidator
 
-REQUEST_TIME = Summary("webhook_request_processing_seconds", "Time spent processing request")
+# Twilio webhooks and Telegram updates are a few kilobytes at most
+MAX_BODY_SIZE = 256 * 1024
+
+# Stages take from microseconds to seconds, so the buckets start lower than the defaults
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_TIME = Histogram("webhook_request_processing_seconds", "Time spent processing request", ["handler"])
+REQUESTS_IN_PROGRESS = Gauge("webhook_requests_in_progress", "Number of requests being processed", ["handler"])
+STAGE_TIME = Histogram(
+    "webhook_stage_seconds", "Time spent in each stage of processing a webhook", ["stage"], buckets=STAGE_BUCKETS
+)
 MESSAGE_COUNT = Counter("webhook_message_count", "Total number of messages processed")
 CALL_COUNT = Counter("webhook_call_count", "Total number of calls processed")
+STATUS_COUNT = Counter("webhook_status_count", "Total number of SMS status callbacks processed")
+STATUS_ERRORS = Counter("webhook_status_error_count", "Total number of SMS status callbacks that failed")
+TELEGRAM_UPDATE_COUNT = Counter("webhook_telegram_update_count", "Total number of Telegram updates received")
 
 
 class TwilioWebhookHandler(object):
     """
-    A wrapped Flask app handling webhooks received from Twilio
+    An ASGI app handling webhooks received from Twilio
+
+    The app runs directly on the uvicorn event loop, the same loop the Telegram
+    application is started on, so webhook calls can await the bot directly.
     """
 
-    def __init__(self, account_sid: str | None = None, auth_token: str | None = None):
-        self.app = Flask(self.__class__.__name__)
-        self.app.add_url_rule("/", "index", self.index, methods=["GET"])
-        self.app.add_url_rule("/health", "health", self.health, methods=["GET"])
-        self.app.add_url_rule("/message", "message", self.message, methods=["POST"])
-        self.app.add_url_rule("/call", "call", self.call, methods=["POST"])
+    def __init__(
+        self,
+        account_sid: str | None = None,
+        auth_token: str | None = None,
+        debug: bool = False,
+        delivery_queue: DeliveryQueue | None = None,
+        dedupe: DedupeCache | None = None,
+        validator: TwilioSignatureValidator | None = None,
+        renderer: MarkdownV2Renderer | None = None,
+        telegram_secret: str | None = None,
+        coalescer: Coalescer | None = None,
+        media_relay: MediaRelay | None = None,
+        router: Router | None = None,
+        admission: AdmissionControl | None = None,
+        history: MessageHistory | None = None,
+        diagnostics: Diagnostics | None = None,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.debug = debug
+        self.renderer = renderer or DEFAULT_RENDERER
+        self.delivery_queue = delivery_queue
+        self.dedupe = dedupe
+        self.media_relay = media_relay
+        self.router = router
+        self.admission = admission
+        self.history = history
+        self.coalescer = coalescer
+        if coalescer is not None:
+            # Buffered messages are only held in memory, so they'd be lost on a crash after Twilio was answered
+            if delivery_queue is not None:
+                raise ValueError("Coalescing can't be used with the delivery queue")
+            if coalescer.flush is None:
+                coalescer.flush = self.deliver_to
 
         # Twilio auth details
         self.account_sid = account_sid
         self.auth_token = auth_token
+        self.validator = validator if validator is not None else TwilioSignatureValidator([auth_token])
 
         # Wrap validation around hook endpoints
         self.message = self.validate_twilio_request(self.message)
         self.call = self.validate_twilio_request(self.call)
+        self.status = self.validate_twilio_request(self.status)
+        # Endpoints turned away by admission control, before their body is read
+        self.admitted = {self.message, self.call}
 
-        # Add prometheus wsgi middleware to route /metrics requests
-        self.app.wsgi_app = DispatcherMiddleware(
-            self.app.wsgi_app,
-            {
-                "/metrics": make_wsgi_app(),
-            },
-        )
+        self.routes = {
+            ("GET", "/"): self.index,
+            ("GET", "/health"): self.health,
+            ("POST", "/message"): self.message,
+            ("POST", "/call"): self.call,
+            ("POST", "/status"): self.status,
+        }
+
+        # Telegram webhook updates, the secret is only sent in a header as paths are written to access logs
+        self.telegram_secret = telegram_secret
+        if telegram_secret:
+            self.routes[("POST", "/telegram")] = self.telegram_update
+
+        # Profiling and task listing, only routed if enabled
+        self.diagnostics = diagnostics
+        if diagnostics is not None:
+            self.routes[("GET", "/debug/profile")] = self.authorize_debug_request(self.debug_profile)
+            self.routes[("GET", "/debug/tasks")] = self.authorize_debug_request(self.debug_tasks)
+
+        # Prometheus ASGI app to serve /metrics requests
+        self.metrics_app = make_asgi_app()
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        """ASGI entrypoint"""
+        if scope["type"] == "lifespan":
+            return await self.lifespan(scope, receive, send)
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] == "/metrics" or scope["path"].startswith("/metrics/"):
+            return await self.metrics_app(scope, receive, send)
+
+        # Route before reading the body, so nothing is buffered for requests that are turned away
+        method, path = scope.get("method", "GET"), scope.get("path", "/")
+        handler = self.routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self.routes):
+                response = abort(405)
+            else:
+                response = abort(404)
+        elif self.admission is not None and handler in self.admitted:
+            if self.admission.acquire():
+                try:
+                    response = await self.handle(handler, scope, receive)
+                finally:
+                    self.admission.release()
+            else:
+                response = Response(
+                    b"",
+                    status=503,
+                    content_type="text/plain",
+                    headers={"retry-after": str(self.admission.retry_after)},
+                )
+        else:
+            response = await self.handle(handler, scope, receive)
+        await response(scope, receive, send)
+
+    async def handle(self, handler, scope: dict, receive) -> Response:
+        """Read the request body, up to MAX_BODY_SIZE, and pass the request to its handler"""
+        try:
+            request = await Request.from_receive(scope, receive, max_size=MAX_BODY_SIZE)
+        except RequestTooLarge:
+            return abort(413)
+        try:
+            with REQUESTS_IN_PROGRESS.labels(handler.__name__).track_inprogress():
+                with REQUEST_TIME.labels(handler.__name__).time():
+                    return await handler(request)
+        except Exception:
+            self.logger.exception("Unhandled exception processing %s %s", request.method, request.path)
+            return abort(500)
+
+    async def lifespan(self, scope: dict, receive, send) -> None:
+        """Handle ASGI lifespan events"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.delivery_queue:
+                    await self.delivery_queue.start(self.deliver)
+                if self.history is not None:
+                    await self.history.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.coalescer is not None:
+                    await self.coalescer.stop()
+                if self.delivery_queue:
+                    await self.delivery_queue.stop()
+                if self.media_relay is not None:
+                    await self.media_relay.close()
+                if self.history is not None:
+                    await self.history.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
 
     def validate_twilio_request(self, func):
         """Validates that incoming requests genuinely originated from Twilio"""
 
         @wraps(func)
-        async def decorated_function(*args, **kwargs):
-            # Create an instance of the RequestValidator class
-            if not self.auth_token:
-                current_app.logger.warning("Twilio request validation skipped due to Twilio Auth Token missing")
-                return await func(*args, **kwargs)
-            validator = RequestValidator(self.auth_token)
+        async def decorated_function(request: Request, *args, **kwargs):
+            if not self.validator:
+                self.logger.warning("Twilio request validation skipped due to Twilio Auth Token missing")
+                return await func(request, *args, **kwargs)
 
             # Validate the request using its URL, POST data,
             # and X-TWILIO-SIGNATURE header
-            request_valid = validator.validate(
-                request.url,
-                request.form,
-                request.headers.get("X-TWILIO-SIGNATURE", ""),
-            )
+            with STAGE_TIME.labels("validate").time():
+                request_valid = self.validator.validate(request)
 
             # Continue processing the request if it's valid, return a 403 error if
             # it's not
-            if request_valid or current_app.debug:
-                return await func(*args, **kwargs)
+            if request_valid or self.debug:
+                return await func(request, *args, **kwargs)
             return abort(403)
 
         return decorated_function
 
+    def authorize_debug_request(self, func):
+        """Only allow requests with the diagnostics token as a bearer token"""
+
+        @wraps(func)
+        async def decorated_function(request: Request, *args, **kwargs):
+            scheme, _, token = request.headers.get("authorization", "").partition(" ")
+            if scheme.lower() != "bearer" or not hmac.compare_digest(token, self.diagnostics.token):
+                return Response(b"", status=401, content_type="text/plain", headers={"www-authenticate": "Bearer"})
+            return await func(request, *args, **kwargs)
+
+        return decorated_function
+
     def set_telegram_application(self, app):
         """Set the Telegram application instance to use for any webhook calls"""
         self.telegram_app = app
 
-    async def index(self) -> str:
-        return f'smsbot v{get_smsbot_version()} - <a href="https://github.com/nikdoof/smsbot">GitHub</a>'
+    def route(self, payload: TwilioCall | TwilioMessage) -> set[int] | None:
+        """Return the chats picked by the routing rules, None sends to every subscriber"""
+        if self.router is None:
+            return None
+        with STAGE_TIME.labels("route").time():
+            return self.router.route(payload)
+
+    async def deliver(self, payload: TwilioCall | TwilioMessage | TwilioMessageStatus) -> None:
+        """Send a parsed webhook payload to the chats it's routed to, or pass a status to the bot"""
+        if isinstance(payload, TwilioMessageStatus):
+            await self.telegram_app.sms_status(payload)
+            return
+        await self.deliver_to(payload, self.route(payload))
+
+    async def deliver_to(self, payload: TwilioCall | TwilioMessage, chats: set[int] | None) -> None:
+        """Send a parsed webhook payload to the given chats, or every subscriber if None"""
+        if chats is not None and not chats:
+            self.logger.info("No routing rules matched %r, not sending it", payload)
+            return
+
+        # When relaying media the files are sent after the text, only media that can't be downloaded is linked
+        files, links = [], None
+        if self.media_relay is not None and isinstance(payload, TwilioMessage) and payload.media:
+            with STAGE_TIME.labels("media").time():
+                downloads = await self.media_relay.download_all(payload.media)
+            files = [media for media in downloads if media is not None]
+            links = [url for url, media in zip(payload.media, downloads) if media is None]
+
+        with STAGE_TIME.labels("render").time():
+            texts = self.renderer.render(payload, media=links)
+        for text in texts:
+            with STAGE_TIME.labels("send").time():
+                results = await self.send_text(text, chats)
 
-    async def health(self) -> dict[str, str | int]:
+            # Only fail if nobody got the message, so a queued payload is retried without duplicating it
+            if results and not any(result.ok for result in results):
+                raise FanOutError(results)
+
+        if files:
+            with STAGE_TIME.labels("media").time():
+                unsent = await self.media_relay.send(files, self.telegram_app, chats)
+            # Link anything Telegram wouldn't accept, so it isn't lost
+            if unsent:
+                await self.send_text(escape_markdownv2("\n".join(media.url for media in unsent)), chats)
+
+    async def send_text(self, text: str, chats: set[int] | None) -> list[FanOutResult]:
+        """Send a rendered message to the given chats, or every subscriber if None"""
+        if chats is None:
+            return await self.telegram_app.send_subscribers(text)
+        return await self.telegram_app.send_many(chats, text)
+
+    async def dispatch(self, payload: TwilioCall | TwilioMessage) -> None:
+        """Hand a payload to the coalescer if configured, otherwise queue or deliver it"""
+        if self.coalescer is not None:
+            # Each message is routed on its own, as a digest's numbers and body don't match any single message
+            await self.coalescer.add(payload, self.route(payload))
+        else:
+            await self.enqueue(payload)
+
+    async def enqueue(self, payload: TwilioCall | TwilioMessage | TwilioMessageStatus) -> None:
+        """Queue a payload for delivery if a queue is configured, otherwise deliver it inline"""
+        if self.delivery_queue:
+            with STAGE_TIME.labels("enqueue").time():
+                await self.delivery_queue.put(payload)
+        else:
+            await self.deliver(payload)
+
+    async def notify_rate_limited(self, sender: str) -> None:
+        """Tell the owners a sender's messages and calls are being dropped"""
+        limit, window = self.admission.sender_limit, self.admission.sender_window
+        self.logger.warning("Dropping webhooks from %s, more than %d in %g seconds", sender, limit, window)
+        text = f"Dropping messages and calls from {sender}, more than {limit} in {window:g} seconds"
+        try:
+            await self.telegram_app.send_owners(escape_markdownv2(text))
+        except Exception:
+            self.logger.exception("Failed to tell the owners %s is rate limited", sender)
+
+    async def process(self, values: dict[str, str]) -> None:
+        """Parse and dispatch a webhook, ignoring any Twilio has already sent us"""
+        sid = values.get("SmsMessageSid") or values.get("CallSid")
+        if sid and self.dedupe is not None and await self.dedupe.seen(sid):
+            self.logger.info("Ignoring duplicate webhook %s", sid)
+            return
+
+        # Drop anything over a sender's rate limit, telling the owners the first time in each window
+        if self.admission is not None:
+            sender = values.get("From", "")
+            dropped = self.admission.check_sender(sender)
+            if dropped == 1:
+                await self.notify_rate_limited(sender)
+            if dropped:
+                return
+
+        with STAGE_TIME.labels("parse").time():
+            hook_data = TwilioWebhookPayload.parse(values)
+        if isinstance(hook_data, (TwilioMessage, TwilioCall)):
+            try:
+                await self.dispatch(hook_data)
+            except Exception:
+                # Let Twilio's retry of this webhook through
+                if sid and self.dedupe is not None:
+                    await self.dedupe.forget(sid)
+                raise
+            # Only once dispatched, so a retried webhook isn't stored twice
+            if self.history is not None and isinstance(hook_data, TwilioMessage):
+                self.history.add(hook_data)
+
+    async def index(self, request: Request) -> Response:
+        return Response(f'smsbot v{get_smsbot_version()} - <a href="https://github.com/nikdoof/smsbot">GitHub</a>')
+
+    async def health(self, request: Request) -> Response:
         """Return basic health information"""
-        return {
-            "version": get_smsbot_version(),
-            "owners": self.telegram_app.owners,
-            "subscribers": len(self.telegram_app.subscribers),
-        }
+        return JSONResponse(
+            {
+                "version": get_smsbot_version(),
+                "owners": sorted(self.telegram_app.owners),
+                "subscribers": len(self.telegram_app.subscribers),
+            }
+        )
+
+    async def telegram_update(self, request: Request) -> Response:
+        """Feed an update pushed by the Telegram webhook into the bot's update queue"""
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, self.telegram_secret):
+            return abort(403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return abort(400)
+
+        application = self.telegram_app.app
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        TELEGRAM_UPDATE_COUNT.inc()
+        return Response(b"", content_type="text/plain")
 
-    @time(REQUEST_TIME)
-    async def message(self) -> str:
+    async def message(self, request: Request) -> Response:
         """Handle incoming SMS messages from Twilio"""
-        current_app.logger.info("Received SMS from {From}: {Body}".format(**request.values.to_dict()))
-        hook_data = TwilioWebhookPayload.parse(request.values.to_dict())
-        if hook_data:
-            await self.telegram_app.send_subscribers(hook_data.to_markdownv2())
+        values = request.values
+        self.logger.info("Received SMS from %s: %s", values.get("From"), Body(values.get("Body")))
+        await self.process(values)
 
         # Return a blank response
         MESSAGE_COUNT.inc()
-        return '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+        return Response(
+            '<?xml version="1.0" encoding="UTF-8"?><Response></Response>', content_type="application/xml"
+        )
 
-    @time(REQUEST_TIME)
-    async def call(self) -> str:
+    async def call(self, request: Request) -> Response:
         """Handle incoming calls from Twilio"""
-        current_app.logger.info("Received Call from {From}".format(**request.values.to_dict()))
-        hook_data = TwilioWebhookPayload.parse(request.values.to_dict())
-        if hook_data:
-            await self.telegram_app.send_subscribers(hook_data.to_markdownv2())
+        values = request.values
+        self.logger.info("Received Call from %s", values.get("From"))
+        await self.process(values)
 
         # Always reject calls
         CALL_COUNT.inc()
-        return '<?xml version="1.0" encoding="UTF-8"?><Response><Reject/></Response>'
+        return Response(
+            '<?xml version="1.0" encoding="UTF-8"?><Response><Reject/></Response>', content_type="application/xml"
+        )
+
+    async def status(self, request: Request) -> Response:
+        """Handle status callbacks for SMS sent with /sms"""
+        payload = TwilioWebhookPayload.parse(request.values)
+        if not isinstance(payload, TwilioMessageStatus):
+            return abort(400)
+        self.logger.debug("SMS %s is %s", payload.sid, payload.status)
+        # Queued like messages when there's a queue, so telling the chat about a failure is retried
+        try:
+            await self.enqueue(payload)
+        except Exception:
+            self.logger.exception("Failed to process status %s of SMS %s", payload.status, payload.sid)
+            STATUS_ERRORS.inc()
+            return abort(500)
+
+        STATUS_COUNT.inc()
+        return Response(b"", content_type="text/plain")
+
+    async def debug_profile(self, request: Request) -> Response:
+        """Profile the event loop, returning stacks in the collapsed format flame graph tools read"""
+        try:
+            seconds = float(request.args.get("seconds", "10"))
+        except ValueError:
+            return abort(400)
+        # Written this way round to reject NaN too
+        if not seconds > 0:
+            return abort(400)
+        if self.diagnostics.profiling:
+            return abort(409)
+        return Response(await self.diagnostics.profile(seconds), content_type="text/plain")
+
+    async def debug_tasks(self, request: Request) -> Response:
+        """List the pending asyncio tasks, oldest first"""
+        return JSONResponse(self.diagnostics.tasks())
@@ -0,0 +1,365 @@
+"""
+End to end load test for smsbot
+
+Runs the webhook server and the Telegram bot as they run in production, with
+a local stand-in for the Telegram Bot API and a generator sending signed
+Twilio webhooks at a fixed rate. Webhook latency is measured by the
+generator, delivery latency is the time from sending a webhook until the
+last subscriber received it.
+
+    uv run python tests/benchmarks/loadtest.py --rate 200 --duration 10 --subscribers 5 --output results.json
+
+Results are written as JSON, pass a previous result file with `--baseline` to
+compare against it.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import platform
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import uvicorn
+from twilio.request_validator import RequestValidator
+
+from smsbot.dedupe import DedupeCache
+from smsbot.delivery import DeliveryQueue
+from smsbot.fanout import FanOut
+from smsbot.telegram import TelegramSmsBot
+from smsbot.utils import get_smsbot_version
+from smsbot.utils.asgi import JSONResponse, Request, abort
+from smsbot.webhook import TwilioWebhookHandler
+
+BOT_TOKEN = "123456:loadtest"
+AUTH_TOKEN = "loadtest"
+MARKER = re.compile(r"Load test message (\d+)")
+
+
+class FakeTelegramServer:
+    """An ASGI app answering the Bot API methods smsbot uses, recording when each message arrives"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.received: dict[int, list[float]] = {}
+        self.message_id = 0
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] != "http":
+            return
+        request = await Request.from_receive(scope, receive)
+        method = request.path.rsplit("/", 1)[-1]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "smsbot", "username": "smsbot_loadtest_bot"}
+        elif method == "sendMessage":
+            values = request.form
+            match = MARKER.search(values.get("text", ""))
+            if match:
+                self.received.setdefault(int(match.group(1)), []).append(time.perf_counter())
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(values["chat_id"]), "type": "private"},
+                "text": values.get("text", ""),
+            }
+        elif method in ("deleteWebhook", "setWebhook", "close", "logOut"):
+            result = True
+        else:
+            response = abort(404)
+            return await response(scope, receive, send)
+        await JSONResponse({"ok": True, "result": result})(scope, receive, send)
+
+
+class TwilioWebhookGenerator:
+    """Sends signed SMS webhooks at a fixed rate, whether or not earlier requests have finished"""
+
+    def __init__(self, url: str, auth_token: str = AUTH_TOKEN, connections: int = 16):
+        self.url = url
+        self.validator = RequestValidator(auth_token)
+        self.connections = connections
+        self.started: dict[int, float] = {}
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    def build(self, number: int) -> tuple[dict[str, str], dict[str, str]]:
+        """Return the form values and headers for a webhook, signed as Twilio would"""
+        values = {
+            "SmsMessageSid": f"SM{number:032x}",
+            "AccountSid": "AC" + "0" * 32,
+            "From": "+15005550006",
+            "To": "+15005550001",
+            "Body": f"Load test message {number}",
+            "NumMedia": "0",
+        }
+        return values, {"X-Twilio-Signature": self.validator.compute_signature(self.url, values)}
+
+    async def send(self, client: httpx.AsyncClient, number: int) -> None:
+        values, headers = self.build(number)
+        self.started[number] = start = time.perf_counter()
+        try:
+            response = await client.post(self.url, data=values, headers=headers)
+        except httpx.HTTPError:
+            self.errors += 1
+            return
+        if response.status_code == 200:
+            self.latencies.append(time.perf_counter() - start)
+        else:
+            self.errors += 1
+
+    async def run(self, rate: float, duration: float) -> float:
+        """Send webhooks for `duration` seconds, returning how long it took for them all to be answered"""
+        limits = httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+            tasks = []
+            start = time.perf_counter()
+            for number in range(int(rate * duration)):
+                delay = start + number / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self.send(client, number)))
+            await asyncio.gather(*tasks)
+            return time.perf_counter() - start
+
+
+async def start_server(app, lifespan: str = "off") -> tuple[uvicorn.Server, asyncio.Task, int]:
+    """Serve an ASGI app on a free local port"""
+    # Let uvicorn bind the port, it doesn't disable Nagle's algorithm on sockets passed to it
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=0, lifespan=lifespan, log_level="warning", access_log=False)
+    )
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return server, task, server.servers[0].sockets[0].getsockname()[1]
+
+
+async def stop_server(server: uvicorn.Server, task: asyncio.Task) -> None:
+    server.should_exit = True
+    await task
+
+
+def percentile(values: list[float], percent: float) -> float | None:
+    """Nearest rank percentile of the values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def summarise(values: list[float]) -> dict[str, float | None]:
+    """Latency percentiles in milliseconds"""
+    result = {f"p{percent}": percentile(values, percent) for percent in (50, 95, 99)}
+    result["max"] = max(values) if values else None
+    return {key: round(value * 1000, 3) if value is not None else None for key, value in result.items()}
+
+
+async def serve_smsbot(
+    conn,
+    telegram_url: str,
+    subscribers: int,
+    queue: bool,
+    global_rate: float,
+    chat_rate: float,
+) -> None:
+    """Run smsbot against the fake Bot API until told to stop, sending back the CPU time it used"""
+    bot = TelegramSmsBot(
+        BOT_TOKEN,
+        subscribers=list(range(1, subscribers + 1)),
+        fanout=FanOut(global_rate=global_rate, chat_rate=chat_rate),
+        base_url=telegram_url,
+    )
+    await bot.app.initialize()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        handler = TwilioWebhookHandler(
+            auth_token=AUTH_TOKEN,
+            delivery_queue=DeliveryQueue(str(Path(tmp_dir) / "queue.db")) if queue else None,
+            dedupe=DedupeCache(),
+        )
+        handler.set_telegram_application(bot)
+        server, task, port = await start_server(handler, lifespan="on")
+
+        cpu = time.process_time()
+        conn.send(port)
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        conn.send(time.process_time() - cpu)
+
+        await stop_server(server, task)
+    await bot.app.shutdown()
+
+
+def smsbot_process(conn, level: int, *args) -> None:
+    """Entry point of the process smsbot runs in"""
+    logging.basicConfig(level=level, stream=sys.stderr)
+    asyncio.run(serve_smsbot(conn, *args))
+
+
+async def run_loadtest(
+    rate: float = 100.0,
+    duration: float = 5.0,
+    subscribers: int = 1,
+    telegram_latency: float = 0.0,
+    queue: bool = False,
+    global_rate: float = 10000.0,
+    chat_rate: float = 10000.0,
+    connections: int = 16,
+    drain_timeout: float = 30.0,
+) -> dict:
+    """Run a load test and return the results"""
+    loop = asyncio.get_running_loop()
+    telegram = FakeTelegramServer(latency=telegram_latency)
+    telegram_server, telegram_task, telegram_port = await start_server(telegram)
+
+    # smsbot gets a process of its own, as it would in production, so the harness doesn't share its event loop
+    conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.get_context("spawn").Process(
+        target=smsbot_process,
+        args=(
+            child_conn,
+            logging.getLogger().getEffectiveLevel(),
+            f"http://127.0.0.1:{telegram_port}/bot",
+            subscribers,
+            queue,
+            global_rate,
+            chat_rate,
+        ),
+        daemon=True,
+    )
+    process.start()
+    try:
+        webhook_port = await loop.run_in_executor(None, conn.recv)
+        generator = TwilioWebhookGenerator(f"http://127.0.0.1:{webhook_port}/message", connections=connections)
+        elapsed = await generator.run(rate, duration)
+
+        # Wait for queued messages to reach every subscriber
+        deadline = time.perf_counter() + drain_timeout
+        while time.perf_counter() < deadline and any(
+            len(telegram.received.get(number, ())) < subscribers for number in generator.started
+        ):
+            await asyncio.sleep(0.05)
+
+        conn.send("stop")
+        cpu = await loop.run_in_executor(None, conn.recv)
+    finally:
+        await loop.run_in_executor(None, process.join, 10)
+        if process.is_alive():
+            process.kill()
+        await stop_server(telegram_server, telegram_task)
+
+    delivery = [
+        max(telegram.received[number]) - started
+        for number, started in generator.started.items()
+        if len(telegram.received.get(number, ())) >= subscribers
+    ]
+    sent = len(generator.started)
+    return {
+        "version": get_smsbot_version(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "parameters": {
+            "rate": rate,
+            "duration": duration,
+            "subscribers": subscribers,
+            "telegram_latency": telegram_latency,
+            "queue": queue,
+            "global_rate": global_rate,
+            "chat_rate": chat_rate,
+            "connections": connections,
+        },
+        "requests": sent,
+        "errors": generator.errors,
+        "undelivered": sent - len(delivery),
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(generator.latencies) / elapsed, 2) if elapsed else 0.0,
+        "cpu_ms_per_webhook": round(cpu * 1000 / sent, 3) if sent else None,
+        "webhook_latency_ms": summarise(generator.latencies),
+        "delivery_latency_ms": summarise(delivery),
+    }
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    """Describe how the results changed from a baseline"""
+    lines = [f"Compared to smsbot v{baseline['version']}:"]
+
+    def change(name: str, current: float | None, previous: float | None) -> None:
+        if current is None or not previous:
+            return
+        lines.append(f"  {name}: {previous} -> {current} ({(current - previous) / previous:+.1%})")
+
+    change("throughput", results["throughput"], baseline["throughput"])
+    change("cpu_ms_per_webhook", results["cpu_ms_per_webhook"], baseline.get("cpu_ms_per_webhook"))
+    for key in ("webhook_latency_ms", "delivery_latency_ms"):
+        for percent in ("p50", "p95", "p99"):
+            change(f"{key} {percent}", results[key][percent], baseline[key][percent])
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser("loadtest", description="Load test smsbot end to end")
+    parser.add_argument("--rate", type=float, default=100.0, help="Webhooks sent per second")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to send webhooks for")
+    parser.add_argument("--subscribers", type=int, default=1, help="Number of Telegram subscribers")
+    parser.add_argument(
+        "--telegram-latency", type=float, default=0.0, help="Seconds the fake Bot API waits before responding"
+    )
+    parser.add_argument("--queue", action="store_true", help="Use the durable delivery queue")
+    parser.add_argument(
+        "--global-rate", type=float, default=10000.0, help="Fan-out messages per second, Telegram allows 30"
+    )
+    parser.add_argument(
+        "--chat-rate", type=float, default=10000.0, help="Fan-out messages per second per chat, Telegram allows 1"
+    )
+    parser.add_argument("--connections", type=int, default=16, help="Maximum concurrent webhook connections")
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, defaults to stdout")
+    parser.add_argument("--baseline", type=argparse.FileType("r"), help="Previous results to compare against")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show smsbot's own logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+    results = asyncio.run(
+        run_loadtest(
+            rate=args.rate,
+            duration=args.duration,
+            subscribers=args.subscribers,
+            telegram_latency=args.telegram_latency,
+            queue=args.queue,
+            global_rate=args.global_rate,
+            chat_rate=args.chat_rate,
+            connections=args.connections,
+        )
+    )
+
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        Path(args.output).write_text(output + "\n")
+
+    print(
+        f"{results['requests']} webhooks, {results['errors']} errors, {results['undelivered']} undelivered, "
+        f"{results['throughput']}/s, {results['cpu_ms_per_webhook']}ms CPU per webhook, "
+        f"webhook p50/p95/p99 {results['webhook_latency_ms']['p50']}/"
+        f"{results['webhook_latency_ms']['p95']}/{results['webhook_latency_ms']['p99']}ms, delivery p50/p95/p99 "
+        f"{results['delivery_latency_ms']['p50']}/{results['delivery_latency_ms']['p95']}/"
+        f"{results['delivery_latency_ms']['p99']}ms",
+        file=sys.stderr,
+    )
+    if args.baseline:
+        print("\n".join(compare(results, json.load(args.baseline))), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
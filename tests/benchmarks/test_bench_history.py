@@ -0,0 +1,65 @@
+import asyncio
+import random
+import string
+from time import time
+
+import pytest
+
+from smsbot.history import MessageHistory
+
+# Only fill the history when timing it, as it takes a while
+MESSAGES = 200000
+MESSAGES_UNTIMED = 1000
+
+
+def random_body(rng: random.Random) -> str:
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(rng.randint(5, 25))]
+    return " ".join(words) + f" code {rng.randint(0, 999999):06d}"
+
+
+@pytest.fixture(scope="module")
+def history(request, tmp_path_factory):
+    """A history of 200,000 messages, and a persistent loop to query it on"""
+    timed = request.config.getoption("benchmark_enable") or not request.config.getoption("benchmark_disable")
+    count = MESSAGES if timed else MESSAGES_UNTIMED
+    rng = random.Random(0)
+    history = MessageHistory(str(tmp_path_factory.mktemp("history") / "history.db"), max_messages=count + 1)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(history.start())
+    now = time()
+    history.pending = [
+        (now, f"+1555{rng.randint(0, 9999999):07d}", "+15005550006", random_body(rng)) for _ in range(count)
+    ]
+    history.pending.append((now, "+447700900123", "+15005550006", "Your Acme verification code is 314159"))
+    loop.run_until_complete(history.flush())
+    yield history, loop
+    loop.run_until_complete(history.stop())
+    loop.close()
+
+
+def test_bench_history_last(benchmark, history):
+    history, loop = history
+    messages = benchmark(lambda: loop.run_until_complete(history.last(10)))
+    assert len(messages) == 10
+
+
+def test_bench_history_search_rare(benchmark, history):
+    history, loop = history
+    messages = benchmark(lambda: loop.run_until_complete(history.search("acme 314")))
+    assert len(messages) == 1
+
+
+def test_bench_history_search_common(benchmark, history):
+    history, loop = history
+    messages = benchmark(lambda: loop.run_until_complete(history.search("code")))
+    assert len(messages) == 10
+
+
+def test_bench_history_write_batch(benchmark, history):
+    history, loop = history
+
+    def write():
+        history.pending = [(time(), "+15555550100", "+15005550006", "Your code is 123456")] * history.batch_size
+        loop.run_until_complete(history.flush())
+
+    benchmark(write)
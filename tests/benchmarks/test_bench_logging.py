@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+import pytest
+
+from smsbot.utils.asgi import Request
+from smsbot.utils.log import setup_logging
+from smsbot.webhook import TwilioWebhookHandler
+
+BODY = b"SmsMessageSid=SM123&From=%2B1234567890&To=%2B0987654321&Body=" + b"Hello+" * 50
+SCOPE = {
+    "type": "http",
+    "method": "POST",
+    "path": "/message",
+    "headers": [(b"content-type", b"application/x-www-form-urlencoded")],
+}
+
+
+class FakeTelegramApp:
+    owners = [1]
+    subscribers = [2, 3]
+
+    async def send_subscribers(self, text):
+        pass
+
+
+@pytest.fixture
+def handle_message():
+    """Run the message handler on a persistent loop, with the root logger restored afterwards"""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    webhooks = TwilioWebhookHandler()
+    webhooks.set_telegram_application(FakeTelegramApp())
+    loop = asyncio.new_event_loop()
+    yield lambda: loop.run_until_complete(webhooks.message(Request(SCOPE, BODY)))
+    loop.close()
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_bench_message_no_logging(benchmark, handle_message):
+    logging.getLogger().setLevel(logging.WARNING)
+    benchmark(handle_message)
+
+
+def test_bench_message_stream_logging(benchmark, handle_message, tmp_path):
+    with (tmp_path / "smsbot.log").open("a") as stream:
+        logging.basicConfig(level=logging.INFO, stream=stream, force=True)
+        benchmark(handle_message)
+
+
+def test_bench_message_queue_logging(benchmark, handle_message, tmp_path):
+    with (tmp_path / "smsbot.log").open("a") as stream:
+        listener = setup_logging(stream=stream)
+        benchmark(handle_message)
+        listener.stop()
@@ -0,0 +1,38 @@
+from smsbot.utils.render import MarkdownV2Renderer, escape_markdownv2
+from smsbot.utils.twilio import TwilioMessage
+
+# A 10 segment SMS, the longest Twilio will concatenate, with plenty of characters to escape
+BODY = ("Your verification code is 123-456. Don't share it! (Expires in 10 mins) #secure " * 20)[:1530]
+MESSAGE = TwilioMessage({"From": "+1234567890", "To": "+0987654321", "Body": BODY})
+
+
+def escape_per_character(text: str) -> str:
+    """The previous escaper, one str.replace pass per special character"""
+    for char in ["_", "*", "[", "]", "(", ")", "~", "`", ">", "#", "+", "-", "=", "|", "{", "}", ".", "!"]:
+        text = text.replace(char, rf"\{char}")
+    return text
+
+
+def render_per_character(message: TwilioMessage) -> str:
+    """The previous renderer built from repeated f-strings"""
+    media_str = "\n".join([f"{escape_per_character(url)}" for url in message.media]) if message.media else ""
+    msg = f"**From**: {escape_per_character(message.from_number)}\n"
+    msg += f"**To**: {escape_per_character(message.to_number)}\n\n"
+    msg += f"{escape_per_character(message.body)}\n\n{media_str}"
+    return msg
+
+
+def test_bench_escape_per_character(benchmark):
+    benchmark(escape_per_character, BODY)
+
+
+def test_bench_escape_markdownv2(benchmark):
+    benchmark(escape_markdownv2, BODY)
+
+
+def test_bench_render_per_character(benchmark):
+    benchmark(render_per_character, MESSAGE)
+
+
+def test_bench_render_template(benchmark):
+    benchmark(MarkdownV2Renderer().render, MESSAGE)
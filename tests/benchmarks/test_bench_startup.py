@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+# Seconds allowed to import the CLI, it takes about half a second on a laptop so this leaves room for slow runners
+IMPORT_BUDGET = 2.0
+
+# Modules that should only be imported once they're used
+LAZY_MODULES = ["twilio.rest", "aiohttp"]
+
+
+def import_times(module: str) -> dict[str, float]:
+    """Import a module in a fresh interpreter, returning the cumulative import time of everything it imported"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1_000_000
+    return times
+
+
+def test_cli_import_time():
+    times = import_times("smsbot.cli")
+    assert times["smsbot.cli"] < IMPORT_BUDGET
+
+
+def test_optional_modules_imported_lazily():
+    times = import_times("smsbot.cli")
+    assert [module for module in LAZY_MODULES if module in times] == []
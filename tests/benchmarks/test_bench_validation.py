@@ -0,0 +1,33 @@
+from twilio.request_validator import RequestValidator
+
+from smsbot.utils.asgi import Request
+from smsbot.validation import TwilioSignatureValidator
+
+DATA = {"SmsMessageSid": "SM123", "From": "+1234567890", "To": "+0987654321", "Body": "Hello " * 50}
+URL = "https://sms.example.com/message"
+
+
+def make_request():
+    signature = RequestValidator("token").compute_signature(URL, DATA)
+    body = "&".join(f"{key}={value}" for key, value in DATA.items()).replace("+", "%2B").encode()
+    headers = [
+        (b"host", b"sms.example.com"),
+        (b"content-type", b"application/x-www-form-urlencoded"),
+        (b"x-twilio-signature", signature.encode()),
+    ]
+    return Request({"type": "http", "method": "POST", "path": "/message", "scheme": "https", "headers": headers}, body)
+
+
+def test_bench_request_validator_per_request(benchmark):
+    request = make_request()
+
+    def validate():
+        return RequestValidator("token").validate(request.url, request.form, request.headers["x-twilio-signature"])
+
+    assert benchmark(validate)
+
+
+def test_bench_cached_validator(benchmark):
+    request = make_request()
+    validator = TwilioSignatureValidator(["token"], public_url="https://sms.example.com")
+    assert benchmark(validator.validate, request)
@@ -0,0 +1,23 @@
+import asyncio
+
+import pytest
+from loadtest import percentile, run_loadtest
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([1.0], 95) == 1.0
+    assert percentile([], 50) is None
+
+
+@pytest.mark.parametrize("queue", [False, True])
+def test_loadtest(queue):
+    results = asyncio.run(run_loadtest(rate=20, duration=0.5, subscribers=2, queue=queue, drain_timeout=10))
+    assert results["requests"] == 10
+    assert results["errors"] == 0
+    assert results["undelivered"] == 0
+    latency = results["webhook_latency_ms"]
+    assert latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+    assert results["delivery_latency_ms"]["p50"] is not None
@@ -0,0 +1,47 @@
+from smsbot.admission import AdmissionControl
+
+
+def test_in_flight_limit():
+    admission = AdmissionControl(max_in_flight=2)
+    assert admission.acquire()
+    assert admission.acquire()
+    assert not admission.acquire()
+    admission.release()
+    assert admission.acquire()
+
+
+def test_no_in_flight_limit():
+    admission = AdmissionControl(max_in_flight=0)
+    assert all(admission.acquire() for _ in range(1000))
+
+
+def test_sender_limit():
+    admission = AdmissionControl(sender_limit=2, sender_window=60)
+    assert admission.check_sender("+441234567890", now=0) == 0
+    assert admission.check_sender("+441234567890", now=1) == 0
+    assert admission.check_sender("+441234567890", now=2) == 1
+    assert admission.check_sender("+441234567890", now=3) == 2
+    # Other senders have their own counters
+    assert admission.check_sender("+15005550006", now=3) == 0
+
+
+def test_sender_window_slides():
+    admission = AdmissionControl(sender_limit=2, sender_window=60)
+    admission.check_sender("+441234567890", now=50)
+    admission.check_sender("+441234567890", now=55)
+    assert admission.check_sender("+441234567890", now=56) == 1
+    # Early in the next window most of the previous window still counts
+    assert admission.check_sender("+441234567890", now=61) == 0
+    assert admission.check_sender("+441234567890", now=62) == 1
+    # By the end of it little does
+    assert admission.check_sender("+441234567890", now=119) == 0
+    # Two windows later the counts are gone
+    assert admission.check_sender("+441234567890", now=300) == 0
+
+
+def test_senders_bounded():
+    admission = AdmissionControl(sender_limit=1, max_senders=2)
+    for sender in ["+1", "+2", "+3"]:
+        admission.check_sender(sender, now=0)
+    assert len(admission.senders) == 2
+    assert admission.check_sender("+1", now=0) == 0
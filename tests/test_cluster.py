@@ -0,0 +1,110 @@
+import asyncio
+
+from smsbot.cluster import LeaderElection, Lease, SqliteLease
+from smsbot.dedupe import DedupeCache
+from smsbot.store import SqliteSubscriberStore
+
+
+def test_lease():
+    leases = {}
+    first = Lease("first", ttl=60, leases=leases)
+    second = Lease("second", ttl=60, leases=leases)
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+
+
+def test_lease_expires():
+    leases = {}
+    assert Lease("first", ttl=-1, leases=leases).acquire()
+    assert Lease("second", ttl=60, leases=leases).acquire()
+
+
+def test_sqlite_lease(tmp_path):
+    path = str(tmp_path / "cluster.db")
+    first = SqliteLease(path, "first", ttl=60)
+    second = SqliteLease(path, "second", ttl=60)
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    assert not first.acquire()
+
+
+def test_leader_election_fails_over():
+    leases = {}
+    events = []
+
+    def make_election(name):
+        async def elected():
+            events.append(("elected", name))
+
+        async def demoted():
+            events.append(("demoted", name))
+
+        return LeaderElection(Lease(name, ttl=0.2, leases=leases), elected, demoted, interval=0.02)
+
+    async def run():
+        first, second = make_election("first"), make_election("second")
+        first.start()
+        await asyncio.sleep(0.05)
+        second.start()
+        await asyncio.sleep(0.05)
+        assert first.leader and not second.leader
+
+        await first.stop()
+        await asyncio.sleep(0.05)
+        assert second.leader
+        await second.stop()
+
+    asyncio.run(run())
+    assert events == [("elected", "first"), ("demoted", "first"), ("elected", "second"), ("demoted", "second")]
+
+
+def test_shared_subscriber_store(tmp_path):
+    path = str(tmp_path / "cluster.db")
+    first = SqliteSubscriberStore(path, subscribers=[1], shared=True)
+    second = SqliteSubscriberStore(path, subscribers=[1], shared=True)
+    first.REFRESH_INTERVAL = second.REFRESH_INTERVAL = 0
+    assert first.subscribers == second.subscribers == {1}
+
+    first.add_subscriber(2)
+    assert second.subscribers == {1, 2}
+    assert not second.add_subscriber(2)
+    second.remove_subscriber(1)
+    assert first.subscribers == {2}
+
+
+def test_shared_subscriber_store_refresh_interval(tmp_path):
+    path = str(tmp_path / "cluster.db")
+    first = SqliteSubscriberStore(path, shared=True)
+    second = SqliteSubscriberStore(path, shared=True)
+    second.REFRESH_INTERVAL = 60
+    assert second.subscribers == set()
+    first.add_subscriber(1)
+
+    # Reads within the interval don't query the version, so the change is seen once it has passed
+    assert second.subscribers == set()
+    second.next_refresh = 0
+    assert second.subscribers == {1}
+
+
+def test_shared_dedupe(tmp_path):
+    path = str(tmp_path / "cluster.db")
+    first = DedupeCache(path=path, shared=True)
+    second = DedupeCache(path=path, shared=True)
+
+    async def run():
+        assert not await first.seen("SM1")
+        assert await second.seen("SM1")
+        assert not await second.seen("SM2")
+        assert await first.seen("SM2")
+
+        # The replica that failed to process a webhook lets the retry through on any replica
+        await second.forget("SM2")
+        assert not await first.seen("SM2")
+
+    asyncio.run(run())
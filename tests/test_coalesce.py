@@ -0,0 +1,107 @@
+import asyncio
+
+from smsbot.coalesce import Coalescer
+from smsbot.utils.twilio import TwilioCall, TwilioMessage
+
+
+def message(body, sender="+111", to="+999"):
+    return TwilioMessage({"SmsMessageSid": f"SM{body}", "From": sender, "To": to, "Body": body})
+
+
+def run(coalescer, payloads, wait=0.0):
+    async def main():
+        for payload in payloads:
+            await coalescer.add(payload)
+        await asyncio.sleep(wait)
+        await coalescer.stop()
+
+    asyncio.run(main())
+
+
+def test_coalescer_combines_burst():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append(payload)
+
+    run(Coalescer(flush, window=0.05), [message("one"), message("two")], wait=0.1)
+    assert len(flushed) == 1
+    assert flushed[0].body == "one\n\ntwo"
+
+
+def test_coalescer_keys_by_sender():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append(payload)
+
+    run(Coalescer(flush, window=0.05), [message("one", "+111"), message("two", "+222")], wait=0.1)
+    assert sorted(payload.body for payload in flushed) == ["one", "two"]
+
+
+def test_coalescer_keys_by_destination():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append(payload)
+
+    run(Coalescer(flush, window=0.05, key="to"), [message("one", "+111"), message("two", "+222")], wait=0.1)
+    assert len(flushed) == 1
+    assert flushed[0].body == "+111: one\n\n+222: two"
+    assert flushed[0].from_number == "Multiple senders"
+
+
+def test_coalescer_keys_by_route():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append((payload.body, chats))
+
+    async def main():
+        coalescer = Coalescer(flush, window=0.05)
+        await coalescer.add(message("one"), {5})
+        await coalescer.add(message("two"), {6})
+        await coalescer.add(message("three"), {5})
+        await coalescer.add(message("four"))
+        await asyncio.sleep(0.1)
+        await coalescer.stop()
+
+    asyncio.run(main())
+    assert sorted(flushed, key=lambda item: item[0]) == [("four", None), ("one\n\nthree", {5}), ("two", {6})]
+
+
+def test_coalescer_max_batch():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append(payload)
+
+    run(Coalescer(flush, window=10, max_batch=2), [message("one"), message("two"), message("three")])
+    assert [payload.body for payload in flushed] == ["one\n\ntwo", "three"]
+
+
+def test_coalescer_max_latency():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append(payload)
+
+    async def main():
+        coalescer = Coalescer(flush, window=0.05, max_latency=0.1)
+        for i in range(6):
+            await coalescer.add(message(str(i)))
+            await asyncio.sleep(0.03)
+        await coalescer.stop()
+
+    asyncio.run(main())
+    assert len(flushed) >= 2
+
+
+def test_coalescer_passes_calls_through():
+    flushed = []
+
+    async def flush(payload, chats):
+        flushed.append(payload)
+
+    run(Coalescer(flush, window=10), [TwilioCall({"CallSid": "CA1", "From": "+111"})])
+    assert isinstance(flushed[0], TwilioCall)
@@ -0,0 +1,60 @@
+import asyncio
+
+from smsbot.dedupe import DedupeCache
+
+
+def test_dedupe_cache():
+    cache = DedupeCache()
+
+    async def run():
+        return [await cache.seen("SM1"), await cache.seen("SM1"), await cache.seen("SM2")]
+
+    assert asyncio.run(run()) == [False, True, False]
+
+
+def test_dedupe_cache_ttl():
+    cache = DedupeCache(ttl=-1)
+
+    async def run():
+        return [await cache.seen("SM1"), await cache.seen("SM1")]
+
+    assert asyncio.run(run()) == [False, False]
+
+
+def test_dedupe_cache_bounded():
+    cache = DedupeCache(max_size=2)
+
+    async def run():
+        for sid in ["SM1", "SM2", "SM3"]:
+            await cache.seen(sid)
+        assert len(cache) == 2
+        return await cache.seen("SM1")
+
+    assert not asyncio.run(run())
+
+
+def test_dedupe_cache_forget():
+    cache = DedupeCache()
+
+    async def run():
+        await cache.seen("SM1")
+        await cache.forget("SM1")
+        return await cache.seen("SM1")
+
+    assert not asyncio.run(run())
+
+
+def test_dedupe_cache_persists(tmp_path):
+    path = str(tmp_path / "dedupe.db")
+    asyncio.run(DedupeCache(path=path).seen("SM1"))
+    assert asyncio.run(DedupeCache(path=path).seen("SM1"))
+
+
+def test_dedupe_cache_concurrent_retry(tmp_path):
+    cache = DedupeCache(path=str(tmp_path / "dedupe.db"))
+
+    async def run():
+        return await asyncio.gather(cache.seen("SM1"), cache.seen("SM1"))
+
+    # The retry arrives while the first is still being written, and is still seen
+    assert sorted(asyncio.run(run())) == [False, True]
@@ -0,0 +1,139 @@
+import asyncio
+
+from telegram.error import Forbidden, NetworkError
+
+from smsbot.delivery import DeliveryQueue
+from smsbot.fanout import FanOut
+from smsbot.health import ChatHealth
+from smsbot.telegram import TelegramSmsBot
+from smsbot.utils.twilio import TwilioMessage
+from smsbot.webhook import TwilioWebhookHandler
+
+MESSAGE = {"SmsMessageSid": "SM123", "From": "+1234567890", "To": "+0987654321", "Body": "Hello"}
+
+
+def test_delivery_queue_delivers(tmp_path):
+    delivered = []
+
+    async def deliver(payload):
+        delivered.append(payload)
+
+    async def run():
+        queue = DeliveryQueue(str(tmp_path / "queue.db"), workers=2)
+        await queue.start(deliver)
+        await queue.put(TwilioMessage(MESSAGE))
+        await queue.queue.join()
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(run())
+    assert len(delivered) == 1
+    assert delivered[0].body == "Hello"
+    assert queue.pending == {}
+
+
+def test_delivery_queue_survives_restart(tmp_path):
+    path = str(tmp_path / "queue.db")
+    delivered = []
+
+    async def never(payload):
+        await asyncio.Event().wait()
+
+    async def deliver(payload):
+        delivered.append(payload)
+
+    async def run():
+        queue = DeliveryQueue(path)
+        await queue.start(never)
+        await queue.put(TwilioMessage(MESSAGE))
+        await queue.stop()
+
+        queue = DeliveryQueue(path)
+        await queue.start(deliver)
+        await queue.queue.join()
+        await queue.stop()
+
+    asyncio.run(run())
+    assert len(delivered) == 1
+    assert delivered[0].sid == "SM123"
+
+
+def test_delivery_queue_retries(tmp_path):
+    attempts = []
+
+    async def flaky(payload):
+        attempts.append(payload)
+        if len(attempts) < 2:
+            raise RuntimeError("Telegram unavailable")
+
+    async def run():
+        queue = DeliveryQueue(str(tmp_path / "queue.db"), retry_delay=0.01)
+        await queue.start(flaky)
+        await queue.put(TwilioMessage(MESSAGE))
+        while queue.pending:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert len(attempts) == 2
+
+
+def test_delivery_queue_keeps_message_for_skipped_chats(tmp_path):
+    health = ChatHealth(backoff=0.2)
+    bot = TelegramSmsBot("123:abc", subscribers=[2], fanout=FanOut(1000, 1000, backoff=0), health=health)
+    handler = TwilioWebhookHandler()
+    handler.set_telegram_application(bot)
+    sent = []
+
+    async def send_message(chat_id, text):
+        if len(sent) < 3:
+            sent.append(None)
+            raise NetworkError("Telegram unavailable")
+        sent.append(chat_id)
+
+    bot.send_message = send_message
+
+    async def run():
+        queue = DeliveryQueue(str(tmp_path / "queue.db"), max_attempts=2, retry_delay=0.01)
+        await queue.start(handler.deliver)
+        await queue.put(TwilioMessage(MESSAGE))
+        # The first attempt fails and backs the chat off, the retry skips it and the message is kept
+        await asyncio.sleep(0.1)
+        assert sent == [None, None, None]
+        assert queue.pending
+        rows = await queue._run(lambda: queue.connection.execute("SELECT attempts FROM deliveries").fetchall())
+        assert rows == [(1,)]
+        while queue.pending:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert sent[-1] == 2
+
+
+def test_delivery_queue_drops_message_deferred_too_long(tmp_path):
+    health = ChatHealth()
+    bot = TelegramSmsBot("123:abc", subscribers=[2], fanout=FanOut(1000, 1000), health=health)
+    handler = TwilioWebhookHandler()
+    handler.set_telegram_application(bot)
+
+    async def send_message(chat_id, text):
+        raise Forbidden("bot was blocked by the user")
+
+    bot.send_message = send_message
+
+    async def run():
+        # The chat is suspended, so the message can never be delivered
+        await bot.send_subscribers("Hello")
+        queue = DeliveryQueue(str(tmp_path / "queue.db"), retry_delay=0.01, max_defer=0.2)
+        await queue.start(handler.deliver)
+        await queue.put(TwilioMessage(MESSAGE))
+        await asyncio.sleep(0.1)
+        assert queue.pending
+        while queue.pending:
+            await asyncio.sleep(0.01)
+        rows = await queue._run(lambda: queue.connection.execute("SELECT id FROM deliveries").fetchall())
+        await queue.stop()
+        return rows
+
+    assert asyncio.run(run()) == []
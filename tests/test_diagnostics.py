@@ -0,0 +1,70 @@
+import asyncio
+import threading
+from time import monotonic
+
+from smsbot.diagnostics import Diagnostics, sample
+
+
+def spin(seconds):
+    end = monotonic() + seconds
+    while monotonic() < end:
+        pass
+
+
+def test_sample_collapses_stacks():
+    thread = threading.Thread(target=spin, args=(0.3,))
+    thread.start()
+    stacks = sample(thread.ident, 0.1, 0.005)
+    thread.join()
+    assert stacks
+    stack = stacks.most_common(1)[0][0]
+    assert stack.split(";")[-1].startswith("spin (tests/test_diagnostics.py:")
+
+
+def test_profile_samples_event_loop():
+    diagnostics = Diagnostics("token")
+
+    async def busy():
+        await asyncio.sleep(0.01)
+        spin(0.2)
+
+    async def run():
+        task = asyncio.create_task(busy())
+        profile = await diagnostics.profile(0.3)
+        await task
+        return profile
+
+    profile = asyncio.run(run())
+    lines = profile.splitlines()
+    assert any(".<locals>.busy (" in line and ";spin (" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+def test_profile_limited():
+    diagnostics = Diagnostics("token", max_seconds=0.05)
+    start = monotonic()
+    asyncio.run(diagnostics.profile(10))
+    assert monotonic() - start < 1
+
+
+def test_tasks_have_ages():
+    diagnostics = Diagnostics("token")
+
+    async def waiting():
+        await asyncio.Event().wait()
+
+    async def run():
+        diagnostics.install(asyncio.get_running_loop())
+        task = asyncio.create_task(waiting(), name="waiting")
+        await asyncio.sleep(0.05)
+        tasks = diagnostics.tasks()
+        task.cancel()
+        return tasks
+
+    tasks = asyncio.run(run())
+    waiting_task = next(task for task in tasks if task["name"] == "waiting")
+    assert waiting_task["coroutine"] == "test_tasks_have_ages.<locals>.waiting"
+    assert waiting_task["age"] >= 0.04
+    assert waiting_task["stack"][0].startswith("test_tasks_have_ages.<locals>.waiting")
+    # The main task was created before the factory was installed
+    assert tasks[-1]["age"] is None
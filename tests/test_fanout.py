@@ -0,0 +1,69 @@
+import asyncio
+from time import monotonic
+
+from prometheus_client import REGISTRY
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+from smsbot.fanout import FanOut, TokenBucket
+
+
+def test_token_bucket_rate():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return monotonic() - start
+
+    # One token available immediately, then five more at 50/s
+    assert asyncio.run(run()) >= 0.09
+
+
+def test_fanout_failing_chat_does_not_stop_others():
+    sent = []
+
+    async def send(chat_id):
+        if chat_id == 2:
+            raise BadRequest("Chat not found")
+        sent.append(chat_id)
+
+    results = asyncio.run(FanOut(global_rate=1000, chat_rate=1000).send([1, 2, 3], send))
+    assert sorted(sent) == [1, 3]
+    assert [result.ok for result in results] == [True, False, True]
+    assert isinstance(results[1].error, BadRequest)
+
+
+def test_fanout_honours_retry_after():
+    calls = []
+
+    async def send(chat_id):
+        calls.append(monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(0.1)
+
+    results = asyncio.run(FanOut(global_rate=1000, chat_rate=1000).send([1], send))
+    assert results[0].ok
+    assert results[0].attempts == 2
+    assert calls[1] - calls[0] >= 0.09
+
+
+def test_fanout_gives_up_after_max_attempts():
+    async def send(chat_id):
+        raise TimedOut()
+
+    results = asyncio.run(FanOut(global_rate=1000, chat_rate=1000, max_attempts=2, backoff=0.01).send([1], send))
+    assert not results[0].ok
+    assert results[0].attempts == 2
+
+
+def test_fanout_counts_outcomes():
+    def count(outcome):
+        return REGISTRY.get_sample_value("fanout_recipient_count_total", {"outcome": outcome}) or 0.0
+
+    async def send(chat_id):
+        if chat_id == 2:
+            raise BadRequest("Chat not found")
+
+    before = count("ok"), count("BadRequest")
+    asyncio.run(FanOut(global_rate=1000, chat_rate=1000).send([1, 2, 3], send))
+    assert (count("ok"), count("BadRequest")) == (before[0] + 2, before[1] + 1)
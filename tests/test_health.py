@@ -0,0 +1,49 @@
+from telegram.error import BadRequest, Forbidden, TimedOut
+
+from smsbot.fanout import FanOutResult
+from smsbot.health import ChatHealth
+
+
+def test_permanent_error_suspends():
+    health = ChatHealth(probe_interval=100)
+    assert health.record(FanOutResult(1, False, 1, Forbidden("bot was blocked by the user")), now=0)
+    assert health.is_suspended(1)
+    assert not health.available(1, now=50)
+    # One probe is let through once the interval has passed
+    assert health.available(1, now=100)
+    assert not health.available(1, now=101)
+    # A second failure doesn't suspend it again
+    assert not health.record(FanOutResult(1, False, 1, Forbidden("bot was blocked by the user")), now=101)
+
+
+def test_chat_not_found_suspends():
+    health = ChatHealth()
+    assert health.record(FanOutResult(1, False, 1, BadRequest("Chat not found")), now=0)
+
+
+def test_other_bad_requests_ignored():
+    health = ChatHealth()
+    assert not health.record(FanOutResult(1, False, 1, BadRequest("Can't parse entities")), now=0)
+    assert health.available(1, now=0)
+
+
+def test_transient_errors_back_off():
+    health = ChatHealth(backoff=10, max_backoff=25)
+    health.record(FanOutResult(1, False, 3, TimedOut()), now=0)
+    assert not health.is_suspended(1)
+    assert not health.available(1, now=9)
+    assert health.available(1, now=10)
+    health.record(FanOutResult(1, False, 3, TimedOut()), now=10)
+    assert not health.available(1, now=29)
+    assert health.available(1, now=30)
+    health.record(FanOutResult(1, False, 3, TimedOut()), now=30)
+    # Capped at the maximum backoff
+    assert health.available(1, now=55)
+
+
+def test_success_recovers():
+    health = ChatHealth()
+    health.record(FanOutResult(1, False, 1, Forbidden("blocked")), now=0)
+    health.record(FanOutResult(1, True, 1), now=1)
+    assert not health.is_suspended(1)
+    assert health.available(1, now=1)
@@ -0,0 +1,86 @@
+import asyncio
+from time import time
+
+from smsbot.history import MessageHistory, search_query
+from smsbot.utils.twilio import TwilioMessage
+
+
+def message(body, from_number="+1234567890", to_number="+0987654321"):
+    return TwilioMessage({"From": from_number, "To": to_number, "Body": body})
+
+
+def test_search_query():
+    assert search_query('code 12"3 (x') == '"code"* "12""3"* "(x"*'
+    assert search_query("  ") == ""
+
+
+def test_history_last_and_search(tmp_path):
+    async def run():
+        history = MessageHistory(str(tmp_path / "history.db"))
+        await history.start()
+        history.add(message("Your Acme code is 123456"))
+        history.add(message("Lunch at noon?", from_number="+447700900123"))
+        history.add(message("Your Widget code is 654321"))
+        await history.flush()
+        results = (
+            await history.last(2),
+            await history.search("code"),
+            await history.search("acme 123"),
+            await history.search("447700"),
+            await history.search("missing"),
+        )
+        await history.stop()
+        return results
+
+    last, code, acme, number, missing = asyncio.run(run())
+    assert [stored.body for stored in last] == ["Your Widget code is 654321", "Lunch at noon?"]
+    assert [stored.body for stored in code] == ["Your Widget code is 654321", "Your Acme code is 123456"]
+    assert [stored.body for stored in acme] == ["Your Acme code is 123456"]
+    assert [stored.body for stored in number] == ["Lunch at noon?"]
+    assert missing == []
+
+
+def test_history_batches_writes(tmp_path):
+    async def run():
+        history = MessageHistory(str(tmp_path / "history.db"), batch_size=2, flush_interval=60)
+        await history.start()
+        history.add(message("One"))
+        await asyncio.sleep(0.05)
+        before = await history.last()
+        history.add(message("Two"))
+        await asyncio.sleep(0.05)
+        after = await history.last()
+        # Anything still waiting is written on stop
+        history.add(message("Three"))
+        await history.stop()
+        return before, after
+
+    before, after = asyncio.run(run())
+    assert before == []
+    assert len(after) == 2
+
+    async def reopen():
+        history = MessageHistory(str(tmp_path / "history.db"))
+        await history.start()
+        stored = await history.last()
+        await history.stop()
+        return stored
+
+    assert len(asyncio.run(reopen())) == 3
+
+
+def test_history_retention(tmp_path):
+    async def run():
+        history = MessageHistory(str(tmp_path / "history.db"), max_messages=2, max_age=3600)
+        await history.start()
+        history.pending.append((time() - 7200, "+1", "+2", "Expired"))
+        for body in ["One", "Two", "Three"]:
+            history.add(message(body))
+        await history.flush()
+        results = await history.last(), await history.search("expired")
+        await history.stop()
+        return results
+
+    last, expired = asyncio.run(run())
+    assert [stored.body for stored in last] == ["Three", "Two"]
+    assert expired == []
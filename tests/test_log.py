@@ -0,0 +1,65 @@
+import io
+import json
+import logging
+
+import pytest
+
+from smsbot.utils.log import Body, setup_logging
+
+
+@pytest.fixture
+def restore_logging():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def log(stream, **kwargs):
+    listener = setup_logging(stream=stream, **kwargs)
+    logging.getLogger("test").info("Received SMS from %s: %s", "+441234567890", Body("Your code is 1234"))
+    listener.stop()
+    return stream.getvalue()
+
+
+def test_redacts_bodies_and_numbers(restore_logging):
+    output = log(io.StringIO())
+    assert "Your code is 1234" not in output
+    assert "<17 characters>" in output
+    assert "+441234567890" not in output
+    assert "+44********90" in output
+
+
+def test_no_redaction(restore_logging):
+    output = log(io.StringIO(), redact=False)
+    assert "Received SMS from +441234567890: Your code is 1234" in output
+
+
+def test_json_format(restore_logging):
+    record = json.loads(log(io.StringIO(), json_format=True))
+    assert record["level"] == "INFO"
+    assert record["logger"] == "test"
+    assert record["message"] == "Received SMS from +44********90: <17 characters>"
+
+
+def test_bad_log_call_keeps_listener(restore_logging):
+    stream = io.StringIO()
+    listener = setup_logging(stream=stream)
+    logging.getLogger("test").info("Bad %d from %s", "x")
+    logging.getLogger("test").info("Still logging %s", "+441234567890")
+    listener.stop()
+    output = stream.getvalue()
+    assert "Bad %d from %s" in output
+    assert "Still logging +44********90" in output
+
+
+def test_formats_on_listener_thread(restore_logging):
+    stream = io.StringIO()
+    listener = setup_logging(stream=stream, level=logging.INFO)
+    logging.getLogger("test").debug("Filtered %s", Body("not formatted"))
+    listener.stop()
+    assert stream.getvalue() == ""
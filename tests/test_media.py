@@ -0,0 +1,177 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+from telegram import InputFile, InputMediaPhoto, InputMediaVideo
+
+from smsbot.fanout import FanOut
+from smsbot.media import MediaRelay
+from smsbot.utils.twilio import TwilioMessage
+from smsbot.webhook import TwilioWebhookHandler
+
+CONTENT = {
+    "https://api.twilio.com/media/1": ("image/jpeg", b"jpeg" * 100),
+    "https://api.twilio.com/media/2": ("image/png", b"png" * 100),
+    "https://api.twilio.com/media/3": ("application/pdf", b"pdf" * 100),
+    "https://api.twilio.com/media/4": ("video/mp4", b"mp4" * 100),
+}
+
+
+class FakeBot:
+    def __init__(self, fail_groups=False):
+        self.calls = []
+        self.fail_groups = fail_groups
+
+    def message(self, file_id):
+        return SimpleNamespace(effective_attachment=(SimpleNamespace(file_id=file_id),))
+
+    async def send_media_group(self, chat_id, media):
+        self.calls.append(("group", chat_id, media))
+        if self.fail_groups:
+            raise RuntimeError("Upload failed")
+        return tuple(self.message(f"file{i}") for i, _ in enumerate(media))
+
+    async def send_photo(self, chat_id, photo):
+        self.calls.append(("photo", chat_id, photo))
+        return self.message("photo")
+
+    async def send_document(self, chat_id, document):
+        self.calls.append(("document", chat_id, document))
+        return SimpleNamespace(effective_attachment=SimpleNamespace(file_id="doc"))
+
+
+def make_relay(tmp_path, requests):
+    def handler(request):
+        requests.append(str(request.url))
+        if str(request.url) not in CONTENT:
+            return httpx.Response(404)
+        content_type, body = CONTENT[str(request.url)]
+        return httpx.Response(200, headers={"content-type": content_type}, content=body)
+
+    relay = MediaRelay(str(tmp_path))
+    relay._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return relay
+
+
+def test_media_relay_uploads_once(tmp_path):
+    requests = []
+    relay = make_relay(tmp_path, requests)
+    bot = FakeBot()
+    telegram_app = SimpleNamespace(
+        app=SimpleNamespace(bot=bot), subscribers=[1, 2, 3], fanout=FanOut(1000, 1000), available=list
+    )
+
+    unsent = asyncio.run(relay.relay(list(CONTENT), telegram_app))
+    assert unsent == []
+    assert len(requests) == 4
+
+    # Photos and the video share a group uploaded to the first chat, everyone else gets the file IDs
+    groups = [call for call in bot.calls if call[0] == "group"]
+    assert groups[0][1] == 1
+    assert [type(item) for item in groups[0][2]] == [InputMediaPhoto, InputMediaPhoto, InputMediaVideo]
+    assert all(isinstance(item.media, InputFile) and item.media.attach_name for item in groups[0][2])
+    assert sorted(call[1] for call in groups[1:]) == [2, 3]
+    assert all([item.media for item in call[2]] == ["file0", "file1", "file2"] for call in groups[1:])
+
+    # The PDF is sent on its own as a document
+    documents = [call for call in bot.calls if call[0] == "document"]
+    assert [call[2] for call in documents[1:]] == ["doc", "doc"]
+
+
+def test_media_relay_cache(tmp_path):
+    requests = []
+    relay = make_relay(tmp_path, requests)
+
+    async def run():
+        first = await relay.download("https://api.twilio.com/media/1")
+        second = await relay.download("https://api.twilio.com/media/1")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert len(requests) == 1
+    assert first.path == second.path
+    assert second.kind == "photo"
+
+
+def test_media_relay_evicts(tmp_path):
+    requests = []
+    relay = make_relay(tmp_path, requests)
+    relay.cache_size = 500
+
+    async def run():
+        for url in CONTENT:
+            await relay.download(url)
+
+    asyncio.run(run())
+    assert sum(path.stat().st_size for path in tmp_path.iterdir() if not path.suffix) <= 500
+
+
+def test_undownloaded_media_linked(tmp_path):
+    relay = make_relay(tmp_path, [])
+    bot = FakeBot()
+    sent = []
+
+    async def send_subscribers(text):
+        sent.append(text)
+        return []
+
+    telegram_app = SimpleNamespace(
+        app=SimpleNamespace(bot=bot),
+        subscribers=[1],
+        fanout=FanOut(1000, 1000),
+        available=list,
+        send_subscribers=send_subscribers,
+    )
+    handler = TwilioWebhookHandler(media_relay=relay)
+    handler.set_telegram_application(telegram_app)
+    message = TwilioMessage(
+        {
+            "SmsMessageSid": "SM1",
+            "Body": "Photos",
+            "NumMedia": "2",
+            "MediaUrl0": "https://api.twilio.com/media/1",
+            "MediaUrl1": "https://api.twilio.com/media/missing",
+        }
+    )
+    asyncio.run(handler.deliver(message))
+
+    # The missing file is linked, the other is only sent as a file
+    assert "media/missing" in sent[0]
+    assert "media/1" not in sent[0]
+    assert [(kind, chat_id) for kind, chat_id, _ in bot.calls] == [("photo", 1)]
+
+
+def test_unsent_media_linked(tmp_path):
+    relay = make_relay(tmp_path, [])
+    bot = FakeBot(fail_groups=True)
+    sent = []
+
+    async def send_subscribers(text):
+        sent.append(text)
+        return []
+
+    telegram_app = SimpleNamespace(
+        app=SimpleNamespace(bot=bot),
+        subscribers=[1, 2],
+        fanout=FanOut(1000, 1000),
+        available=list,
+        send_subscribers=send_subscribers,
+    )
+    handler = TwilioWebhookHandler(media_relay=relay)
+    handler.set_telegram_application(telegram_app)
+    message = TwilioMessage(
+        {
+            "SmsMessageSid": "SM1",
+            "Body": "Photos",
+            "NumMedia": "2",
+            "MediaUrl0": "https://api.twilio.com/media/1",
+            "MediaUrl1": "https://api.twilio.com/media/2",
+        }
+    )
+    asyncio.run(handler.deliver(message))
+
+    # Every chat refused the upload, so the media is linked after the message
+    assert [call[1] for call in bot.calls] == [1, 2]
+    assert len(sent) == 2
+    assert "media/1" not in sent[0]
+    assert "media/1" in sent[1] and "media/2" in sent[1]
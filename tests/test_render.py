@@ -0,0 +1,67 @@
+import pytest
+
+from smsbot.utils.render import MarkdownV2Renderer, MessageTemplate, escape_markdownv2, split_message
+from smsbot.utils.twilio import TwilioCall, TwilioMessage
+
+
+def test_escape_markdownv2():
+    assert escape_markdownv2("Hello.World!") == "Hello\\.World\\!"
+    assert escape_markdownv2("a_b*c[d]") == "a\\_b\\*c\\[d\\]"
+    assert escape_markdownv2("back\\slash") == "back\\\\slash"
+
+
+def test_message_template():
+    template = MessageTemplate("*Hi* $name, $$5 ${thing}\\.")
+    assert template.render({"name": "J.R.", "thing": "(ok)"}) == "*Hi* J\\.R\\., $5 \\(ok\\)\\."
+
+
+def test_message_template_invalid():
+    with pytest.raises(ValueError):
+        MessageTemplate("Hello $")
+
+
+def test_render_message():
+    message = TwilioMessage(
+        {
+            "From": "+1234567890",
+            "To": "+0987654321",
+            "Body": "Your code is 1234.",
+            "NumMedia": "1",
+            "MediaUrl0": "http://example.com/media1.jpg",
+        }
+    )
+    assert message.to_markdownv2() == (
+        "*From*: \\+1234567890\n*To*: \\+0987654321\n\nYour code is 1234\\.\n\nhttp://example\\.com/media1\\.jpg"
+    )
+
+
+def test_render_call():
+    call = TwilioCall({"From": "+1234567890", "To": "+0987654321"})
+    assert MarkdownV2Renderer().render(call) == ["Call from \\+1234567890, rejected\\."]
+
+
+def test_render_custom_template():
+    renderer = MarkdownV2Renderer(message_template="$from_number: $body")
+    message = TwilioMessage({"From": "+1", "Body": "Hi!"})
+    assert renderer.render(message) == ["\\+1: Hi\\!"]
+
+
+def test_split_message_on_newlines():
+    text = "\n".join(["x" * 30] * 10)
+    chunks = split_message(text, limit=100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert "\n".join(chunks) == text
+
+
+def test_split_message_keeps_escapes():
+    text = "a" * 99 + "\\." + "b" * 10
+    chunks = split_message(text, limit=100)
+    assert chunks[0] == "a" * 99
+    assert chunks[1].startswith("\\.")
+
+
+def test_split_message_long_body():
+    message = TwilioMessage({"From": "+1", "To": "+2", "Body": "Hello world. " * 1000})
+    chunks = MarkdownV2Renderer().render(message)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 4096 for chunk in chunks)
@@ -0,0 +1,38 @@
+import pytest
+
+from smsbot.routing import PrefixTrie, Router, parse_rules
+from smsbot.utils.twilio import TwilioCall, TwilioMessage
+
+
+def message(from_number="+447700900123", to_number="+15005550001", body="Hello"):
+    return TwilioMessage({"SmsMessageSid": "SM1", "From": from_number, "To": to_number, "Body": body})
+
+
+def test_parse_rules():
+    assert parse_rules("+15005550001: 1 2, +15005550002: -100, +15005550001: 3") == {
+        "+15005550001": {1, 2, 3},
+        "+15005550002": {-100},
+    }
+    assert parse_rules("") == {}
+    with pytest.raises(ValueError):
+        parse_rules("+15005550001")
+
+
+def test_prefix_trie():
+    trie = PrefixTrie({"+44": [1], "+447700": [2], "+1": [3]})
+    assert trie.match("+447700900123") == {1, 2}
+    assert trie.match("+441632960000") == {1}
+    assert trie.match("+33123456789") == set()
+
+
+def test_router_combines_rules():
+    router = Router(to={"+15005550001": [1]}, from_prefixes={"+44": [2]}, keywords={"OTP": [3]})
+    assert router.route(message()) == {1, 2}
+    assert router.route(message(body="Your otp is 1234")) == {1, 2, 3}
+    assert router.route(message(from_number="+33123456789", to_number="+15005550009", body="otp")) == {3}
+    assert router.route(TwilioCall({"CallSid": "CA1", "From": "+447700900123", "To": "+1"})) == {2}
+
+
+def test_router_fallback():
+    assert Router(to={"+15005550009": [1]}).route(message()) is None
+    assert Router(to={"+15005550009": [1]}, fallback=False).route(message()) == set()
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from smsbot.sms import OutboundSms
+from smsbot.utils.twilio import TwilioMessageStatus
+
+
+class FakeMessages:
+    def __init__(self):
+        self.sent = []
+        self.threads = set()
+
+    def create(self, body, to, from_, status_callback=None):
+        self.threads.add(threading.current_thread().name)
+        self.status_callback = status_callback
+        if to == "+100":
+            raise RuntimeError("Invalid number")
+        self.sent.append((to, body, from_))
+        return SimpleNamespace(sid=f"SM{len(self.sent)}")
+
+
+def make_sms(**kwargs):
+    messages = FakeMessages()
+    client = SimpleNamespace(messages=messages, http_client=None)
+    return OutboundSms(from_number="+999", client=client, **kwargs), messages
+
+
+def test_outbound_sms_runs_off_loop():
+    sms, messages = make_sms()
+    sid = asyncio.run(sms.send("+123", "Hello"))
+    assert sid == "SM1"
+    assert messages.sent == [("+123", "Hello", "+999")]
+    assert all(name.startswith("twilio") for name in messages.threads)
+
+
+def test_outbound_sms_send_many():
+    sms, messages = make_sms(concurrency=2)
+    results = asyncio.run(sms.send_many(["+123", "+100", "+456"], "Hello"))
+    assert isinstance(results["+100"], RuntimeError)
+    assert sorted(to for to, _, _ in messages.sent) == ["+123", "+456"]
+
+
+def test_outbound_sms_tracks_status():
+    sms, messages = make_sms(status_callback="https://sms.example.com/status", max_pending=2)
+    asyncio.run(sms.send_many(["+123", "+456", "+789"], "Hello", chat_id=-100))
+    assert messages.status_callback == "https://sms.example.com/status"
+    # Only the most recent sends are kept
+    assert len(sms.pending) == 2
+
+    sid = next(iter(sms.pending))
+    pending = sms.update_status(TwilioMessageStatus({"MessageSid": sid, "MessageStatus": "sent"}))
+    assert pending.chat_id == -100
+    assert pending.status == "sent"
+    assert sid in sms.pending
+    sms.update_status(TwilioMessageStatus({"MessageSid": sid, "MessageStatus": "delivered"}))
+    assert sid not in sms.pending
+    assert sms.update_status(TwilioMessageStatus({"MessageSid": "SM999", "MessageStatus": "failed"})) is None
+
+
+def test_outbound_sms_untracked_without_callback():
+    sms, messages = make_sms()
+    asyncio.run(sms.send("+123", "Hello", chat_id=-100))
+    assert messages.status_callback is None
+    assert sms.pending == {}
@@ -0,0 +1,45 @@
+from smsbot.store import SqliteSubscriberStore, SubscriberStore
+
+
+def test_subscriber_store():
+    store = SubscriberStore(owners=[1], subscribers=[2])
+    assert store.is_owner(1)
+    assert not store.is_owner(2)
+    assert store.add_subscriber(3)
+    assert not store.add_subscriber(3)
+    assert store.subscribers == {2, 3}
+    assert store.remove_subscriber(2)
+    assert not store.remove_subscriber(2)
+
+
+def test_subscriber_store_defaults_not_shared():
+    first = SubscriberStore()
+    first.add_subscriber(1)
+    assert SubscriberStore().subscribers == set()
+
+
+def test_sqlite_subscriber_store_persists(tmp_path):
+    path = str(tmp_path / "subscribers.db")
+    store = SqliteSubscriberStore(path, owners=[1], subscribers=[2])
+    store.add_subscriber(3)
+    store.add_subscriber(4)
+    store.remove_subscriber(4)
+
+    store = SqliteSubscriberStore(path, owners=[1])
+    assert store.subscribers == {2, 3}
+    assert store.owners == {1}
+
+
+def test_sqlite_subscriber_store_keeps_unsubscribes(tmp_path):
+    path = str(tmp_path / "subscribers.db")
+    store = SqliteSubscriberStore(path, subscribers=[2, 3])
+    assert store.remove_subscriber(2)
+
+    # The config still lists chat 2, but it unsubscribed
+    store = SqliteSubscriberStore(path, subscribers=[2, 3, 4])
+    assert store.subscribers == {3, 4}
+
+    store.add_subscriber(2)
+    store.remove_subscriber(3)
+    store = SqliteSubscriberStore(path, subscribers=[2, 3, 4])
+    assert store.subscribers == {2, 4}
@@ -0,0 +1,210 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import REGISTRY
+from telegram.error import Forbidden, TimedOut
+
+from smsbot.fanout import FanOut
+from smsbot.history import StoredMessage
+from smsbot.sms import OutboundSms, PendingSend
+from smsbot.telegram import TelegramSmsBot
+from smsbot.utils.twilio import TwilioMessageStatus
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+
+    async def reply_markdown(self, text):
+        self.replies.append(text)
+
+
+class FakeOutboundSms:
+    def __init__(self):
+        self.sent = []
+        self.chats = []
+
+    async def send_many(self, recipients, body, chat_id=None):
+        self.sent.append((recipients, body))
+        self.chats.append(chat_id)
+        return {to: "SM1" for to in recipients}
+
+
+def make_update(text, user_id=1, chat_id=1):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username="user"),
+        effective_chat=SimpleNamespace(id=chat_id),
+        message=FakeMessage(text),
+    )
+
+
+def test_handler_sms_multiple_recipients():
+    sms = FakeOutboundSms()
+    bot = TelegramSmsBot("123:abc", outbound_sms=sms, owners=[1])
+    update = make_update("/sms +111,+222 Hello  there\nsecond line")
+    asyncio.run(bot.handler_sms(update, None))
+    assert sms.sent == [(["+111", "+222"], "Hello  there\nsecond line")]
+    assert sms.chats == [1]
+    assert update.message.replies == ["Sent SMS to +111, +222"]
+
+
+def test_handler_sms_usage():
+    sms = FakeOutboundSms()
+    bot = TelegramSmsBot("123:abc", outbound_sms=sms, owners=[1])
+    for text in ["/sms +111", "/sms , hello"]:
+        update = make_update(text)
+        asyncio.run(bot.handler_sms(update, None))
+        assert update.message.replies[0].startswith("Usage")
+    assert sms.sent == []
+
+
+def test_handler_sms_not_configured():
+    bot = TelegramSmsBot("123:abc", owners=[1])
+    update = make_update("/sms +111 Hello")
+    asyncio.run(bot.handler_sms(update, None))
+    assert "not configured" in update.message.replies[0]
+
+
+def test_handler_time_includes_awaits():
+    class SlowMessage(FakeMessage):
+        async def reply_text(self, text):
+            await asyncio.sleep(0.05)
+            await super().reply_text(text)
+
+    def duration():
+        return REGISTRY.get_sample_value("telegram_request_processing_seconds_sum", {"command": "sms"}) or 0.0
+
+    bot = TelegramSmsBot("123:abc", outbound_sms=FakeOutboundSms(), owners=[1])
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1, username="user"), message=SlowMessage("/sms"))
+    before = duration()
+    asyncio.run(bot.handler_sms(update, None))
+    assert duration() - before >= 0.05
+
+
+class FakeHistory:
+    def __init__(self, messages):
+        self.messages = messages
+        self.queries = []
+
+    async def last(self, count=5):
+        self.queries.append(("last", count))
+        return self.messages[:count]
+
+    async def search(self, terms, count=10):
+        self.queries.append(("search", terms))
+        return self.messages
+
+
+def test_handler_last():
+    history = FakeHistory([StoredMessage(0, "+111", "+222", "Code 1234"), StoredMessage(0, "+333", "+222", "Hi")])
+    bot = TelegramSmsBot("123:abc", owners=[1], history=history)
+    update = make_update("/last 1")
+    asyncio.run(bot.handler_last(update, None))
+    assert history.queries == [("last", 1)]
+    assert len(update.message.replies) == 1
+    assert "from +111 to +222\nCode 1234" in update.message.replies[0]
+    assert "+333" not in update.message.replies[0]
+
+
+def test_handler_last_usage():
+    bot = TelegramSmsBot("123:abc", owners=[1], history=FakeHistory([]))
+    update = make_update("/last lots")
+    asyncio.run(bot.handler_last(update, None))
+    assert update.message.replies == ["Usage: /last [count]"]
+
+
+def test_handler_search():
+    history = FakeHistory([])
+    bot = TelegramSmsBot("123:abc", owners=[1], history=history)
+    update = make_update("/search acme  code")
+    asyncio.run(bot.handler_search(update, None))
+    assert history.queries == [("search", "acme code")]
+    assert update.message.replies == ["No messages found."]
+
+
+def test_handler_search_not_configured():
+    bot = TelegramSmsBot("123:abc", owners=[1])
+    update = make_update("/search code")
+    asyncio.run(bot.handler_search(update, None))
+    assert update.message.replies == ["Message history is not configured."]
+
+
+def test_sms_status_failed():
+    sms = OutboundSms(status_callback="https://sms.example.com/status")
+    sms.track("SM1", PendingSend(-100, "+111"))
+    sms.track("SM2", PendingSend(-100, "+222"))
+    bot = TelegramSmsBot("123:abc", outbound_sms=sms, owners=[1])
+    sent = []
+
+    async def send_message(chat_id, text):
+        sent.append((chat_id, text))
+
+    bot.send_message = send_message
+    failed = TwilioMessageStatus({"MessageSid": "SM2", "MessageStatus": "failed", "ErrorCode": "30003"})
+
+    async def run():
+        await bot.sms_status(TwilioMessageStatus({"MessageSid": "SM1", "MessageStatus": "sent"}))
+        await bot.sms_status(TwilioMessageStatus({"MessageSid": "SM1", "MessageStatus": "delivered"}))
+        await bot.sms_status(failed)
+
+    asyncio.run(run())
+    assert sent == [(-100, "SMS to \\+222 failed, Twilio error 30003")]
+    assert sms.pending == {}
+
+
+def test_sms_status_notify_retried():
+    sms = OutboundSms(status_callback="https://sms.example.com/status")
+    sms.track("SM1", PendingSend(-100, "+111"))
+    bot = TelegramSmsBot("123:abc", outbound_sms=sms, owners=[1])
+    sent = []
+
+    async def send_message(chat_id, text):
+        if not sent:
+            sent.append(None)
+            raise TimedOut()
+        sent.append((chat_id, text))
+
+    bot.send_message = send_message
+    failed = TwilioMessageStatus({"MessageSid": "SM1", "MessageStatus": "undelivered"})
+
+    # The first notification fails, Twilio's retry of the callback still reaches the chat
+    with pytest.raises(TimedOut):
+        asyncio.run(bot.sms_status(failed))
+    assert "SM1" in sms.pending
+    asyncio.run(bot.sms_status(failed))
+    assert sent[1] == (-100, "SMS to \\+111 undelivered")
+    assert sms.pending == {}
+
+
+def test_send_many_suspends_blocked_chats():
+    bot = TelegramSmsBot("123:abc", owners=[1], subscribers=[2, 3], fanout=FanOut(1000, 1000))
+    sent = []
+
+    async def send_message(chat_id, text):
+        if chat_id == 3:
+            raise Forbidden("bot was blocked by the user")
+        sent.append((chat_id, text))
+
+    bot.send_message = send_message
+
+    async def run():
+        first = await bot.send_subscribers("Hello")
+        second = await bot.send_subscribers("Again")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert [result.ok for result in sorted(first)] == [True, False]
+    # Chat 3 is skipped from then on, and the owner was told
+    assert [(result.chat_id, result.ok, result.attempts) for result in second] == [(2, True, 1), (3, False, 0)]
+    assert sent[1][0] == 1
+    assert "Suspended chat 3" in sent[1][1]
+
+    # Subscribing again makes it healthy
+    update = make_update("/subscribe", user_id=3)
+    asyncio.run(bot.handler_subscribe(update, None))
+    assert not bot.health.is_suspended(3)
@@ -1,4 +1,6 @@
-from smsbot.utils.twilio import TwilioMessage
+import pytest
+
+from smsbot.utils.twilio import TwilioCall, TwilioMessage, TwilioMessageStatus, TwilioWebhookPayload
 
 
 def test_twiliomessage_normal():
@@ -63,7 +65,49 @@ def test_twiliomessage_invalid_media_count_extra():
     assert instance.media == [
         "http://example.com/media1.jpg",
         "http://example.com/media2.jpg",
-        None,
-        None,
-        None,
     ]
+
+
+def test_twiliomessage_to_dict_roundtrip():
+    instance = TwilioMessage(
+        {
+            "SmsMessageSid": "SM123",
+            "From": "+1234567890",
+            "To": "+0987654321",
+            "Body": "Hello, world!",
+            "NumMedia": "1",
+            "MediaUrl0": "http://example.com/media1.jpg",
+        }
+    )
+
+    copy = TwilioMessage(instance.to_dict())
+    assert copy.sid == "SM123"
+    assert copy.body == instance.body
+    assert copy.media == instance.media
+
+
+def test_parse_message_status():
+    status = TwilioWebhookPayload.parse(
+        {"MessageSid": "SM1", "SmsSid": "SM1", "MessageStatus": "undelivered", "ErrorCode": "30005", "To": "+1"}
+    )
+    assert isinstance(status, TwilioMessageStatus)
+    assert status.sid == "SM1"
+    assert status.final
+    assert status.failed
+    assert status.error_code == "30005"
+    assert not TwilioMessageStatus({"MessageSid": "SM1", "MessageStatus": "sent"}).final
+
+
+def test_payloads_have_no_instance_dict():
+    for payload in [
+        TwilioMessage({"SmsMessageSid": "SM1"}),
+        TwilioCall({"CallSid": "CA1"}),
+        TwilioMessageStatus({"MessageSid": "SM1", "MessageStatus": "sent"}),
+    ]:
+        with pytest.raises(AttributeError):
+            payload.unexpected = True
+
+
+def test_twiliowebhookpayload_abstract():
+    with pytest.raises(TypeError):
+        TwilioWebhookPayload()
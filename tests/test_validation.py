@@ -0,0 +1,55 @@
+from twilio.request_validator import RequestValidator
+
+from smsbot.utils.asgi import Request
+from smsbot.validation import TwilioSignatureValidator
+
+DATA = {"SmsMessageSid": "SM123", "From": "+1234567890", "Body": "Hello"}
+
+
+def make_request(url_path="/message", headers=None, host="internal:8080", scheme="http"):
+    body = "&".join(f"{key}={value}" for key, value in DATA.items()).replace("+", "%2B").encode()
+    raw_headers = [(b"host", host.encode()), (b"content-type", b"application/x-www-form-urlencoded")]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), value.encode()))
+    scope = {"type": "http", "method": "POST", "path": url_path, "scheme": scheme, "headers": raw_headers}
+    return Request(scope, body)
+
+
+def sign(token, url):
+    return RequestValidator(token).compute_signature(url, DATA)
+
+
+def test_validator_direct_url():
+    validator = TwilioSignatureValidator(["token"])
+    request = make_request(headers={"X-Twilio-Signature": sign("token", "http://internal:8080/message")})
+    assert validator.validate(request)
+
+
+def test_validator_rejects_bad_signature():
+    validator = TwilioSignatureValidator(["token"])
+    assert not validator.validate(make_request(headers={"X-Twilio-Signature": "invalid"}))
+    assert not validator.validate(make_request())
+
+
+def test_validator_public_url():
+    validator = TwilioSignatureValidator(["token"], public_url="https://sms.example.com/")
+    request = make_request(headers={"X-Twilio-Signature": sign("token", "https://sms.example.com/message")})
+    assert validator.validate(request)
+
+
+def test_validator_forwarded_headers():
+    signature = sign("token", "https://sms.example.com/message")
+    headers = {"X-Twilio-Signature": signature, "X-Forwarded-Proto": "https", "X-Forwarded-Host": "sms.example.com"}
+    assert not TwilioSignatureValidator(["token"]).validate(make_request(headers=headers))
+    assert TwilioSignatureValidator(["token"], trust_forwarded=True).validate(make_request(headers=headers))
+
+
+def test_validator_token_rotation():
+    validator = TwilioSignatureValidator(["old", "new"])
+    for token in ["old", "new"]:
+        request = make_request(headers={"X-Twilio-Signature": sign(token, "http://internal:8080/message")})
+        assert validator.validate(request)
+
+    cached = validator.validators["new"]
+    validator.set_auth_tokens(["new"])
+    assert validator.validators == {"new": cached}
@@ -0,0 +1,371 @@
+import asyncio
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+from twilio.request_validator import RequestValidator
+
+from smsbot.admission import AdmissionControl
+from smsbot.coalesce import Coalescer
+from smsbot.dedupe import DedupeCache
+from smsbot.delivery import DeliveryQueue
+from smsbot.diagnostics import Diagnostics
+from smsbot.routing import Router
+from smsbot.telegram import TelegramSmsBot
+from smsbot.webhook import MAX_BODY_SIZE, TwilioWebhookHandler
+
+
+class FakeTelegramApp:
+    def __init__(self):
+        self.owners = [1]
+        self.subscribers = [2, 3]
+        self.sent = []
+
+    async def send_subscribers(self, text):
+        self.sent.append(text)
+
+    async def send_many(self, chat_ids, text):
+        self.sent.append((sorted(chat_ids), text))
+
+    async def send_owners(self, text):
+        self.sent.append((self.owners, text))
+
+    async def sms_status(self, status):
+        self.sent.append(status)
+
+
+def make_handler(**kwargs):
+    handler = TwilioWebhookHandler(**kwargs)
+    telegram_app = FakeTelegramApp()
+    handler.set_telegram_application(telegram_app)
+    return handler, telegram_app
+
+
+def request(handler, method, url, **kwargs):
+    async def run():
+        transport = httpx.ASGITransport(app=handler)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.request(method, url, **kwargs)
+
+    return asyncio.run(run())
+
+
+def test_index():
+    handler, _ = make_handler()
+    response = request(handler, "GET", "/")
+    assert response.status_code == 200
+    assert "smsbot v" in response.text
+
+
+def test_health():
+    handler, _ = make_handler()
+    response = request(handler, "GET", "/health")
+    assert response.status_code == 200
+    assert response.json()["subscribers"] == 2
+
+
+def test_unknown_route():
+    handler, _ = make_handler()
+    assert request(handler, "GET", "/missing").status_code == 404
+    assert request(handler, "GET", "/message").status_code == 405
+
+
+def test_metrics():
+    handler, _ = make_handler()
+    response = request(handler, "GET", "/metrics")
+    assert response.status_code == 200
+    assert "webhook_message_count" in response.text
+
+
+def test_message():
+    handler, telegram_app = make_handler()
+    response = request(
+        handler,
+        "POST",
+        "/message",
+        data={"SmsMessageSid": "SM123", "From": "+1234567890", "To": "+0987654321", "Body": "Hello"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/xml"
+    assert len(telegram_app.sent) == 1
+    assert "Hello" in telegram_app.sent[0]
+
+
+def test_message_metrics():
+    def count(name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    handler, _ = make_handler()
+    before = [
+        count("webhook_request_processing_seconds_count", {"handler": "message"}),
+        count("webhook_stage_seconds_count", {"stage": "parse"}),
+        count("webhook_stage_seconds_count", {"stage": "render"}),
+    ]
+    request(handler, "POST", "/message", data={"SmsMessageSid": "SM999", "From": "+1234567890", "Body": "Hello"})
+    assert [
+        count("webhook_request_processing_seconds_count", {"handler": "message"}),
+        count("webhook_stage_seconds_count", {"stage": "parse"}),
+        count("webhook_stage_seconds_count", {"stage": "render"}),
+    ] == [value + 1 for value in before]
+    assert count("webhook_requests_in_progress", {"handler": "message"}) == 0
+
+
+def test_message_routed():
+    handler, telegram_app = make_handler(
+        router=Router(to={"+0987654321": [5]}, from_prefixes={"+1234": [6]}, fallback=False)
+    )
+    for sid, from_number, to_number in [("SM1", "+1234567890", "+0987654321"), ("SM2", "+4455", "+0000")]:
+        data = {"SmsMessageSid": sid, "From": from_number, "To": to_number, "Body": "Hi"}
+        request(handler, "POST", "/message", data=data)
+    assert len(telegram_app.sent) == 1
+    assert telegram_app.sent[0][0] == [5, 6]
+
+
+def test_message_routed_before_coalescing():
+    handler, telegram_app = make_handler(
+        router=Router(to={"+0987654321": [5]}, keywords={"otp": [6]}, fallback=False),
+        coalescer=Coalescer(window=0.05),
+    )
+    messages = [
+        ("SM1", "+0987654321", "Hello"),
+        ("SM2", "+0000", "Your OTP is 1234"),
+        ("SM3", "+0000", "Unrelated"),
+        ("SM4", "+0987654321", "Again"),
+    ]
+
+    async def run():
+        transport = httpx.ASGITransport(app=handler)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            for sid, to_number, body in messages:
+                data = {"SmsMessageSid": sid, "From": "+1234567890", "To": to_number, "Body": body}
+                await client.post("/message", data=data)
+        await handler.coalescer.stop()
+
+    asyncio.run(run())
+    # Messages are only combined with others routed to the same chats, and unmatched ones go nowhere
+    sent = sorted(telegram_app.sent)
+    assert [chats for chats, _ in sent] == [[5], [6]]
+    assert "Hello" in sent[0][1] and "Again" in sent[0][1]
+    assert "OTP" in sent[1][1] and "Unrelated" not in sent[1][1]
+
+
+def test_coalescer_refused_with_queue(tmp_path):
+    # Buffered messages could be lost after Twilio was told they were safely queued
+    with pytest.raises(ValueError):
+        TwilioWebhookHandler(delivery_queue=DeliveryQueue(str(tmp_path / "queue.db")), coalescer=Coalescer())
+
+
+def test_message_overloaded():
+    admission = AdmissionControl(max_in_flight=1, retry_after=5)
+    handler, telegram_app = make_handler(admission=admission)
+    admission.acquire()
+    response = request(handler, "POST", "/message", data={"SmsMessageSid": "SM1", "From": "+1", "Body": "Hi"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+    assert telegram_app.sent == []
+
+    admission.release()
+    response = request(handler, "POST", "/message", data={"SmsMessageSid": "SM1", "From": "+1", "Body": "Hi"})
+    assert response.status_code == 200
+    assert admission.in_flight == 0
+
+
+def test_overloaded_body_not_read():
+    admission = AdmissionControl(max_in_flight=1)
+    handler, _ = make_handler(admission=admission)
+    admission.acquire()
+    scope = {"type": "http", "method": "POST", "path": "/message", "headers": []}
+    messages = []
+
+    async def receive():
+        raise AssertionError("The body should not be read")
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(handler(scope, receive, send))
+    assert messages[0]["status"] == 503
+
+
+def test_message_too_large():
+    handler, telegram_app = make_handler()
+    data = {"SmsMessageSid": "SM1", "From": "+1", "Body": "x" * (MAX_BODY_SIZE + 1)}
+    assert request(handler, "POST", "/message", data=data).status_code == 413
+
+    async def stream():
+        for _ in range(MAX_BODY_SIZE // 1024 + 1):
+            yield b"x" * 1024 + b"&"
+
+    # Chunked, so only the size read is checked
+    response = request(
+        handler, "POST", "/message", content=stream(), headers={"content-type": "application/x-www-form-urlencoded"}
+    )
+    assert response.status_code == 413
+    assert telegram_app.sent == []
+
+
+def test_message_sender_rate_limited():
+    handler, telegram_app = make_handler(admission=AdmissionControl(sender_limit=1))
+    for sid in ["SM1", "SM2", "SM3"]:
+        data = {"SmsMessageSid": sid, "From": "+1234567890", "To": "+0987654321", "Body": "Spam"}
+        assert request(handler, "POST", "/message", data=data).status_code == 200
+    # The first message is sent, the owners are told about the second and the third is dropped
+    assert len(telegram_app.sent) == 2
+    assert "Spam" in telegram_app.sent[0]
+    assert telegram_app.sent[1][0] == [1]
+    assert "Dropping messages and calls from \\+1234567890" in telegram_app.sent[1][1]
+
+
+def test_message_history():
+    class FakeHistory:
+        def __init__(self):
+            self.added = []
+
+        def add(self, message):
+            self.added.append(message)
+
+    history = FakeHistory()
+    handler, _ = make_handler(history=history)
+    request(handler, "POST", "/message", data={"SmsMessageSid": "SM1", "From": "+1", "To": "+2", "Body": "Hi"})
+    request(handler, "POST", "/call", data={"CallSid": "CA1", "From": "+1", "To": "+2"})
+    assert [message.body for message in history.added] == ["Hi"]
+
+
+def test_call():
+    handler, telegram_app = make_handler()
+    response = request(handler, "POST", "/call", data={"CallSid": "CA123", "From": "+1234567890", "To": "+0987"})
+    assert response.status_code == 200
+    assert "<Reject/>" in response.text
+    assert len(telegram_app.sent) == 1
+
+
+def test_status():
+    handler, telegram_app = make_handler()
+    response = request(handler, "POST", "/status", data={"MessageSid": "SM1", "MessageStatus": "failed"})
+    assert response.status_code == 200
+    assert telegram_app.sent[0].status == "failed"
+    assert request(handler, "POST", "/status", data={"SmsMessageSid": "SM2", "Body": "Hi"}).status_code == 400
+
+
+def test_status_failed_counted():
+    def count():
+        return REGISTRY.get_sample_value("webhook_status_error_count_total") or 0.0
+
+    handler, telegram_app = make_handler()
+
+    async def sms_status(status):
+        raise RuntimeError("Telegram unavailable")
+
+    telegram_app.sms_status = sms_status
+    before = count()
+    response = request(handler, "POST", "/status", data={"MessageSid": "SM1", "MessageStatus": "failed"})
+    assert response.status_code == 500
+    assert count() == before + 1
+
+
+def test_status_queued(tmp_path):
+    handler, telegram_app = make_handler(delivery_queue=DeliveryQueue(str(tmp_path / "queue.db"), retry_delay=0.01))
+    attempts = []
+
+    async def sms_status(status):
+        attempts.append(status)
+        if len(attempts) == 1:
+            raise RuntimeError("Telegram unavailable")
+
+    telegram_app.sms_status = sms_status
+
+    async def run():
+        await handler.delivery_queue.start(handler.deliver)
+        transport = httpx.ASGITransport(app=handler)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            response = await client.post("/status", data={"MessageSid": "SM1", "MessageStatus": "failed"})
+        while handler.delivery_queue.pending:
+            await asyncio.sleep(0.01)
+        await handler.delivery_queue.stop()
+        return response
+
+    # Twilio is answered straight away, and the failed notification is retried from the queue
+    assert asyncio.run(run()).status_code == 200
+    assert [status.sid for status in attempts] == ["SM1", "SM1"]
+
+
+def test_status_invalid_signature():
+    handler, telegram_app = make_handler(auth_token="secret")
+    response = request(handler, "POST", "/status", data={"MessageSid": "SM1", "MessageStatus": "failed"})
+    assert response.status_code == 403
+    assert telegram_app.sent == []
+
+
+def test_message_invalid_signature():
+    handler, telegram_app = make_handler(auth_token="secret")
+    response = request(handler, "POST", "/message", data={"SmsMessageSid": "SM123", "From": "+1", "Body": "Hi"})
+    assert response.status_code == 403
+    assert telegram_app.sent == []
+
+
+def test_message_valid_signature():
+    handler, telegram_app = make_handler(auth_token="secret")
+    data = {"SmsMessageSid": "SM123", "From": "+1", "To": "+2", "Body": "Hi"}
+    signature = RequestValidator("secret").compute_signature("http://testserver/message", data)
+    response = request(handler, "POST", "/message", data=data, headers={"X-Twilio-Signature": signature})
+    assert response.status_code == 200
+    assert len(telegram_app.sent) == 1
+
+
+def test_message_duplicate_ignored():
+    handler, telegram_app = make_handler(dedupe=DedupeCache())
+    data = {"SmsMessageSid": "SM123", "From": "+1", "To": "+2", "Body": "Hi"}
+    assert request(handler, "POST", "/message", data=data).status_code == 200
+    assert request(handler, "POST", "/message", data=data).status_code == 200
+    assert len(telegram_app.sent) == 1
+
+
+def test_telegram_update():
+    handler, telegram_app = make_handler(telegram_secret="s3cret")
+    telegram_app.app = TelegramSmsBot("123:abc").app
+    update = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}}
+
+    response = request(handler, "POST", "/telegram", json=update)
+    assert response.status_code == 403
+    response = request(handler, "POST", "/telegram", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert response.status_code == 403
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+    response = request(handler, "POST", "/telegram", json=update, headers=headers)
+    assert response.status_code == 200
+    assert telegram_app.app.update_queue.get_nowait().update_id == 1
+
+
+def test_telegram_update_disabled():
+    handler, _ = make_handler()
+    assert request(handler, "POST", "/telegram", json={}).status_code == 404
+
+
+def test_debug_disabled():
+    handler, _ = make_handler()
+    assert request(handler, "GET", "/debug/tasks").status_code == 404
+    assert request(handler, "GET", "/debug/profile").status_code == 404
+
+
+def test_debug_requires_token():
+    handler, _ = make_handler(diagnostics=Diagnostics("secret"))
+    assert request(handler, "GET", "/debug/tasks").status_code == 401
+    response = request(handler, "GET", "/debug/tasks", headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
+
+
+def test_debug_tasks():
+    handler, _ = make_handler(diagnostics=Diagnostics("secret"))
+    response = request(handler, "GET", "/debug/tasks", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+
+def test_debug_profile():
+    handler, _ = make_handler(diagnostics=Diagnostics("secret"))
+    headers = {"Authorization": "Bearer secret"}
+    response = request(handler, "GET", "/debug/profile?seconds=0.05", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "text/plain"
+    assert request(handler, "GET", "/debug/profile?seconds=nan", headers=headers).status_code == 400
+    assert request(handler, "GET", "/debug/profile?seconds=-1", headers=headers).status_code == 400